@@ -1,14 +1,24 @@
-from platform import platform
 import gc
 import json
 import uos
+import asyncio
 from machine import reset
 from config import config
-from update_from_github import Updater
+import sensor
+import metrics
+import code_rollback
 from logger import publish_log_message, publish_error_message, get_current_time
-from lib.ota import status, update
+
+# The updater, the OTA code and platform are all only imported when a command that needs them
+# arrives, so they don't take up memory the rest of the time
+
+# Only one firmware update and one code update can run at a time
+firmware_update_running = False
+code_update_running = False
 
 async def messages(client, payload):
+    global firmware_update_running, code_update_running
+
     gc.collect()
 
     try:
@@ -26,10 +36,25 @@ async def messages(client, payload):
                 await replace_config(incoming_config=payload.get('config'), client=client)
 
             elif payload['command'] == 'update_code':
-                await start_code_update(client)
+                # Like firmware updates, code updates download in the background so the board stays
+                # online while they run
+                if code_update_running:
+                    await publish_error_message(error={'error': 'A code update is already running'}, client=client)
+                elif code_rollback.pending():
+                    # Another update would replace the copy of the code the last one rolls back to
+                    await publish_error_message(error={'error': 'The last code update has not come online yet, try again once it has'}, client=client)
+                else:
+                    code_update_running = True
+                    asyncio.create_task(start_code_update(client))
 
             elif payload['command'] == 'update_firmware' and 'firmware' in payload:
-                await start_firmware_update(firmware=payload.get('firmware'), client=client)
+                # The update takes a while so it runs in the background, leaving other commands and
+                # messages for any output devices to be handled in the meantime
+                if firmware_update_running:
+                    await publish_error_message(error={'error': 'A firmware update is already running'}, client=client)
+                else:
+                    firmware_update_running = True
+                    asyncio.create_task(start_firmware_update(firmware=payload.get('firmware'), client=client))
 
             elif payload['command'] == 'restart':
                 await publish_log_message(message={
@@ -51,6 +76,9 @@ async def get_config(client):
 
 
 async def get_system_info(client):
+    from platform import platform
+    from lib.ota import status
+
     try:
         with open('.version', 'r') as file:
             commit = file.read()
@@ -72,6 +100,9 @@ async def get_system_info(client):
         "free_space": f'{(block_size * free_blocks)/1024:.0f}KB',
         "micropython_updates_supported": status.ready(),
         "current_time": get_current_time(),
+        "sensors": sensor.scheduler.stats(),
+        "metrics": metrics.stats(),
+        "mqtt": client.stats(),
     }
 
     await publish_log_message(message=system_info, client=client)
@@ -143,6 +174,18 @@ async def replace_config(incoming_config, client):
 
 
 async def start_code_update(client):
+    global code_update_running
+
+    try:
+        await _update_code(client)
+    finally:
+        code_update_running = False
+
+
+
+async def _update_code(client):
+    from update_from_github import Updater
+
     try:
         await publish_log_message(message={'message': 'Beginning code update from GitHub...'}, client=client)
 
@@ -153,10 +196,14 @@ async def start_code_update(client):
             api_token=config['github_token'],
             repository=config['github_repository'],
             ref=config['github_ref'],
+            mode=config['code_update_mode'],
+            archive_url=config['code_update_archive_url'],
             client=client,
         )
 
-        await config_updater.update()
+        if not await config_updater.update():
+            await publish_error_message(error={'error': 'Failed to download every file, the code has not been changed'}, client=client)
+            return
 
         await publish_log_message(message={
             'message': 'Code update successful, restarting board...',
@@ -168,6 +215,18 @@ async def start_code_update(client):
         await publish_error_message(error={'error': 'Failed to run update code'}, exception=e, client=client)
 
 async def start_firmware_update(firmware, client):
+    global firmware_update_running
+
+    try:
+        await _update_firmware(firmware=firmware, client=client)
+    finally:
+        firmware_update_running = False
+
+
+
+async def _update_firmware(firmware, client):
+    from lib.ota import status, update
+
     if status.ready() is not True:
         await publish_error_message(error={'error': 'Board cannot be updated over the air, make sure it has been flashed with an OTA-enabled image'}, client=client)
         return
@@ -189,13 +248,52 @@ async def start_firmware_update(firmware, client):
         'update_status': 'updating',
     }, client=client)
 
+    # Report progress every 10%
+    reported = [0]
+
+    async def publish_progress(written, length):
+        percent = written * 100 // length
+
+        if percent >= reported[0] + 10:
+            reported[0] = percent - percent % 10
+
+            await publish_log_message(message={
+                'message': f'Firmware update {percent}% complete',
+                'update_status': 'updating',
+                'progress': percent,
+            }, client=client)
+
     try:
         gc.collect()
 
-        update.from_file(url, sha=sha256, length=size, reboot=False)
+        delta_url = firmware.get('delta_url')
+        # Which of the patch or the whole image the firmware was updated from
+        updated_from = None
+
+        # A patch against the firmware that's running is much smaller to download than the whole image,
+        # but if it was made from different firmware, or downloading it fails partway since patches
+        # can't be resumed, fall back to downloading the whole thing
+        if delta_url is not None:
+            try:
+                await update.afrom_delta_file(delta_url, sha=sha256, length=size, verify='block', reboot=False, progress=publish_progress)
+                updated_from = f'patch {delta_url}'
+            except (ValueError, OSError) as e:
+                await publish_error_message(error={
+                    'error': f'Failed to apply firmware patch from {delta_url} ({e}), downloading {url} instead',
+                    'update_status': 'updating',
+                }, exception=e, client=client)
+
+                reported[0] = 0
+                gc.collect()
+
+        # This downloads and writes the firmware without blocking, so sensor readings keep being
+        # published and the connection to the broker stays up while it runs
+        if updated_from is None:
+            await update.afrom_file(url, sha=sha256, length=size, verify='block', reboot=False, progress=publish_progress)
+            updated_from = url
 
         await publish_log_message(message={
-            'message': f'Sucessfully updated firmware from {url}, restarting...',
+            'message': f'Sucessfully updated firmware from {updated_from}, restarting...',
             'update_status': 'updated',
             'status': 'offline',
         }, client=client)
@@ -0,0 +1,5 @@
+# Finish off a code update that was interrupted, or roll it back if it hasn't come online after a few
+# boots, before main.py runs
+import code_rollback
+
+code_rollback.check()
@@ -0,0 +1,26 @@
+import gc
+from time import ticks_ms
+import logger
+
+# Records when each phase of starting up finished and how much memory was free at that point, so the
+# time from a restart to the first reading being sent can be measured. Times are milliseconds since
+# the board started. The profile is only published once, after which nothing more is recorded.
+_phases = []
+_published = False
+
+def mark(phase):
+    if not _published:
+        _phases.append((phase, ticks_ms(), gc.mem_free()))
+
+async def publish(client, phase):
+    global _published
+
+    if _published:
+        return
+
+    mark(phase)
+    _published = True
+
+    await logger.publish_log_message(message={
+        'boot_profile': [{'phase': name, 'ms': ms, 'mem_free': mem_free} for (name, ms, mem_free) in _phases],
+    }, client=client)
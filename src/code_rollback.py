@@ -0,0 +1,224 @@
+import os
+import json
+
+# Code updates are downloaded into STAGING_DIR and only swapped in once every file has been fetched and
+# verified. While they're being swapped in, the files they replace or delete are moved into
+# PREVIOUS_DIR, and JOURNAL_FILE records what's being changed so that if the board resets partway
+# through, the swap can be finished on the next boot. The journal is kept until the new code has
+# successfully come online, and if it doesn't manage that within MAX_BOOTS boots the previous code is
+# put back, the same way an OTA firmware update is rolled back.
+STAGING_DIR = '.staging'
+PREVIOUS_DIR = '.previous'
+JOURNAL_FILE = '.update_journal.json'
+MAX_BOOTS = 3
+# The board is restarted if the new code hasn't come online this long after booting, so code that
+# hangs or drops to the REPL still counts towards MAX_BOOTS
+TRIAL_TIMEOUT = 300000
+
+_timer = None
+
+def exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+
+# Create every directory leading up to filename
+def make_dirs(filename):
+    path = ''
+
+    for part in filename.split('/')[:-1]:
+        path += part
+
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+
+        path += '/'
+
+
+
+# Remove a directory and everything in it
+def remove_dir(path):
+    if not exists(path):
+        return
+
+    for entry in os.ilistdir(path):
+        child = f'{path}/{entry[0]}'
+
+        if entry[1] == 0x4000:
+            remove_dir(child)
+        else:
+            os.remove(child)
+
+    os.rmdir(path)
+
+
+
+# Remove the directories leading up to filename if that leaves them empty
+def remove_empty_dirs(filename):
+    path = filename
+
+    while '/' in path:
+        path = path.rsplit('/', 1)[0]
+
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+
+
+
+def move(source, destination):
+    make_dirs(destination)
+
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # Not every filesystem allows renaming over an existing file
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+
+def _write_journal(journal):
+    with open(JOURNAL_FILE + '.tmp', 'w') as file:
+        json.dump(journal, file)
+
+    move(JOURNAL_FILE + '.tmp', JOURNAL_FILE)
+
+
+
+def _read_journal():
+    try:
+        with open(JOURNAL_FILE, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+
+# Swap the files in STAGING_DIR into place and delete the given files, keeping what they replace so it
+# can be restored. Every step can safely be run again if the board resets partway through.
+def _apply(journal):
+    for filename in journal['install']:
+        staged = f'{STAGING_DIR}/{filename}'
+
+        if not exists(staged):
+            continue
+
+        if exists(filename) and not exists(f'{PREVIOUS_DIR}/{filename}'):
+            move(filename, f'{PREVIOUS_DIR}/{filename}')
+
+        move(staged, filename)
+
+    for filename in journal['delete']:
+        if exists(filename):
+            move(filename, f'{PREVIOUS_DIR}/{filename}')
+            remove_empty_dirs(filename)
+
+    remove_dir(STAGING_DIR)
+
+    journal['state'] = 'trial'
+    journal['boots'] = 0
+    _write_journal(journal)
+
+
+
+# Put back the files that were replaced or deleted, and remove any that were added
+def _rollback(journal):
+    for filename in journal['install'] + journal['delete']:
+        previous = f'{PREVIOUS_DIR}/{filename}'
+
+        if exists(previous):
+            move(previous, filename)
+        elif filename in journal['install'] and exists(filename):
+            os.remove(filename)
+            remove_empty_dirs(filename)
+
+    remove_dir(PREVIOUS_DIR)
+
+    journal['state'] = 'rolled_back'
+    _write_journal(journal)
+
+
+
+# True while the last code update is still being swapped in or hasn't come online yet, during which
+# PREVIOUS_DIR holds the only copy of the code to roll back to
+def pending():
+    journal = _read_journal()
+
+    return journal is not None and journal['state'] in ('commit', 'trial')
+
+
+
+# Swap in a staged code update. install is every file in STAGING_DIR, and delete is every file that was
+# removed upstream. Refuses while the last update is still pending, since swapping in another one would
+# delete the code it would be rolled back to.
+def commit(install, delete):
+    if pending():
+        raise RuntimeError('The last code update has not come online yet')
+
+    remove_dir(PREVIOUS_DIR)
+
+    journal = {'state': 'commit', 'install': install, 'delete': delete}
+    _write_journal(journal)
+    _apply(journal)
+
+
+
+# Called from boot.py before main.py runs, to finish off an update that was interrupted, count how many
+# times the new code has booted without coming online, and roll it back once that reaches MAX_BOOTS
+def check():
+    global _timer
+
+    journal = _read_journal()
+
+    if journal is None:
+        return
+
+    if journal['state'] == 'commit':
+        print('Finishing interrupted code update')
+        _apply(journal)
+
+    if journal['state'] != 'trial':
+        return
+
+    journal['boots'] += 1
+
+    if journal['boots'] > MAX_BOOTS:
+        print(f"New code failed to come online after {MAX_BOOTS} boots, rolling back")
+        _rollback(journal)
+        return
+
+    _write_journal(journal)
+
+    from machine import Timer, reset
+
+    _timer = Timer(0)
+    _timer.init(mode=Timer.ONE_SHOT, period=TRIAL_TIMEOUT, callback=lambda t: reset())
+
+
+
+# Called once the board is online to keep the new code. Returns 'updated' if new code has just come
+# online or 'rolled_back' if it was rolled back, the first time it's called after either happens.
+def cancel():
+    global _timer
+
+    if _timer is not None:
+        _timer.deinit()
+        _timer = None
+
+    journal = _read_journal()
+
+    if journal is None or journal['state'] == 'commit':
+        return None
+
+    remove_dir(PREVIOUS_DIR)
+    os.remove(JOURNAL_FILE)
+
+    return 'updated' if journal['state'] == 'trial' else journal['state']
@@ -13,6 +13,7 @@ mqtt_config['server']                        = c.get('server')
 mqtt_config['port']                          = c.get('port')
 mqtt_config['ssid']                          = c.get('ssid')
 mqtt_config['wifi_pw']                       = c.get('wifi_pw')
+mqtt_config['max_inflight']                  = convert_to_int(c.get('max_inflight', 4))
 mqtt_config['will']                          = f"logs/{c.get('client_id')}", '{"status": "offline"}', True, 1
 
 config = {}
@@ -29,12 +30,19 @@ config['disable_watchdog']              = c.get('disable_watchdog', False)
 config['led_pin']                       = convert_to_int(c.get('led_pin', 13))
 config['neopixel_pin']                  = convert_to_int(c.get('neopixel_pin', None))
 config['neopixel_power_pin']            = convert_to_int(c.get('neopixel_power_pin', None))
+config['offline_buffer_size']           = convert_to_int(c.get('offline_buffer_size', 8192))
+config['offline_buffer_spill_size']     = convert_to_int(c.get('offline_buffer_spill_size', 0))
+config['batch']                         = c.get('batch', None)
+config['sensor_tick']                   = c.get('sensor_tick', 1)
+config['metrics']                       = c.get('metrics', None)
 
 # Settings for GitHub updates
 config['github_token']                  = c.get('github_token', None)
 config['github_username']               = c.get('github_username', 'VirtualWolf')
 config['github_repository']             = c.get('github_repository', 'esp32-sensor-reader-mqtt')
 config['github_ref']                    = c.get('github_ref', 'main')
+config['code_update_mode']              = c.get('code_update_mode', 'api')
+config['code_update_archive_url']       = c.get('code_update_archive_url', None)
 
 # MQTT topics to subscribe to for receiving commands and emitting logs
 config['commands_topic']                = f"commands/{c.get('client_id')}"
@@ -0,0 +1,17 @@
+# Maps each sensor type that can be used in the configuration to the module in this package with its
+# driver. Drivers are only imported when a sensor of that type is configured, so a board with one
+# sensor attached doesn't spend the memory or boot time loading the code for all of the others.
+DRIVERS = {
+    'dht22': 'dht22',
+    'bme280': 'bme280',
+    'sht30': 'sht30',
+    'pms5003': 'pms5003',
+    'ens160': 'ens160',
+    'vl53l1x': 'vl53l1x',
+}
+
+def get_driver(sensor_type):
+    if sensor_type not in DRIVERS:
+        raise ValueError(f'Unknown sensor type {sensor_type}')
+
+    return __import__(f'drivers.{DRIVERS[sensor_type]}', None, None, ['Driver']).Driver
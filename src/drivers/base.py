@@ -0,0 +1,51 @@
+from math import log
+import sntp
+
+# The most recent temperature and humidity read by any sensor, which the ENS160 uses for calibration
+# rather than defaulting to 25˚C and 50% humidity
+calibration = {
+    'temperature': 25,
+    'humidity': 50,
+}
+
+# Each sensor's driver subclasses this and adds an async read(self, client) method, which returns the
+# reading to publish, or None if there's nothing to publish this time
+class Driver:
+    # Sensors on the I2C bus are given the bus when they're set up
+    uses_i2c = False
+    # How often the sensor is read in seconds, unless the sensor configuration has its own interval
+    default_interval = 30
+    # Sensors that have to be checked constantly rather than read on an interval set this to how
+    # often to poll them in milliseconds
+    poll_interval = None
+    # How long the watchdog waits for a successful reading before restarting the board. If sensors
+    # with different timeouts are attached only the ones with the longest timeout feed the watchdog,
+    # so a sensor that's read less often can't be hidden by the others carrying on.
+    watchdog_timeout = 120000
+
+    def __init__(self, sensor, i2c=None):
+        self.sensor = sensor
+        self.topic = sensor['topic']
+        self.payload_format = sensor.get('format', 'json')
+        self.feeds_watchdog = True
+
+
+
+def set_calibration(temperature, humidity):
+    calibration['temperature'] = temperature
+    calibration['humidity'] = humidity
+
+
+
+def generate_timestamp():
+    return sntp.time_ms()
+
+
+
+# Thanks to https://gist.github.com/sourceperl/45587ea99ff123745428?permalink_comment_id=5119362#gistcomment-5119362
+def calculate_dew_point(temperature, humidity):
+    a = 17.625
+    b = 243.04
+    alpha = log(humidity/100.0) + ((a * temperature) / (b + temperature))
+
+    return (b * alpha) / (a - alpha)
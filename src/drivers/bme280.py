@@ -0,0 +1,39 @@
+import logger
+from lib import bme280_float
+from drivers.base import Driver as BaseDriver, set_calibration, generate_timestamp
+
+class Driver(BaseDriver):
+    uses_i2c = True
+
+    def __init__(self, sensor, i2c=None):
+        super().__init__(sensor, i2c)
+        self.device = bme280_float.BME280(i2c=i2c, address=sensor['i2c_address'])
+
+    async def read(self, client):
+        (temperature, pressure, humidity) = self.device.read_compensated_data()
+        dew_point = self.device.dew_point
+        timestamp = generate_timestamp()
+
+        set_calibration(temperature, humidity)
+
+        logger.log(f'Sensor read at {timestamp}, new values: {temperature}C, {humidity}%, and {pressure} Pa. Dew point is {dew_point}')
+
+        if self.sensor.get('enable_pressure_only') is True:
+            return {
+                "timestamp": timestamp,
+                "pressure": pressure/100
+            }
+
+        current_data = {
+            "timestamp": timestamp,
+            "temperature": temperature,
+            "humidity": humidity,
+        }
+
+        if self.sensor['enable_additional_data'] is True:
+            current_data.update({
+                "dew_point": dew_point,
+                "pressure": pressure/100
+            })
+
+        return current_data
@@ -0,0 +1,34 @@
+import dht
+from machine import Pin
+import logger
+from drivers.base import Driver as BaseDriver, set_calibration, generate_timestamp, calculate_dew_point
+
+class Driver(BaseDriver):
+    def __init__(self, sensor, i2c=None):
+        super().__init__(sensor, i2c)
+        self.device = dht.DHT22(Pin(sensor['rx_pin']))
+
+    async def read(self, client):
+        self.device.measure()
+
+        temperature = self.device.temperature()
+        humidity = self.device.humidity()
+        dew_point = calculate_dew_point(temperature=temperature, humidity=humidity)
+        timestamp = generate_timestamp()
+
+        set_calibration(temperature, humidity)
+
+        logger.log(f'Sensor read at {timestamp}, new values: {temperature} & {humidity}%. Dew point is {dew_point}')
+
+        current_data = {
+            "timestamp": timestamp,
+            "temperature": temperature,
+            "humidity": humidity
+        }
+
+        if self.sensor.get('enable_dew_point') is True:
+            current_data.update({
+                'dew_point': dew_point
+            })
+
+        return current_data
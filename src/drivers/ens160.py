@@ -0,0 +1,28 @@
+import logger
+from lib import ens160
+from drivers.base import Driver as BaseDriver, calibration, generate_timestamp
+
+class Driver(BaseDriver):
+    uses_i2c = True
+
+    def __init__(self, sensor, i2c=None):
+        super().__init__(sensor, i2c)
+        self.device = ens160.ENS160(i2c=i2c, address=sensor['i2c_address'], temperature=calibration['temperature'], humidity=calibration['humidity'])
+
+    async def read(self, client):
+        (aqi, tvoc, eco2) = self.device.get_readings()
+        timestamp = generate_timestamp()
+
+        logger.log('Sensor read at {}. AQI {}, TVOC {}, ECO2 {}'.format(timestamp, aqi, tvoc, eco2))
+
+        if aqi == 0:
+            await logger.publish_log_message({'message': 'Received 0 reading for AQI, skipping'}, client=client)
+
+            return None
+
+        return {
+            'timestamp': timestamp,
+            'aqi': aqi,
+            'tvoc': tvoc,
+            'eco2': eco2,
+        }
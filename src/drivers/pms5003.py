@@ -0,0 +1,21 @@
+import logger
+from lib import pms5003
+from drivers.base import Driver as BaseDriver, generate_timestamp
+
+class Driver(BaseDriver):
+    # The PMS5003 is only read every three minutes to prolong the sensor lifetime, so the watchdog
+    # timeout needs to be several times that rather than two minutes
+    default_interval = 180
+    watchdog_timeout = 600000
+
+    async def read(self, client):
+        current_data = await pms5003.read_data(rx_pin=self.sensor['rx_pin'])
+
+        if current_data is None:
+            await logger.publish_error_message(error={'error': 'No valid data'}, client=client)
+
+            return None
+
+        current_data['timestamp'] = generate_timestamp()
+
+        return current_data
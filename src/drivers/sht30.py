@@ -0,0 +1,72 @@
+import logger
+from lib import sht30
+from drivers.base import Driver as BaseDriver, set_calibration, generate_timestamp, calculate_dew_point
+
+HIGH_HUMIDITY = 95
+
+class Driver(BaseDriver):
+    uses_i2c = True
+
+    def __init__(self, sensor, i2c=None):
+        super().__init__(sensor, i2c)
+        self.device = sht30.SHT30(i2c=i2c, address=sensor['i2c_address'])
+        self.heater_on_count = 0
+        self.heater_enabled_at = 0
+
+    async def read(self, client):
+        (temperature, humidity) = self.device.measure()
+        dew_point = calculate_dew_point(temperature, humidity)
+        timestamp = generate_timestamp()
+
+        set_calibration(temperature, humidity)
+
+        logger.log(f'Sensor read at {timestamp}, new values: {temperature}C, {humidity}%. Dew point is {dew_point}')
+
+        current_data = {
+            "timestamp": timestamp,
+            "temperature": temperature,
+            "humidity": humidity
+        }
+
+        if self.sensor.get('enable_dew_point') is True:
+            current_data.update({'dew_point': dew_point})
+
+        if self.sensor.get('enable_heater') is True:
+            await self._update_heater(client, humidity, timestamp)
+
+        return current_data
+
+    async def _update_heater(self, client, humidity, timestamp):
+        is_heater_on = self.device.is_heater_on()
+
+        if is_heater_on is None:
+            sensor_status = self.device.status()
+            await logger.publish_log_message(message={'message':f'Received unexpected response from heater status check: {sensor_status}'}, client=client)
+
+        # Initial state of high humidity, heater not on, and hasn't been on in the last five minutes
+        if humidity > HIGH_HUMIDITY and self.heater_on_count == 0 and (timestamp - self.heater_enabled_at) > 300000 and is_heater_on is False:
+            await logger.publish_log_message(message={'message': f'Humidity is {humidity}, enabling heater'}, client=client)
+
+            self.device.turn_heater_on()
+            self.heater_on_count = self.heater_on_count + 1
+            self.heater_enabled_at = timestamp
+
+        # Humidity has reduced so we can turn the heater off regardless of how long it's been on
+        elif humidity <= HIGH_HUMIDITY and is_heater_on is True:
+            await logger.publish_log_message(message={'message': f'Humidity is {humidity}, disabling heater'}, client=client)
+
+            self.device.turn_heater_off()
+            self.heater_on_count = 0
+
+        # Heater is on but humidity is still high and the maximum heater count hasn't been reached
+        elif humidity > HIGH_HUMIDITY and is_heater_on is True and 0 < self.heater_on_count < 5:
+            await logger.publish_log_message(message={'message': f'Humidity is {humidity}, incrementing heater_on_count to {self.heater_on_count}'}, client=client)
+
+            self.heater_on_count = self.heater_on_count + 1
+
+        # The heater is on and has been on for the last five readings so we'll turn it off again
+        elif is_heater_on is True and self.heater_on_count >= 5:
+            await logger.publish_log_message(message={'message': f'Humidity is {humidity}, heater_on_count has reached 5, disabling heater'}, client=client)
+
+            self.device.turn_heater_off()
+            self.heater_on_count = 0
@@ -0,0 +1,48 @@
+import logger
+from lib import vl53l1x
+from drivers.base import Driver as BaseDriver, generate_timestamp
+
+class Driver(BaseDriver):
+    uses_i2c = True
+    # The sensor is polled constantly to catch anything crossing the distance threshold rather than
+    # being sampled periodically
+    poll_interval = 50
+
+    def __init__(self, sensor, i2c=None):
+        super().__init__(sensor, i2c)
+        self.device = vl53l1x.VL53L1X(i2c=i2c, address=sensor['i2c_address'])
+        self.last_trigger = 0
+        self.triggered = False
+
+    async def read(self, client):
+        distance = self.device.read()
+
+        if self.device.status != 'OK':
+            return None
+
+        timestamp = generate_timestamp()
+        threshold = self.sensor['trigger_threshold_mm']
+        ignore_trigger_period = self.sensor['ignore_trigger_period'] * 1000
+
+        # If the threshold is breached AND it's not currently triggered AND the last trigger timestamp is more than the ignore period, send a trigger message
+        if distance < threshold and self.triggered is False and (timestamp - self.last_trigger > ignore_trigger_period):
+            await logger.publish_log_message({'message': 'Distance threshold breached'}, client=client)
+
+            self.last_trigger = timestamp
+            self.triggered = True
+
+            return {'timestamp': timestamp, 'triggered': True}
+
+        # If the threshold is breached but it's already been triggered, update the last trigger timestamp so the ignore period remains current
+        elif distance < threshold and self.triggered is True:
+            self.last_trigger = timestamp
+
+        # If the threshold is no longer breached AND it's currently triggered AND the last trigger time is greater than the ignore period, reset back to false
+        elif distance > threshold and self.triggered is True and (self.last_trigger < timestamp - ignore_trigger_period):
+            await logger.publish_log_message({'message': 'Distance threshold not breached in last period, resetting trigger'}, client=client)
+
+            self.triggered = False
+
+            return {'timestamp': timestamp, 'triggered': False}
+
+        return None
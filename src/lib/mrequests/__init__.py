@@ -2,6 +2,7 @@ from .mrequests import (
     MAX_READ_SIZE,
     RequestContext,
     Response,
+    Session,
     delete,
     encode_basic_auth,
     get,
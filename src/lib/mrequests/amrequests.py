@@ -0,0 +1,595 @@
+"""An asyncio HTTP client for MicroPython with an API similar to mrequests.
+
+Requests are made over asyncio streams, so other tasks keep running while waiting
+on DNS, the connection, TLS and the response, instead of the whole board blocking.
+Responses follow redirects and support chunked transfer encoding, and their bodies
+can be read, saved or iterated over a chunk at a time with ``await``:
+
+    response = await amrequests.get(url)
+    async for chunk in response.iter_chunks(buf):
+        ...
+    await response.close()
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+try:
+    from errno import ECONNRESET, ETIMEDOUT
+except ImportError:
+    from uerrno import ECONNRESET, ETIMEDOUT
+
+from . import mrequests
+from .mrequests import MAX_READ_SIZE, MICROPY, JsonArrayParser, RequestContext, _prepare, _request_head
+
+
+def head(url, **kw):
+    return request("HEAD", url, **kw)
+
+
+def get(url, **kw):
+    return request("GET", url, **kw)
+
+
+def post(url, **kw):
+    return request("POST", url, **kw)
+
+
+def put(url, **kw):
+    return request("PUT", url, **kw)
+
+
+def patch(url, **kw):
+    return request("PATCH", url, **kw)
+
+
+def delete(url, **kw):
+    return request("DELETE", url, **kw)
+
+
+async def _wait(coro, timeout):
+    if timeout is None:
+        return await coro
+
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise OSError(ETIMEDOUT)
+
+
+class _Stream:
+    """Give CPython's StreamReader and StreamWriter the interface of MicroPython's Stream."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write(data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def readline(self):
+        return await self.reader.readline()
+
+    async def readinto(self, buf):
+        data = await self.reader.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    async def wait_closed(self):
+        self.writer.close()
+
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def _connect(ctx, timeout=None, ssl_context=None):
+    ssl = (ssl_context or True) if ctx.scheme == "https" else None
+    reader, writer = await _wait(asyncio.open_connection(ctx.host, ctx.port, ssl=ssl), timeout)
+    return reader if MICROPY else _Stream(reader, writer)
+
+
+async def _send_request(stream, ctx, headers, data, json, encoding, keep_alive=False, timeout=None):
+    stream.write(_request_head(ctx, headers, data, json, encoding, keep_alive))
+
+    if data and ctx.method not in ("GET", "HEAD"):
+        stream.write(data if isinstance(data, bytes) else data.encode(encoding or "utf-8"))
+
+    await _wait(stream.drain(), timeout)
+
+
+async def _read_response(stream, ctx, response_class, save_headers, timeout):
+    resp = response_class(stream, save_headers=save_headers, timeout=timeout)
+    l = await _wait(stream.readline(), timeout)
+
+    if not l:
+        # The server closed the connection without responding
+        raise OSError(ECONNRESET)
+
+    l = l.split(None, 2)
+    resp.status_code = int(l[1])
+
+    if len(l) > 2:
+        resp.reason = l[2].rstrip()
+
+    while True:
+        l = await _wait(stream.readline(), timeout)
+        if not l or l == b"\r\n":
+            break
+
+        if l.startswith(b"Location:"):
+            ctx.set_location(resp.status_code, l[9:].strip().decode("ascii"))
+
+        resp.add_header(l)
+
+    resp._check_body(ctx.method)
+    return resp
+
+
+class Response(mrequests.Response):
+    """The response to a request, whose body is read with ``await``.
+
+    Headers are parsed the same way as ``mrequests.Response``. Call ``await
+    close()`` when finished with it so the connection is closed, or handed back to
+    the session it came from.
+    """
+
+    def __init__(self, stream, save_headers=False, timeout=None):
+        super().__init__(stream, stream, save_headers)
+        self._timeout = timeout
+
+    async def read(self, size=MAX_READ_SIZE):
+        if self.chunked:
+            if self._chunk_size == 0 and not await self._next_chunk():
+                return b""
+
+            size = min(size or MAX_READ_SIZE, self._chunk_size)
+        elif self._remaining is not None:
+            size = min(size or self._remaining, self._remaining)
+
+            if not size:
+                return b""
+        else:
+            size = size or MAX_READ_SIZE
+
+        buf = bytearray(size)
+        n = await self.readinto(buf)
+        return bytes(buf[:n])
+
+    async def readinto(self, buf, size=0):
+        size = size or len(buf)
+
+        if self.chunked:
+            if self._chunk_size == 0 and not await self._next_chunk():
+                return 0
+
+            n = await self._readinto(buf, min(size, self._chunk_size))
+
+            if not n:
+                raise OSError(ECONNRESET)
+
+            self._chunk_size -= n
+
+            if self._chunk_size == 0:
+                await self._end_chunk()
+
+            return n
+
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+
+            if not size:
+                return 0
+
+            n = await self._readinto(buf, size)
+
+            if not n:
+                raise OSError(ECONNRESET)
+
+            self._remaining -= n
+            self._done = self._remaining == 0
+            return n
+
+        return await self._readinto(buf, size)
+
+    async def _readinto(self, buf, size):
+        mv = buf if size == len(buf) else memoryview(buf)[:size]
+
+        while True:
+            n = await _wait(self._sf.readinto(mv), self._timeout)
+
+            # An SSL socket can be readable without any data being ready
+            if n is not None:
+                return n
+
+    async def _read_exactly(self, mv):
+        pos = 0
+
+        while pos < len(mv):
+            n = await self._readinto(mv[pos:], len(mv) - pos)
+
+            if not n:
+                break
+
+            pos += n
+
+        return pos
+
+    async def _next_chunk(self):
+        if self._done:
+            return False
+
+        if self._sep is None:
+            self._sep = bytearray(2)
+            self._byte = memoryview(self._sep)[:1]
+
+        size = 0
+        ext = False
+
+        while True:
+            if not await self._read_exactly(self._byte):
+                # Connection closed before the last chunk
+                self._keep_alive = False
+                self._done = True
+                return False
+
+            b = self._byte[0]
+
+            if b == 0x0A:  # \n
+                break
+            elif ext or b in (0x0D, 0x20, 0x09):
+                continue
+            elif b == 0x3B:  # ;, ignore chunk extensions
+                ext = True
+            elif 0x30 <= b <= 0x39:
+                size = size * 16 + b - 0x30
+            elif 0x61 <= b <= 0x66 or 0x41 <= b <= 0x46:
+                size = size * 16 + (b | 0x20) - 0x57
+            else:
+                raise ValueError("Invalid chunk size.")
+
+        self._chunk_size = size
+
+        if size == 0:
+            # End of message
+            await self._end_chunk("final chunk separator")
+            self._done = True
+            return False
+
+        return True
+
+    async def _end_chunk(self, what="chunk separator"):
+        sep = self._sep
+        n = await self._read_exactly(memoryview(sep))
+
+        if n != 2 or sep[0] != 0x0D or sep[1] != 0x0A:
+            raise ValueError("Expected %s, read %r instead." % (what, bytes(sep[:n])))
+
+    def iter_chunks(self, buf):
+        """Iterate over the body, read into buf one chunk at a time.
+
+        Each chunk is buf itself, or a view of the part of it that was filled, and is
+        only valid until the next one is read.
+        """
+        return _ChunkIterator(self, buf)
+
+    def iter_json_array(self, chunk_size=256):
+        """Iterate over the elements of a JSON array body as they are read."""
+        return _JsonArrayIterator(self, chunk_size)
+
+    async def save(self, fn, buf=None, chunk_size=0):
+        with open(fn, "wb") as fobj:
+            return await self.saveinto(fobj, buf, chunk_size)
+
+    async def saveinto(self, fobj, buf=None, chunk_size=0):
+        num_read_total = 0
+
+        if not buf:
+            buf = bytearray(chunk_size or MAX_READ_SIZE)
+            chunk_size = 0
+
+        while True:
+            num_read_chunk = await self.readinto(buf, chunk_size)
+
+            if not num_read_chunk:
+                break
+
+            num_read_total += num_read_chunk
+            fobj.write(buf if num_read_chunk == len(buf) else memoryview(buf)[:num_read_chunk])
+
+        return num_read_total
+
+    async def drain(self):
+        if self._sf and self._keep_alive and (self.chunked or self._remaining is not None):
+            buf = bytearray(256)
+
+            while await self.readinto(buf):
+                pass
+
+    async def close(self):
+        if self._session is not None and self._sf and self.reusable:
+            # Give the connection back to the session for its next request
+            self._session._release(self._sf)
+        elif self._sf:
+            await self._sf.wait_closed()
+
+        self._sf = self._sock = None
+        self._cached = None
+
+    async def content(self):
+        if self._cached is None:
+            try:
+                chunks = []
+
+                while True:
+                    chunk = await self.read(size=None)
+
+                    if not chunk:
+                        break
+
+                    chunks.append(chunk)
+
+                self._cached = b"".join(chunks)
+            finally:
+                cached = self._cached
+                await self.close()
+                self._cached = cached
+
+        return self._cached
+
+    async def text(self):
+        return str(await self.content(), self.encoding)
+
+    async def json(self):
+        try:
+            import json
+        except ImportError:
+            import ujson as json
+
+        return json.loads(await self.content())
+
+
+class _ChunkIterator:
+    def __init__(self, response, buf):
+        self.response = response
+        self.buf = buf
+        self.mv = memoryview(buf)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        n = await self.response.readinto(self.buf)
+
+        if not n:
+            raise StopAsyncIteration
+
+        return self.buf if n == len(self.buf) else self.mv[:n]
+
+
+class _JsonArrayIterator:
+    def __init__(self, response, chunk_size):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.parser = JsonArrayParser()
+        self.items = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.items:
+            if self.parser.done:
+                await self.response.drain()
+                raise StopAsyncIteration
+
+            data = await self.response.read(self.chunk_size)
+
+            if not data:
+                raise ValueError("JSON array ended unexpectedly.")
+
+            self.items = self.parser.feed(data)
+
+        return self.items.pop(0)
+
+
+async def request(
+    method,
+    url,
+    data=None,
+    json=None,
+    headers={},
+    auth=None,
+    encoding=None,
+    response_class=Response,
+    save_headers=False,
+    max_redirects=1,
+    timeout=None,
+    ssl_context=None
+):
+    data = _prepare(data, json, headers, auth)
+    ctx = RequestContext(url, method)
+
+    while True:
+        if ctx.scheme not in ("http", "https"):
+            raise ValueError("Protocol scheme %s not supported." % ctx.scheme)
+
+        ctx.redirect = False
+
+        stream = await _connect(ctx, timeout, ssl_context)
+        try:
+            await _send_request(stream, ctx, headers, data, json, encoding, timeout=timeout)
+            resp = await _read_response(stream, ctx, response_class, save_headers, timeout)
+        except BaseException:
+            await stream.wait_closed()
+            raise
+
+        if ctx.redirect:
+            await stream.wait_closed()
+            max_redirects -= 1
+
+            if max_redirects < 0:
+                raise ValueError("Maximum redirection count exceeded.")
+
+        else:
+            break
+
+    return resp
+
+
+class Session:
+    """Make requests over a persistent connection, like ``mrequests.Session``.
+
+    The connection to the last host is kept open and reused for the next request to
+    the same host and port once the previous response has been read to the end, and
+    re-opened transparently if the server has closed it.
+    """
+
+    def __init__(
+        self,
+        headers=None,
+        auth=None,
+        response_class=Response,
+        save_headers=False,
+        timeout=None,
+        ssl_context=None
+    ):
+        self.headers = headers or {}
+        self.auth = auth
+        self.response_class = response_class
+        self.save_headers = save_headers
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._key = None
+        self._stream = None
+        self._busy = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def head(self, url, **kw):
+        return self.request("HEAD", url, **kw)
+
+    def get(self, url, **kw):
+        return self.request("GET", url, **kw)
+
+    def post(self, url, **kw):
+        return self.request("POST", url, **kw)
+
+    def put(self, url, **kw):
+        return self.request("PUT", url, **kw)
+
+    def patch(self, url, **kw):
+        return self.request("PATCH", url, **kw)
+
+    def delete(self, url, **kw):
+        return self.request("DELETE", url, **kw)
+
+    async def request(
+        self,
+        method,
+        url,
+        data=None,
+        json=None,
+        headers=None,
+        auth=None,
+        encoding=None,
+        max_redirects=1
+    ):
+        hdrs = self.headers.copy()
+        if headers:
+            hdrs.update(headers)
+
+        data = _prepare(data, json, hdrs, auth or self.auth)
+        ctx = RequestContext(url, method)
+
+        while True:
+            if ctx.scheme not in ("http", "https"):
+                raise ValueError("Protocol scheme %s not supported." % ctx.scheme)
+
+            ctx.redirect = False
+            resp = await self._request(ctx, hdrs, data, json, encoding)
+
+            if ctx.redirect:
+                await resp.drain()
+                await resp.close()
+                max_redirects -= 1
+
+                if max_redirects < 0:
+                    raise ValueError("Maximum redirection count exceeded.")
+
+            else:
+                break
+
+        return resp
+
+    async def _request(self, ctx, headers, data, json, encoding):
+        # A previous response that wasn't read to the end leaves the connection in an
+        # unknown state, so it can't be used again
+        if self._busy is not None:
+            busy, self._busy = self._busy, None
+            busy._session = None
+            await busy.close()
+
+        key = (ctx.scheme, ctx.host, ctx.port)
+
+        if key != self._key:
+            await self.close()
+
+        reused = self._stream is not None
+
+        while True:
+            if self._stream is None:
+                self._stream = await _connect(ctx, self.timeout, self.ssl_context)
+                self._key = key
+
+            stream, self._stream = self._stream, None
+
+            try:
+                await _send_request(stream, ctx, headers, data, json, encoding, True, self.timeout)
+                resp = await _read_response(stream, ctx, self.response_class, self.save_headers, self.timeout)
+            except BaseException as e:
+                # Whatever went wrong, including being cancelled, the connection is in
+                # an unknown state so it's never put back for the next request
+                await stream.wait_closed()
+                self._key = None
+
+                # The server may have closed the connection while it was idle, so try
+                # once more on a new one
+                if reused and isinstance(e, OSError):
+                    reused = False
+                    continue
+
+                raise
+
+            resp._session = self
+            self._busy = resp
+            return resp
+
+    # Called by Response.close() to hand back a connection that can be reused
+    def _release(self, stream):
+        if self._busy is not None and self._busy._sf is stream:
+            self._busy = None
+
+        self._stream = stream
+
+    async def close(self):
+        if self._busy is not None:
+            busy, self._busy = self._busy, None
+            busy._session = None
+            await busy.close()
+
+        if self._stream is not None:
+            stream, self._stream = self._stream, None
+            await stream.wait_closed()
+
+        self._key = None
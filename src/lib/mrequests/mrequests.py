@@ -7,6 +7,11 @@ try:
 except ImportError:
     import usocket as socket
 
+try:
+    from errno import ECONNRESET
+except ImportError:
+    from uerrno import ECONNRESET
+
 
 MICROPY = sys.implementation.name == "micropython"
 MAX_READ_SIZE = 4 * 1024
@@ -135,6 +140,15 @@ class Response:
         self._cached = None
         self._chunk_size = 0
         self._content_size = 0
+        # Bytes of the body left to read, if the length is known from the Content-Length header
+        self._remaining = None
+        # Set once the whole body has been read, so the connection can be used for another request
+        self._done = False
+        self._keep_alive = True
+        self._session = None
+        # Preallocated buffers for reading chunk sizes and separators
+        self._sep = None
+        self._byte = None
         self._sf = sockfile
         self._sock = sock
         self.chunked = False
@@ -147,42 +161,112 @@ class Response:
         sf = self._sf
 
         if self.chunked:
-            if self._chunk_size == 0:
-                l = sf.readline().strip()
-
-                if not l:
-                    return b''
-
-                # ignore chunk extensions
-                l = l.split(b";", 1)[0]
-                self._chunk_size = max(0, int(l, 16))
-
-                if self._chunk_size == 0:
-                    # End of message
-                    sep = sf.read(2)
-
-                    if sep != b"\r\n":
-                        raise ValueError("Expected final chunk separator, read %r instead." % sep)
-
-                    return b""
+            if self._chunk_size == 0 and not self._next_chunk():
+                return b""
 
             data = sf.read(min(size or MAX_READ_SIZE, self._chunk_size))
             self._chunk_size = max(0, self._chunk_size - len(data))
 
             if self._chunk_size == 0:
-                sep = sf.read(2)
-                if sep != b"\r\n":
-                    raise ValueError("Expected chunk separator, read %r instead." % sep)
+                self._end_chunk()
 
+            return data
+        elif self._remaining is not None:
+            data = sf.read(min(size or self._remaining, self._remaining)) if self._remaining else b""
+            self._remaining -= len(data)
+            self._done = self._remaining == 0
             return data
         else:
             return sf.read(size if size else self._content_size)
 
     def readinto(self, buf, size=0):
-        if size:
+        size = size or len(buf)
+
+        if self.chunked:
+            if self._chunk_size == 0 and not self._next_chunk():
+                return 0
+
+            n = self._readinto(buf, min(size, self._chunk_size))
+            self._chunk_size -= n
+
+            if self._chunk_size == 0:
+                self._end_chunk()
+
+            return n
+
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+
+            if not size:
+                return 0
+
+            n = self._readinto(buf, size)
+            self._remaining -= n
+            self._done = self._remaining == 0
+            return n
+
+        return self._readinto(buf, size)
+
+    def _readinto(self, buf, size):
+        if size == len(buf):
+            return self._sf.readinto(buf)
+        elif MICROPY:
             return self._sf.readinto(buf, size)
         else:
-            return self._sf.readinto(buf)
+            return self._sf.readinto(memoryview(buf)[:size])
+
+    # Read the size line at the start of the next chunk, without allocating anything
+    # for it. Returns False at the end of the body.
+    def _next_chunk(self):
+        if self._done:
+            return False
+
+        if self._sep is None:
+            self._sep = bytearray(2)
+            self._byte = memoryview(self._sep)[:1]
+
+        c = self._byte
+        size = 0
+        ext = False
+
+        while True:
+            if not self._sf.readinto(c):
+                # Connection closed before the last chunk
+                self._keep_alive = False
+                self._done = True
+                return False
+
+            b = c[0]
+
+            if b == 0x0A:  # \n
+                break
+            elif ext or b in (0x0D, 0x20, 0x09):
+                continue
+            elif b == 0x3B:  # ;, ignore chunk extensions
+                ext = True
+            elif 0x30 <= b <= 0x39:
+                size = size * 16 + b - 0x30
+            elif 0x61 <= b <= 0x66 or 0x41 <= b <= 0x46:
+                size = size * 16 + (b | 0x20) - 0x57
+            else:
+                raise ValueError("Invalid chunk size.")
+
+        self._chunk_size = size
+
+        if size == 0:
+            # End of message
+            self._end_chunk("final chunk separator")
+            self._done = True
+            return False
+
+        return True
+
+    def _end_chunk(self, what="chunk separator"):
+        sep = self._sep
+        n = self._sf.readinto(sep)
+
+        if n != 2 or sep[0] != 0x0D or sep[1] != 0x0A:
+            raise ValueError("Expected %s, read %r instead." % (what, bytes(sep[:n])))
 
     def save(self, fn, buf=None, chunk_size=0):
         with open(fn, "wb") as fobj:
@@ -191,38 +275,28 @@ class Response:
     def saveinto(self, fobj, buf=None, chunk_size=0):
         num_read_total = 0
 
-        if buf:
-            if self.chunked:
-                raise NotImplementedError("Cannot use a buffer when saving a chunked response.")
-            if chunk_size and not MICROPY:
-                raise NotImplementedError("Cannot set chunk_size when using a buffer with CPython."
-                    " Use a buffer or memoryview of appropriate size instead.")
-
         while True:
             if buf:
+                # Reading into the same buffer each time means nothing is allocated per
+                # chunk, except a view of the buffer when only part of it is filled
                 num_read_chunk = self.readinto(buf, chunk_size)
 
                 if not num_read_chunk:
                     break
 
                 num_read_total += num_read_chunk
-                fobj.write(buf[:num_read_chunk])
+                fobj.write(buf if num_read_chunk == len(buf) else memoryview(buf)[:num_read_chunk])
             else:
                 # Read a chunk of data
-                chunk = self.read(size=None if self.chunked
-                                  else min(chunk_size or MAX_READ_SIZE, remain))
-                num_read_total += len(chunk)
+                chunk = self.read(size=chunk_size or MAX_READ_SIZE)
 
                 if not chunk:
                     break
 
+                num_read_total += len(chunk)
                 fobj.write(chunk)
 
-            if not self.chunked:
-                remain = self._content_size - num_read_total
-
-                if remain <= 0:
-                    break
+        return num_read_total
 
     def _parse_header(self, data):
         if data[:18].lower() == b"transfer-encoding:" and b"chunked" in data[18:]:
@@ -230,7 +304,10 @@ class Response:
             # print("Chunked response detected.")
         elif data[:15].lower() == b"content-length:":
             self._content_size = int(data[15:])
+            self._remaining = self._content_size
             # print("Content length: %i" % self._content_size)
+        elif data[:11].lower() == b"connection:" and b"close" in data[11:].lower():
+            self._keep_alive = False
         elif data[:17].lower() == b"content-encoding:":
             self.encoding = data[17:].decode().strip()
 
@@ -241,7 +318,31 @@ class Response:
         if self.headers is not None:
             self.headers.append(data.rstrip(b"\r\n"))
 
+    # These responses never have a body
+    def _check_body(self, method):
+        if method == "HEAD" or self.status_code in (204, 304) or 100 <= self.status_code < 200:
+            self.chunked = False
+            self._remaining = 0
+            self._done = True
+
+    # True if the whole body has been read and the server will accept another request
+    # on the same connection
+    @property
+    def reusable(self):
+        return self._keep_alive and (self._done or self._remaining == 0)
+
+    # Read and discard the rest of the body, if its length is known, so the connection
+    # can be reused
+    def drain(self):
+        if self._sf and self._keep_alive and (self.chunked or self._remaining is not None):
+            while self.read(MAX_READ_SIZE):
+                pass
+
     def close(self):
+        if self._session is not None and self._sock and self.reusable:
+            # Give the connection back to the session for its next request
+            self._session._release(self._sock, self._sf)
+            self._sock = self._sf = None
         if self._sf and not MICROPY:
             self._sf.close()
             self._sf = None
@@ -254,10 +355,20 @@ class Response:
     def content(self):
         if self._cached is None:
             try:
-                self._cached = self.read(size=None)
+                if self.chunked:
+                    chunks = []
+                    while True:
+                        chunk = self.read(size=None)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                    self._cached = b"".join(chunks)
+                else:
+                    self._cached = self.read(size=None)
             finally:
-                self._sock.close()
-                self._sock = None
+                cached = self._cached
+                self.close()
+                self._cached = cached
         return self._cached
 
     @property
@@ -272,131 +383,267 @@ class Response:
 
         return json.loads(self.content)
 
+    def iter_json_array(self, chunk_size=256):
+        """Parse a JSON array body one element at a time while it is being read.
 
-def request(
-    method,
-    url,
-    data=None,
-    json=None,
-    headers={},
-    auth=None,
-    encoding=None,
-    response_class=Response,
-    save_headers=False,
-    max_redirects=1,
-    timeout=None,
-    ssl_context=None
-):
-    if auth:
-        headers.update(auth if callable(auth) else encode_basic_auth(auth[0], auth[1]))
+        Yields each element of the top-level array as it is completed, so only the
+        element currently being read needs to be held in memory rather than the
+        whole body and everything parsed from it.
+        """
+        parser = JsonArrayParser()
 
-    if json is not None:
-        assert data is None
+        while not parser.done:
+            data = self.read(chunk_size)
+
+            if not data:
+                raise ValueError("JSON array ended unexpectedly.")
+
+            for item in parser.feed(data):
+                yield item
+
+        self.drain()
+
+
+class JsonArrayParser:
+    """Incrementally split a JSON array into its elements.
+
+    Data is fed in as it arrives and the elements completed by it are returned,
+    parsed. Only the element currently being read is buffered.
+    """
+
+    def __init__(self):
         try:
             import json
         except ImportError:
             import ujson as json
 
-        data = json.dumps(json)
-
-    ctx = RequestContext(url, method)
+        self._loads = json.loads
+        self._elem = bytearray()
+        self._opened = False
+        self._in_str = False
+        self._escape = False
+        self._depth = 0
+        self.done = False
+
+    def feed(self, data):
+        items = []
+        elem = self._elem
+        opened = self._opened
+        in_str = self._in_str
+        escape = self._escape
+        depth = self._depth
+        # Start of the part of this chunk belonging to the current element
+        mark = 0
+
+        for i in range(len(data)):
+            c = data[i]
+
+            if in_str:
+                if escape:
+                    escape = False
+                elif c == 0x5C:  # backslash
+                    escape = True
+                elif c == 0x22:  # double quote
+                    in_str = False
+            elif not opened:
+                if c == 0x5B:  # [
+                    opened = True
+                    mark = i + 1
+                elif c not in (0x20, 0x09, 0x0D, 0x0A):  # whitespace
+                    raise ValueError("Expected a JSON array.")
+            elif depth == 0 and (c == 0x2C or c == 0x5D):  # , or ]
+                elem += data[mark:i]
+                mark = i + 1
+
+                if elem.strip():
+                    items.append(self._loads(bytes(elem)))
+                elif c == 0x2C:  # a comma with nothing before it
+                    raise ValueError("Invalid JSON array.")
+
+                elem = bytearray()
+
+                if c == 0x5D:  # ], end of the array
+                    self.done = True
+                    break
+            elif c == 0x22:
+                in_str = True
+            elif c == 0x7B or c == 0x5B:  # { or [
+                depth += 1
+            elif c == 0x7D or c == 0x5D:  # } or ]
+                depth -= 1
+        else:
+            if opened:
+                elem += data[mark:]
 
-    while True:
-        if ctx.scheme not in ("http", "https"):
-            raise ValueError("Protocol scheme %s not supported." % ctx.scheme)
+        self._elem = elem
+        self._opened = opened
+        self._in_str = in_str
+        self._escape = escape
+        self._depth = depth
+        return items
 
-        ctx.redirect = False
 
-        # print("Resolving host address...")
-        ai = socket.getaddrinfo(ctx.host, ctx.port, 0, socket.SOCK_STREAM)[0]
+def _connect(ctx, timeout=None, ssl_context=None):
+    # print("Resolving host address...")
+    ai = socket.getaddrinfo(ctx.host, ctx.port, 0, socket.SOCK_STREAM)[0]
 
-        # print("Creating socket...")
-        sock = socket.socket(ai[0], ai[1], ai[2])
-        sock.settimeout(timeout)
-        try:
-            # print("Connecting to %s:%i..." % (ctx.host, ctx.port))
-            sock.connect(ai[-1])
-            if ctx.scheme == "https":
+    # print("Creating socket...")
+    sock = socket.socket(ai[0], ai[1], ai[2])
+    sock.settimeout(timeout)
+    try:
+        # print("Connecting to %s:%i..." % (ctx.host, ctx.port))
+        sock.connect(ai[-1])
+        if ctx.scheme == "https":
+            try:
+                import tls as ssl
+            except ImportError:
                 try:
-                    import tls as ssl
+                    import ssl
                 except ImportError:
-                    try:
-                        import ssl
-                    except ImportError:
-                        import ussl as ssl
+                    import ussl as ssl
 
 
-                # print("Wrapping socket with TLS")
-                if ssl_context is None:
-                    if hasattr(ssl, "create_default_context"):
-                        ssl_context = ssl.create_default_context()
-                    else:
-                        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                        if hasattr(ssl, "CERT_OPTIONAL"):
-                            ssl_context.verify_mode = ssl.CERT_OPTIONAL
+            # print("Wrapping socket with TLS")
+            if ssl_context is None:
+                if hasattr(ssl, "create_default_context"):
+                    ssl_context = ssl.create_default_context()
+                else:
+                    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                    if hasattr(ssl, "CERT_OPTIONAL"):
+                        ssl_context.verify_mode = ssl.CERT_OPTIONAL
 
-                sock = ssl_context.wrap_socket(sock, server_hostname=ctx.host)
+            sock = ssl_context.wrap_socket(sock, server_hostname=ctx.host)
+    except OSError:
+        sock.close()
+        raise
 
-            sf = sock if MICROPY else sock.makefile("rwb")
-            sf.write(b"%s %s HTTP/1.1\r\n" % (ctx.method.encode("ascii"), ctx.path.encode("ascii")))
-            sf.write(b"Host: %s\r\n" % headers.get(b"Host", ctx.host.encode()))
+    return sock, sock if MICROPY else sock.makefile("rwb")
 
-            for k, val in headers.items():
-                if not isinstance(k, bytes):
-                    k = k.encode("ascii")
 
-                if k.lower() == b"host":
-                    continue
+def _request_head(ctx, headers, data, json, encoding, keep_alive=False):
+    # Assemble the head of the request so it can be sent with a single write, rather
+    # than one per header, which on MicroPython means one TCP segment (and with TLS,
+    # one record) each
+    buf = bytearray(b"%s %s HTTP/1.1\r\n" % (ctx.method.encode("ascii"), ctx.path.encode("ascii")))
+    buf += b"Host: %s\r\n" % headers.get(b"Host", ctx.host.encode())
 
-                sf.write(k)
-                sf.write(b": ")
-                sf.write(val if isinstance(val, bytes) else val.encode("ascii"))
-                sf.write(b"\r\n")
+    for k, val in headers.items():
+        if not isinstance(k, bytes):
+            k = k.encode("ascii")
 
-            if data and ctx.method not in ("GET", "HEAD"):
-                if json is not None:
-                    sf.write(b"Content-Type: application/json")
-                    if encoding:
-                        sf.write(b"; charset=%s" % encoding.encode())
-                    sf.write(b"\r\n")
+        if k.lower() == b"host":
+            continue
 
-                sf.write(b"Content-Length: %d\r\n" % len(data))
+        buf += k
+        buf += b": "
+        buf += val if isinstance(val, bytes) else val.encode("ascii")
+        buf += b"\r\n"
 
-            sf.write(b"Connection: close\r\n\r\n")
+    if data and ctx.method not in ("GET", "HEAD"):
+        if json is not None:
+            buf += b"Content-Type: application/json"
+            if encoding:
+                buf += b"; charset=%s" % encoding.encode()
+            buf += b"\r\n"
 
-            if data and ctx.method not in ("GET", "HEAD"):
-                sf.write(data if isinstance(data, bytes) else data.encode(encoding or "utf-8"))
+        buf += b"Content-Length: %d\r\n" % len(data)
 
-            if not MICROPY:
-                sf.flush()
+    buf += b"Connection: keep-alive\r\n\r\n" if keep_alive else b"Connection: close\r\n\r\n"
+    return buf
 
-            resp = response_class(sock, sf, save_headers=save_headers)
-            l = b""
-            i = 0
-            while True:
-                l += sf.read(1)
-                i += 1
 
-                if l.endswith(b"\r\n") or i > MAX_READ_SIZE:
-                    break
+def _send_request(sf, ctx, headers, data, json, encoding, keep_alive=False):
+    sf.write(_request_head(ctx, headers, data, json, encoding, keep_alive))
 
-            # print("Response: %s" % l.decode("ascii"))
-            l = l.split(None, 2)
-            resp.status_code = int(l[1])
+    if data and ctx.method not in ("GET", "HEAD"):
+        sf.write(data if isinstance(data, bytes) else data.encode(encoding or "utf-8"))
 
-            if len(l) > 2:
-                resp.reason = l[2].rstrip()
+    if not MICROPY:
+        sf.flush()
 
-            while True:
-                l = sf.readline()
-                if not l or l == b"\r\n":
-                    break
 
-                if l.startswith(b"Location:"):
-                    ctx.set_location(resp.status_code, l[9:].strip().decode("ascii"))
+def _read_response(sock, sf, ctx, response_class, save_headers):
+    resp = response_class(sock, sf, save_headers=save_headers)
+    l = b""
+    i = 0
+    while True:
+        c = sf.read(1)
+
+        if not c:
+            # The server closed the connection without responding
+            raise OSError(ECONNRESET)
+
+        l += c
+        i += 1
+
+        if l.endswith(b"\r\n") or i > MAX_READ_SIZE:
+            break
+
+    # print("Response: %s" % l.decode("ascii"))
+    l = l.split(None, 2)
+    resp.status_code = int(l[1])
+
+    if len(l) > 2:
+        resp.reason = l[2].rstrip()
+
+    while True:
+        l = sf.readline()
+        if not l or l == b"\r\n":
+            break
+
+        if l.startswith(b"Location:"):
+            ctx.set_location(resp.status_code, l[9:].strip().decode("ascii"))
 
-                # print("Header: %r" % l)
-                resp.add_header(l)
+        # print("Header: %r" % l)
+        resp.add_header(l)
+
+    resp._check_body(ctx.method)
+    return resp
+
+
+def _prepare(data, json, headers, auth):
+    if auth:
+        headers.update(auth if callable(auth) else encode_basic_auth(auth[0], auth[1]))
+
+    if json is not None:
+        assert data is None
+        try:
+            import json as json_mod
+        except ImportError:
+            import ujson as json_mod
+
+        data = json_mod.dumps(json)
+
+    return data
+
+
+def request(
+    method,
+    url,
+    data=None,
+    json=None,
+    headers={},
+    auth=None,
+    encoding=None,
+    response_class=Response,
+    save_headers=False,
+    max_redirects=1,
+    timeout=None,
+    ssl_context=None
+):
+    data = _prepare(data, json, headers, auth)
+    ctx = RequestContext(url, method)
+
+    while True:
+        if ctx.scheme not in ("http", "https"):
+            raise ValueError("Protocol scheme %s not supported." % ctx.scheme)
+
+        ctx.redirect = False
+
+        sock, sf = _connect(ctx, timeout, ssl_context)
+        try:
+            _send_request(sf, ctx, headers, data, json, encoding)
+            resp = _read_response(sock, sf, ctx, response_class, save_headers)
         except OSError:
             sock.close()
             raise
@@ -413,3 +660,167 @@ def request(
             break
 
     return resp
+
+
+class Session:
+    """Make requests over a persistent connection.
+
+    The connection to the last host is kept open and reused for the next request to
+    the same host and port, saving a TCP connection and TLS handshake per request.
+    The body of each response must be read completely (or the response closed) before
+    the next request is made; responses whose body can't be delimited, because the
+    server sent neither Content-Length nor chunked encoding, close the connection.
+    If the server has closed an idle connection, it is re-opened transparently.
+    """
+
+    def __init__(
+        self,
+        headers=None,
+        auth=None,
+        response_class=Response,
+        save_headers=False,
+        timeout=None,
+        ssl_context=None
+    ):
+        self.headers = headers or {}
+        self.auth = auth
+        self.response_class = response_class
+        self.save_headers = save_headers
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._key = None
+        self._sock = None
+        self._sf = None
+        self._busy = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def head(self, url, **kw):
+        return self.request("HEAD", url, **kw)
+
+    def get(self, url, **kw):
+        return self.request("GET", url, **kw)
+
+    def post(self, url, **kw):
+        return self.request("POST", url, **kw)
+
+    def put(self, url, **kw):
+        return self.request("PUT", url, **kw)
+
+    def patch(self, url, **kw):
+        return self.request("PATCH", url, **kw)
+
+    def delete(self, url, **kw):
+        return self.request("DELETE", url, **kw)
+
+    def request(
+        self,
+        method,
+        url,
+        data=None,
+        json=None,
+        headers=None,
+        auth=None,
+        encoding=None,
+        max_redirects=1
+    ):
+        hdrs = self.headers.copy()
+        if headers:
+            hdrs.update(headers)
+
+        data = _prepare(data, json, hdrs, auth or self.auth)
+        ctx = RequestContext(url, method)
+
+        while True:
+            if ctx.scheme not in ("http", "https"):
+                raise ValueError("Protocol scheme %s not supported." % ctx.scheme)
+
+            ctx.redirect = False
+            resp = self._request(ctx, hdrs, data, json, encoding)
+
+            if ctx.redirect:
+                # print("Redirect to: %s" % ctx.url)
+                resp.drain()
+                resp.close()
+                max_redirects -= 1
+
+                if max_redirects < 0:
+                    raise ValueError("Maximum redirection count exceeded.")
+
+            else:
+                break
+
+        return resp
+
+    def _request(self, ctx, headers, data, json, encoding):
+        # A previous response that wasn't read to the end leaves the connection in an
+        # unknown state, so it can't be used again
+        if self._busy is not None:
+            self._busy.close()
+            self._busy = None
+
+        key = (ctx.scheme, ctx.host, ctx.port)
+
+        if key != self._key:
+            self.close()
+
+        reused = self._sock is not None
+
+        while True:
+            if self._sock is None:
+                self._sock, self._sf = _connect(ctx, self.timeout, self.ssl_context)
+                self._key = key
+
+            sock, sf = self._sock, self._sf
+            self._sock = self._sf = None
+
+            try:
+                _send_request(sf, ctx, headers, data, json, encoding, keep_alive=True)
+                resp = _read_response(sock, sf, ctx, self.response_class, self.save_headers)
+            except OSError:
+                _close(sock, sf)
+
+                # The server may have closed the connection while it was idle, so try
+                # once more on a new one
+                if reused:
+                    reused = False
+                    continue
+
+                raise
+
+            resp._session = self
+            self._busy = resp
+            return resp
+
+    # Called by Response.close() to hand back a connection that can be reused
+    def _release(self, sock, sf):
+        if self._busy is not None and self._busy._sock is sock:
+            self._busy = None
+
+        if self._sock is not None:
+            _close(self._sock, self._sf)
+
+        self._sock, self._sf = sock, sf
+
+    def close(self):
+        if self._busy is not None:
+            busy, self._busy = self._busy, None
+            busy._session = None
+            busy.close()
+
+        if self._sock is not None:
+            _close(self._sock, self._sf)
+            self._sock = self._sf = None
+
+        self._key = None
+
+
+def _close(sock, sf):
+    if sf is not sock and not MICROPY:
+        sf.close()
+
+    sock.close()
@@ -7,7 +7,16 @@
 import hashlib
 import io
 
-from micropython import const
+try:
+    import uasyncio as asyncio
+except ImportError:  # Running on the host, eg. tools/bench_ota_verify.py
+    import asyncio
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
 
 IOCTL_BLOCK_COUNT: int = const(4)  # type: ignore
 IOCTL_BLOCK_SIZE: int = const(5)  # type: ignore
@@ -26,6 +35,12 @@ class Blockdev(io.IOBase):
         self.blockcount = int(device.ioctl(IOCTL_BLOCK_COUNT, None))
         self.pos = 0  # Current position (bytes from beginning) of device
         self.end = 0  # Current end of the data written to the device
+        self.read_sha = None  # If set, data is read back into this hash as it's written
+        self._readbuf = None
+
+    # io.BufferedWriter on CPython checks this before writing
+    def writable(self) -> bool:
+        return True
 
     # Data must be a multiple of blocksize unless it is the last write to the
     # device. The next write after a partial block will raise ValueError.
@@ -33,6 +48,7 @@ class Blockdev(io.IOBase):
         block, remainder = divmod(self.pos, self.blocksize)
         if remainder:
             raise ValueError(f"Block {block} write not aligned at block boundary.")
+        start = block
         data_len = len(data)
         nblocks, remainder = divmod(data_len, self.blocksize)
         mv = memoryview(data)
@@ -42,10 +58,25 @@ class Blockdev(io.IOBase):
         if remainder:  # Write left over data as a partial block
             self.device.ioctl(IOCTL_BLOCK_ERASE, block)  # Erase block first
             self.device.writeblocks(block, mv[-remainder:], 0)
+        if self.read_sha is not None:
+            self._read_back(start, data_len)
         self.pos += data_len
         self.end = self.pos  # The "end" of the data written to the device
         return data_len
 
+    # Read back the data just written, starting at block, and add it to read_sha
+    # while it's still in the flash cache. This replaces reading back the whole
+    # device in a separate pass after the last block has been written.
+    def _read_back(self, block: int, size: int) -> None:
+        if self._readbuf is None:
+            self._readbuf = memoryview(bytearray(self.blocksize))
+        while size > 0:
+            n = min(size, self.blocksize)
+            self.device.readblocks(block, self._readbuf[:n], 0)
+            self.read_sha.update(self._readbuf[:n])
+            block += 1
+            size -= n
+
     # Read data from the block device.
     def readinto(self, data: bytearray | memoryview):
         size = min(len(data), self.end - self.pos)
@@ -69,6 +100,17 @@ def sha_file(f, buffersize=4096) -> str:
     return read_sha.digest().hex()
 
 
+# Asynchronous version of sha_file() which yields to other tasks after each
+# buffer is hashed
+async def asha_file(f, buffersize=4096) -> str:
+    mv = memoryview(bytearray(buffersize))
+    read_sha = hashlib.sha256()
+    while (n := f.readinto(mv)) > 0:
+        read_sha.update(mv[:n])
+        await asyncio.sleep(0)
+    return read_sha.digest().hex()
+
+
 # BlockdevWriter provides a convenient interface to writing images to any block
 # device which implements the micropython os.AbstractBlockDev interface (eg.
 # Partition on flash storage on ESP32).
@@ -78,7 +120,10 @@ class BlockDevWriter:
     def __init__(
         self,
         device,  # Block device to recieve the data (eg. esp32.Partition)
-        verify: bool = True,  # Should we read back and verify data after writing
+        # Should we read back and verify data after writing: True to read back the
+        # whole device when closing, or "block" to read back each block as soon as
+        # it's written, which avoids the separate pass at the end
+        verify: bool | str = True,
         verbose: bool = True,
     ):
         self.device = Blockdev(device)
@@ -90,6 +135,9 @@ class BlockDevWriter:
         self.verbose = verbose
         self.sha: str = ""
         self.length: int = 0
+        self.written: int = 0  # Total bytes passed to write(), including any still buffered
+        if verify == "block":
+            self.device.read_sha = hashlib.sha256()
         blocksize, blockcount = self.device.blocksize, self.device.blockcount
         if self.verbose:
             print(f"Device capacity: {blockcount} x {blocksize} byte blocks.")
@@ -115,9 +163,35 @@ class BlockDevWriter:
     def write(self, data: bytearray | bytes | memoryview) -> int:
         self._sha.update(data)
         n = self.writer.write(data)
+        self.written += n
         self.print_progress()
         return n
 
+    # Discard anything buffered and carry on writing from offset (which must be
+    # on a block boundary), keeping the data already on the device before that.
+    # The SHA state can't be saved, so it's rebuilt by reading back and hashing
+    # the data already written, yielding to other tasks after each block.
+    async def aresume(self, offset: int) -> None:
+        if offset % self.device.blocksize:
+            raise ValueError(f"Resume offset {offset} not aligned at block boundary.")
+        if offset > self.device.blocksize * self.device.blockcount:
+            raise ValueError(f"Resume offset {offset} is > size of partition.")
+        self.writer = io.BufferedWriter(self.device, self.device.blocksize)  # type: ignore
+        self._sha = hashlib.sha256()
+        if self.device.read_sha is not None:
+            self.device.read_sha = hashlib.sha256()
+        self.device.end = offset
+        self.device.seek(0)
+        mv = memoryview(bytearray(self.device.blocksize))
+        while (n := self.device.readinto(mv)) > 0:
+            self._sha.update(mv[:n])
+            if self.device.read_sha is not None:
+                self.device.read_sha.update(mv[:n])
+            await asyncio.sleep(0)
+        self.written = offset
+        if self.verbose:
+            print(f"Resuming at block {offset // self.device.blocksize}.")
+
     # Append data from f (a stream object) to the block device
     def write_from_stream(self, f: io.BufferedReader) -> int:
         mv = memoryview(bytearray(self.device.blocksize))
@@ -126,11 +200,45 @@ class BlockDevWriter:
             tot += self.write(mv[:n])
         return tot
 
+    # Asynchronous version of write_from_stream() where f.readinto() is a
+    # coroutine (eg. an asyncio stream). Yields to other tasks after each block
+    # is written, and awaits progress(nbytes_written, length) if given.
+    async def awrite_from_stream(self, f, progress=None) -> int:
+        mv = memoryview(bytearray(self.device.blocksize))
+        tot = 0
+        while (n := await f.readinto(mv)) != 0:
+            tot += self.write(mv[:n])
+            if progress is not None:
+                await progress(self.written, self.length)
+            await asyncio.sleep(0)
+        return tot
+
     # Flush remaining data to the block device and confirm all checksums
     # Raises:
     #   ValueError("SHA mismatch...") if SHA of received data != expected sha
     #   ValueError("SHA verify fail...") if verified SHA != written sha
     def close(self) -> None:
+        write_sha = self._flush()
+        if self.verify == "block":
+            self._verify_blocks(write_sha)
+        elif self.verify:
+            self._verify_start()
+            self._verify_end(write_sha, sha_file(self.device, self.device.blocksize))
+        self._finish()
+
+    # Asynchronous version of close() which yields to other tasks while reading
+    # back the written data to verify it
+    async def aclose(self) -> None:
+        write_sha = self._flush()
+        if self.verify == "block":
+            self._verify_blocks(write_sha)
+        elif self.verify:
+            self._verify_start()
+            self._verify_end(write_sha, await asha_file(self.device, self.device.blocksize))
+        self._finish()
+
+    # Flush remaining data and check the length and SHA of the received data
+    def _flush(self) -> str:
         self.writer.flush()
         self.print_progress()
         # Check the checksums (SHA256)
@@ -142,15 +250,26 @@ class BlockDevWriter:
             self.sha = write_sha
         if self.sha != write_sha:
             raise ValueError(f"SHA mismatch recv={write_sha} expect={self.sha}.")
-        if self.verify:
-            if self.verbose:
-                print("Verifying SHA of the written data...", end="")
-            self.device.seek(0)  # Reset to start of partition
-            read_sha = sha_file(self.device, self.device.blocksize)
-            if read_sha != write_sha:
-                raise ValueError(f"SHA verify failed write={write_sha} read={read_sha}")
-            if self.verbose:
-                print("Passed.")
+        return write_sha
+
+    def _verify_start(self) -> None:
+        if self.verbose:
+            print("Verifying SHA of the written data...", end="")
+        self.device.seek(0)  # Reset to start of partition
+
+    # Check the SHA of the data read back after each block was written
+    def _verify_blocks(self, write_sha: str) -> None:
+        if self.verbose:
+            print("Verifying SHA of the data read back from each block...", end="")
+        self._verify_end(write_sha, self.device.read_sha.digest().hex())
+
+    def _verify_end(self, write_sha: str, read_sha: str) -> None:
+        if read_sha != write_sha:
+            raise ValueError(f"SHA verify failed write={write_sha} read={read_sha}")
+        if self.verbose:
+            print("Passed.")
+
+    def _finish(self) -> None:
         if self.verbose or not self.sha:
             print(f"SHA256={self.sha}")
         self.device.seek(0)  # Reset to start of partition
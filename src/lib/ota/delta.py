@@ -0,0 +1,125 @@
+# Delta firmware updates for MicroPython on ESP32
+#
+# A patch describes the new firmware image as a series of operations which either
+# copy a run of bytes from the firmware that's currently running or insert bytes
+# carried in the patch itself, so only what has changed needs to be downloaded.
+# Patches are made on the host with tools/make_delta.py.
+#
+# Patch format (integers are little-endian):
+#   header: b"MPDL", version (1 byte), SHA256 of the source image (32 bytes),
+#           source image length (4 bytes), target image length (4 bytes)
+#   followed by ops, each starting with a 1 byte op code:
+#     OP_COPY:   offset (4 bytes), length (4 bytes) - copy from the source image
+#     OP_INSERT: length (4 bytes), then that many bytes to insert
+#     OP_END:    end of the patch
+
+import hashlib
+import struct
+
+try:
+    import uasyncio as asyncio
+except ImportError:  # Running on the host, eg. tools/make_delta.py
+    import asyncio
+
+MAGIC = b"MPDL"
+VERSION = 1
+HEADER_FMT = "<4sB32sLL"
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+OP_END = 0
+OP_COPY = 1
+OP_INSERT = 2
+COPY_FMT = "<LL"
+INSERT_FMT = "<L"
+
+IOCTL_BLOCK_SIZE = 5
+
+
+# Read exactly len(buf) bytes from f, an asyncio stream
+async def _readinto(f, buf: memoryview) -> None:
+    size = 0
+    while size < len(buf):
+        n = await f.readinto(buf[size:])
+        if not n:
+            raise ValueError("Patch ended unexpectedly.")
+        size += n
+
+
+# Return the SHA256 of the first length bytes of a partition, yielding to other
+# tasks after each block is read
+async def sha_partition(part, length: int, buf: memoryview) -> bytes:
+    blocksize = len(buf)
+    sha = hashlib.sha256()
+    pos = 0
+    while pos < length:
+        n = min(length - pos, blocksize)
+        part.readblocks(pos // blocksize, buf[:n], 0)
+        sha.update(buf[:n])
+        pos += n
+        await asyncio.sleep(0)
+    return sha.digest()
+
+
+# Apply the patch being read from f (an asyncio stream, eg. update.AsyncResponse)
+# to the source partition (the running firmware) and write the result with
+# writer, a BlockDevWriter for the partition being updated. The source image is
+# checked against the SHA256 in the patch before anything is written. Awaits
+# progress(bytes_written, length) after each block if given.
+# Raises ValueError if the patch doesn't apply to the running firmware.
+async def apply(f, source, writer, progress=None) -> int:
+    header = memoryview(bytearray(HEADER_SIZE))
+    await _readinto(f, header)
+    magic, version, source_sha, source_len, target_len = struct.unpack(HEADER_FMT, header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a firmware patch.")
+    if writer.length and target_len != writer.length:
+        raise ValueError(f"Patch makes {target_len} bytes (expect {writer.length}).")
+
+    blocksize = int(source.ioctl(IOCTL_BLOCK_SIZE, None))
+    buf = memoryview(bytearray(blocksize))
+    if await sha_partition(source, source_len, buf) != source_sha:
+        raise ValueError("Patch is not for the firmware that's running.")
+
+    # The output is assembled a block at a time in buf so it's always written in
+    # whole blocks, as it would be when downloading the full image
+    op = memoryview(bytearray(1 + struct.calcsize(COPY_FMT)))
+    tot = fill = 0
+    while True:
+        await _readinto(f, op[:1])
+        if op[0] == OP_END:
+            break
+        if op[0] == OP_COPY:
+            await _readinto(f, op[1:])
+            offset, length = struct.unpack_from(COPY_FMT, op, 1)
+            if offset + length > source_len:
+                raise ValueError("Patch copies from past the end of the source image.")
+        elif op[0] == OP_INSERT:
+            await _readinto(f, op[1 : 1 + struct.calcsize(INSERT_FMT)])
+            (length,) = struct.unpack_from(INSERT_FMT, op, 1)
+            offset = -1
+        else:
+            raise ValueError(f"Unknown patch op {op[0]}.")
+        if tot + fill + length > target_len:
+            raise ValueError("Patch makes more than the target length.")
+        while length:
+            n = min(length, blocksize - fill)
+            if offset < 0:
+                await _readinto(f, buf[fill : fill + n])
+            else:
+                # Partition reads don't need to be block aligned with an offset
+                source.readblocks(offset // blocksize, buf[fill : fill + n], offset % blocksize)
+                offset += n
+            fill += n
+            length -= n
+            if fill == blocksize:
+                tot += writer.write(buf)
+                fill = 0
+                if progress is not None:
+                    await progress(tot, target_len)
+                await asyncio.sleep(0)
+    if fill:
+        tot += writer.write(buf[:fill])
+        if progress is not None:
+            await progress(tot, target_len)
+    if tot != target_len:
+        raise ValueError(f"Patch made {tot} bytes (expect {target_len}).")
+    return tot
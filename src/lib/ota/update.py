@@ -6,11 +6,27 @@
 
 import gc
 import io
+import json
+import os
 
-from esp32 import Partition
+try:
+    import uasyncio as asyncio
+except ImportError:  # Running on the host, eg. tools/check_ota_download.py
+    import asyncio
+
+try:
+    from esp32 import Partition
+
+    from .status import ota_reboot
+except ImportError:  # Running on the host, which sets Partition to a stand-in
+    Partition = None
 
 from .blockdev_writer import BlockDevWriter
-from .status import ota_reboot
+
+# Progress of an interrupted asynchronous download is saved here so a later
+# attempt at the same update can pick up where it left off
+CHECKPOINT_FILE = "ota.checkpoint"
+CHECKPOINT_INTERVAL = 16  # Save progress after every this many blocks
 
 
 # Micropython sockets don't have context manager methods. This wrapper provides
@@ -45,12 +61,134 @@ def open_url(url: str, username=None, password=None) -> io.BufferedReader:
         return SocketWrapper(r.raw)  # type: ignore
 
 
+# The body of a HTTP response being read from a non-blocking socket, for use
+# from asyncio code. readinto() returns 0 once the whole body has been read.
+class AsyncResponse:
+    def __init__(self, stream, length: int, partial: bool = False, timeout: int = 30000):
+        self.stream = stream
+        self.timeout = timeout  # Milliseconds to wait for more data before giving up
+        self.length = length  # Content-Length, or 0 if the server didn't send one
+        self.partial = partial  # True if the server sent the requested Range
+        self.remaining = length if length else -1
+
+    async def readinto(self, buf: bytearray | memoryview) -> int:
+        if self.remaining == 0:
+            return 0
+        mv = memoryview(buf)
+        if self.remaining > 0 and len(mv) > self.remaining:
+            mv = mv[: self.remaining]
+        # Keep reading until the block is full so writes stay block aligned
+        size = 0
+        while size < len(mv):
+            try:
+                n = await asyncio.wait_for(self.stream.readinto(mv[size:]), self.timeout / 1000)
+            except asyncio.TimeoutError:
+                raise OSError("Timed out waiting for data")
+            if n is None:  # An SSL socket can be readable without any data ready
+                continue
+            if n == 0:  # Connection closed by the server
+                if self.remaining > size:
+                    raise OSError(f"Connection closed with {self.remaining - size} bytes left to read")
+                break
+            size += n
+        if self.remaining > 0:
+            self.remaining -= size
+        return size
+
+    async def aclose(self) -> None:
+        await self.stream.wait_closed()
+
+
+# Gives CPython's separate StreamReader and StreamWriter the interface of the
+# single Stream that MicroPython's asyncio.open_connection() returns
+class HostStream:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def write(self, data: bytes) -> None:
+        self.writer.write(data)
+
+    async def drain(self) -> None:
+        await self.writer.drain()
+
+    async def readline(self) -> bytes:
+        return await self.reader.readline()
+
+    async def readinto(self, buf: bytearray | memoryview) -> int:
+        data = await self.reader.read(len(buf))
+        buf[: len(data)] = data
+        return len(data)
+
+    async def wait_closed(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+# Open a http[s] url with a non-blocking socket and return an AsyncResponse for
+# reading the body. Redirects are followed. The request is made with HTTP/1.0 so
+# the server doesn't send a chunked response. If offset is given the body is
+# requested from there onwards with a Range header, but the server may still
+# send all of it (check AsyncResponse.partial).
+async def aopen_url(url: str, username=None, password=None, redirects: int = 5, offset: int = 0) -> AsyncResponse:
+    proto, _, host, path = url.split("/", 3)
+    if proto not in ("http:", "https:"):
+        raise ValueError(f"Unsupported url: {url}")
+    ssl = proto == "https:"
+    port = 443 if ssl else 80
+    if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+    reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
+    stream = reader if reader is writer else HostStream(reader, writer)
+    try:
+        request = f"GET /{path} HTTP/1.0\r\nHost: {host}\r\n"
+        if username and password:
+            import binascii
+
+            auth = binascii.b2a_base64(f"{username}:{password}".encode())[:-1].decode()
+            request += f"Authorization: Basic {auth}\r\n"
+        if offset:
+            request += f"Range: bytes={offset}-\r\n"
+        stream.write(f"{request}\r\n".encode())
+        await stream.drain()
+
+        code = int((await stream.readline()).split(None, 2)[1])
+        length = 0
+        location = None
+        while (line := await stream.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode().partition(":")
+            name = name.lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "location":
+                location = value.strip()
+    except BaseException:
+        await stream.wait_closed()
+        raise
+
+    if code in (301, 302, 303, 307, 308) and location and redirects > 0:
+        await stream.wait_closed()
+        if location.startswith("/"):
+            location = f"{proto}//{host}{location}" if port in (80, 443) else f"{proto}//{host}:{port}{location}"
+        return await aopen_url(location, username, password, redirects - 1, offset)
+    if code not in (200, 206):
+        await stream.wait_closed()
+        raise ValueError(f"HTTP Error: {code}")
+    return AsyncResponse(stream, length, code == 206)
+
+
 # OTA manages a MicroPython firmware update over-the-air. It checks that there
 # are at least two "ota" "app" partitions in the partition table and writes new
 # firmware into the partition that is not currently running. When the update is
 # complete, it sets the new partition as the next one to boot. Set reboot=True
 # to force a reset/restart, or call machine.reset() explicitly. Remember to call
 # ota.rollback.cancel() after a successful reboot to the new image.
+# Set verify="block" to check each block as it's written rather than reading back
+# the whole partition at the end (see BlockDevWriter).
 class OTA:
     def __init__(self, verify=True, verbose=True, reboot=False, sha="", length=0):
         self.reboot = reboot
@@ -77,6 +215,21 @@ class OTA:
         if self.writer is None:
             return
         self.writer.close()
+        self._set_boot()
+
+    # Asynchronous version of close() which yields to other tasks while the
+    # written firmware is being verified. Any saved download progress is removed,
+    # whether or not the firmware passed verification.
+    async def aclose(self) -> None:
+        if self.writer is None:
+            return
+        try:
+            await self.writer.aclose()
+        finally:
+            self._clear_checkpoint()
+        self._set_boot()
+
+    def _set_boot(self) -> None:
         # Set as boot partition for next reboot
         name: str = self.part.info()[4]
         print(f"OTA Partition '{name}' updated successfully.")
@@ -106,6 +259,15 @@ class OTA:
         gc.collect()
         return self.writer.write_from_stream(f)
 
+    # Asynchronous version of from_stream() where f.readinto() is a coroutine
+    # - progress: (optional) coroutine awaited with (bytes_written, length)
+    #   after each block is written
+    async def afrom_stream(self, f, sha: str = "", length: int = 0, progress=None) -> int:
+        if sha or length:
+            self.writer.set_sha_length(sha, length)
+        gc.collect()
+        return await self.writer.awrite_from_stream(f, progress)
+
     # Write new firmware to the OTA partition from the given url
     # - url: a filename or a http[s] url for the micropython.bin firmware.
     # - sha: the sha256sum of the firmware file
@@ -116,6 +278,105 @@ class OTA:
         with open_url(url, username, password) as f:
             return self.from_stream(f, sha, length)
 
+    # Asynchronous version of from_firmware_file() for http[s] urls, which
+    # downloads and writes the firmware without blocking other tasks. If the
+    # connection drops, the download is retried from the last block written using
+    # a HTTP Range request, up to `retries` times in a row without progress. When
+    # sha and length are given, progress is also saved to CHECKPOINT_FILE so a
+    # later attempt at the same update from the same url resumes rather than
+    # starting again.
+    async def afrom_firmware_file(self, url: str, sha: str = "", length: int = 0, username=None, password=None, progress=None, retries: int = 3) -> int:
+        dev = self.writer.device
+        if sha and length:
+            offset = self._load_checkpoint(url, sha, length)
+            if offset:
+                await self.writer.aresume(offset)
+        self._checkpoint = dev.pos
+
+        async def _progress(written: int, length: int) -> None:
+            if sha and length and dev.pos - self._checkpoint >= CHECKPOINT_INTERVAL * dev.blocksize:
+                self._save_checkpoint(url, sha, length)
+            if progress is not None:
+                await progress(written, length)
+
+        attempts = 0
+        while True:
+            offset = dev.pos
+            try:
+                return await self._adownload(url, sha, length, username, password, _progress)
+            except OSError as e:
+                attempts = 0 if dev.pos > offset else attempts + 1
+                if attempts > retries:
+                    raise
+                if self.verbose:
+                    print(f"Download interrupted ({e}), retrying...")
+                if sha and length:
+                    self._save_checkpoint(url, sha, length)
+                await self.writer.aresume(dev.pos)
+                await asyncio.sleep(2 ** attempts)
+
+    # Download the firmware from the last block written to the partition onwards
+    async def _adownload(self, url: str, sha: str, length: int, username, password, progress) -> int:
+        offset = self.writer.device.pos
+        if self.verbose:
+            print(f"Opening firmware file {url} at offset {offset}...")
+        f = await aopen_url(url, username, password, offset=offset)
+        try:
+            if offset and not f.partial:  # Server ignored the Range, so start again
+                await self.writer.aresume(0)
+            return await self.afrom_stream(f, sha, length or (0 if f.partial else f.length), progress)
+        finally:
+            await f.aclose()
+
+    # Write new firmware to the OTA partition by applying the patch at the given
+    # http[s] url (made with tools/make_delta.py) to the running firmware. The
+    # patch can't be resumed part way through, so it's downloaded in one go.
+    # - sha: the sha256sum of the new firmware file
+    # - length: the length (in bytes) of the new firmware file
+    # Raises ValueError if the patch isn't for the firmware that's running.
+    async def afrom_delta_file(self, url: str, sha: str = "", length: int = 0, username=None, password=None, progress=None) -> int:
+        from .delta import apply
+        from .status import current_ota
+
+        if self.verbose:
+            print(f"Opening firmware patch {url}...")
+        if sha or length:
+            self.writer.set_sha_length(sha, length)
+        f = await aopen_url(url, username, password)
+        try:
+            gc.collect()
+            return await apply(f, current_ota, self.writer, progress)
+        finally:
+            await f.aclose()
+
+    # Return the offset to resume from if CHECKPOINT_FILE was saved while
+    # writing the same firmware from the same url to the same partition,
+    # otherwise 0
+    def _load_checkpoint(self, url: str, sha: str, length: int) -> int:
+        try:
+            with open(CHECKPOINT_FILE) as f:
+                checkpoint: dict = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        saved = (checkpoint.get("url"), checkpoint.get("sha"), checkpoint.get("length"), checkpoint.get("partition"))
+        if saved != (url, sha, length, self.part.info()[4]):
+            self._clear_checkpoint()
+            return 0
+        return checkpoint.get("offset", 0)
+
+    # Save the offset of the last block on the partition, which is always a
+    # block boundary since anything after that is still buffered
+    def _save_checkpoint(self, url: str, sha: str, length: int) -> None:
+        self._checkpoint = self.writer.device.pos
+        with open(CHECKPOINT_FILE, "w") as f:
+            json.dump({"url": url, "sha": sha, "length": length, "partition": self.part.info()[4], "offset": self._checkpoint}, f)
+
+    def _clear_checkpoint(self) -> None:
+        try:
+            os.remove(CHECKPOINT_FILE)
+        except OSError:
+            pass
+
     # Load a firmware file, the location of which is read from a json file
     # containing the url for the firmware file, the sha and length of the file.
     # - url: the name of a file or url containing the json.
@@ -150,6 +411,26 @@ def from_file(
         ota_update.from_firmware_file(url, sha, length, username, password)
 
 
+# Asynchronous version of from_file() for use from asyncio code. Other tasks
+# keep running while the firmware is downloaded, written and verified.
+async def afrom_file(
+    url: str, sha="", length=0, verify=True, verbose=True, reboot=True, username=None, password=None, progress=None
+) -> None:
+    ota_update = OTA(verify, verbose, reboot)
+    await ota_update.afrom_firmware_file(url, sha, length, username, password, progress)
+    await ota_update.aclose()
+
+
+# Asynchronous update from a patch against the running firmware rather than the
+# whole image (see OTA.afrom_delta_file())
+async def afrom_delta_file(
+    url: str, sha="", length=0, verify=True, verbose=True, reboot=True, username=None, password=None, progress=None
+) -> None:
+    ota_update = OTA(verify, verbose, reboot)
+    await ota_update.afrom_delta_file(url, sha, length, username, password, progress)
+    await ota_update.aclose()
+
+
 def from_json(url: str, verify=True, verbose=True, reboot=True, username=None, password=None):
     with OTA(verify, verbose, reboot) as ota_update:
         ota_update.from_json(url, username, password)
@@ -1,27 +1,17 @@
+import boot_profile
 import asyncio
 import json
-import ntptime
+import sntp
 from machine import Pin, reset
 from neopixel import NeoPixel
 from mqtt import MQTTClient, config as mqtt_config
-from lib.ota import rollback, status
 from config import config
 import sensor
 import output_device
-import admin
 import logger
+import code_rollback
 
-async def sync_ntp(client):
-    while True:
-        try:
-            ntptime.settime()
-
-            await logger.publish_log_message({'message': f'Successfully synced with NTP server {ntptime.host}'}, client=client)
-        except OSError as e:
-            await logger.publish_error_message(error={'error': f'Failed to contact NTP server at {ntptime.host}'}, exception=e, client=client)
-
-        # Sync once per day
-        await asyncio.sleep(86400)
+boot_profile.mark('imports')
 
 def set_connection_status(state):
     # When the wifi and MQTT broker are both successfully connected turn the LED off
@@ -71,6 +61,21 @@ async def up(client):
 
         await logger.publish_log_message({'status': "online"}, client=client, retain=True)
 
+        # The code has come online so keep it, rather than rolling back to the code from before the last update
+        code_update = code_rollback.cancel()
+
+        if code_update == 'updated':
+            await logger.publish_log_message({'message': 'Code update was successful'}, client=client)
+        elif code_update == 'rolled_back':
+            await logger.publish_error_message(error={'error': f'Updated code failed to come online after {code_rollback.MAX_BOOTS} boots and was rolled back'}, client=client)
+
+        # Boards with sensors publish the boot profile after the first reading is sent instead
+        if not sensor.sensor_drivers:
+            await boot_profile.publish(client, phase='online')
+
+        # The OTA code is only needed once the board is up, so don't hold up startup by importing it earlier
+        from lib.ota import rollback, status
+
         # Verify that the board supports OTA updates
         if status.ready() is True:
             # Everything has started up successfully so we can cancel the automatic rollback on reboot
@@ -89,6 +94,10 @@ async def messages(client):
             payload = json.loads(msg.decode())
 
             if topic == config['commands_topic']:
+                # Only loaded the first time a command arrives, along with everything it needs
+                # for updating the code and firmware
+                import admin
+
                 await admin.messages(client=client, payload=payload)
             else:
                 await output_device.update_outputs(client=client, topic=topic, payload=payload)
@@ -119,17 +128,24 @@ async def main(client):
         logger.log('Connection to wifi or MQTT broker failed')
         reset()
 
-    # Run an initial NTP sync on board start
-    ntptime.host = config['ntp_server']
-    ntptime.settime()
+    # Run an initial NTP sync on board start, if it fails sntp.run() keeps retrying every minute until it succeeds
+    sntp.host = config['ntp_server']
+
+    try:
+        await sntp.settime()
+    except OSError as e:
+        await logger.publish_error_message(error={'error': f'Failed to contact NTP server at {sntp.host}'}, exception=e, client=client)
+
+    boot_profile.mark('ntp')
 
-    for coroutine in (up, down, messages, sensor.read_sensors, sync_ntp):
+    for coroutine in (up, down, messages, sensor.read_sensors, sntp.run):
         asyncio.create_task(coroutine(client))
 
     while True:
         await asyncio.sleep(30)
 
 mqtt_config['queue_len'] = 10
+mqtt_config['phase_cb'] = boot_profile.mark
 
 mqtt_client = MQTTClient(mqtt_config)
 
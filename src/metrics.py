@@ -0,0 +1,89 @@
+from array import array
+from time import ticks_us, ticks_diff
+
+# Keeps a histogram of how long something takes each time it runs, such as reading a sensor or
+# publishing a reading, so slow I2C buses and broker latency spikes show up in get_system_info without
+# needing a serial cable. Bucket 0 counts anything under 1µs and each bucket after that counts spans
+# twice as long as the one before, so bucket n counts spans from 2^(n-1) up to 2^n µs and the last one
+# counts everything from about 4 seconds up. Counts stop going up once they reach 65535.
+#
+# All the memory a span needs is allocated when it's created, so recording one allocates nothing.
+BUCKETS = 24
+MAX_COUNT = 65535
+
+_spans = {}
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.histogram = array('H', [0] * BUCKETS)
+        self.count = 0
+        self.min = 0
+        self.max = 0
+
+    # Returns the time to pass to stop() once whatever's being measured has finished
+    def start(self):
+        return ticks_us()
+
+    def stop(self, start):
+        self.record(ticks_diff(ticks_us(), start))
+
+    def record(self, us):
+        if self.count == 0 or us < self.min:
+            self.min = us
+
+        if us > self.max:
+            self.max = us
+
+        self.count += 1
+
+        bucket = 0
+        while us and bucket < BUCKETS - 1:
+            us >>= 1
+            bucket += 1
+
+        if self.histogram[bucket] < MAX_COUNT:
+            self.histogram[bucket] += 1
+
+    def stats(self):
+        # Leave off the empty buckets at the end to keep the message short
+        last = BUCKETS
+
+        while last and self.histogram[last - 1] == 0:
+            last -= 1
+
+        return {
+            'count': self.count,
+            'min_us': self.min,
+            'max_us': self.max,
+            'histogram': list(self.histogram[:last]),
+        }
+
+    def reset(self):
+        for bucket in range(BUCKETS):
+            self.histogram[bucket] = 0
+
+        self.count = 0
+        self.min = 0
+        self.max = 0
+
+
+
+# Returns the span with the given name, creating it the first time. Look spans up once and keep them
+# rather than calling this every time something's measured, since building the name allocates.
+def span(name):
+    if name not in _spans:
+        _spans[name] = Span(name)
+
+    return _spans[name]
+
+
+
+def stats():
+    return {name: s.stats() for name, s in _spans.items()}
+
+
+
+def reset():
+    for s in _spans.values():
+        s.reset()
@@ -6,6 +6,7 @@
 # Various improvements contributed by Kevin Köck.
 
 import gc
+from array import array
 import usocket as socket
 import ustruct as struct
 import utime as time
@@ -15,7 +16,7 @@ from ubinascii import hexlify
 import uasyncio as asyncio
 
 gc.collect()
-from utime import ticks_ms, ticks_diff
+from utime import ticks_ms, ticks_us, ticks_diff
 from uerrno import EINPROGRESS, ETIMEDOUT
 
 gc.collect()
@@ -30,6 +31,9 @@ VERSION = (0, 8, 2)
 # Default initial size for input messge buffer. Increase this if large messages
 # are expected, but rarely, to avoid big runtime allocations
 IBUFSIZE = 50
+# Default initial size for the output buffer that each outgoing packet is assembled
+# in before being sent with a single write. It grows to fit larger packets.
+OBUFSIZE = 256
 # By default the callback interface returns and incoming message as bytes.
 # For performance reasons with large messages it may return a memoryview.
 MSG_BYTES = True
@@ -54,6 +58,17 @@ async def eliza(*_):  # e.g. via set_wifi_handler(coro): see test program
     await asyncio.sleep_ms(0)
 
 
+# Suspend the task until sock has data to read (or has failed), the same way
+# asyncio's own streams do, rather than polling it on every pass of the scheduler.
+async def _readable(sock):
+    yield asyncio.core._io_queue.queue_read(sock)
+
+
+# As above, until sock has room to write.
+async def _writable(sock):
+    yield asyncio.core._io_queue.queue_write(sock)
+
+
 class MsgQueue:
     def __init__(self, size):
         self._q = [0 for _ in range(max(size, 4))]
@@ -83,6 +98,157 @@ class MsgQueue:
         return r
 
 
+# MQTT control packet types, indexed by the high nibble of the first byte of a packet
+PACKET_TYPES = (
+    "reserved",
+    "connect",
+    "connack",
+    "publish",
+    "puback",
+    "pubrec",
+    "pubrel",
+    "pubcomp",
+    "subscribe",
+    "suback",
+    "unsubscribe",
+    "unsuback",
+    "pingreq",
+    "pingresp",
+    "disconnect",
+    "auth",
+)
+
+# Why the connection to the broker was dropped, see MQTTClient._reconnect()
+RECONNECT_WIFI = const(0)  # WiFi went down
+RECONNECT_READ = const(1)  # Error reading from the broker
+RECONNECT_TIMEOUT = const(2)  # Nothing heard from the broker within the keepalive period
+RECONNECT_PING = const(3)  # Error sending a ping
+RECONNECT_PUBLISH = const(4)  # Error publishing or no PUBACK after max_repubs attempts
+RECONNECT_SUBSCRIBE = const(5)  # Error subscribing or unsubscribing, or no SUBACK/UNSUBACK
+RECONNECT_REASONS = ("wifi", "read", "timeout", "ping", "publish", "subscribe")
+
+
+# Runtime statistics for tuning keepalive, queue_len and so on. Every counter is
+# allocated up front so updating them doesn't allocate. Times are in ms.
+class Stats:
+    def __init__(self):
+        self.packets_in = array("L", [0] * 16)  # Indexed by packet type
+        self.packets_out = array("L", [0] * 16)
+        self.bytes_in = array("L", [0] * 16)
+        self.bytes_out = array("L", [0] * 16)
+        self.bytes_read = 0  # Running total, used to find the size of each packet read
+        self.republishes = 0
+        self.reconnects = 0
+        self.reconnect_reasons = array("L", [0] * len(RECONNECT_REASONS))
+        self.last_reconnect_reason = -1
+        self.wifi_connects = 0  # Attempts, including failed ones
+        self.wifi_connect_ms = 0
+        self.wifi_connect_last_ms = 0
+        self.connects = 0
+        self.connect_ms = 0
+        self.connect_last_ms = 0
+        self.ping_sent = None  # ticks_ms() of the last ping still awaiting its PINGRESP
+        self.pings = 0
+        self.ping_rtt_ms = 0
+        self.ping_rtt_last_ms = 0
+        self.ping_rtt_min_ms = 0
+        self.ping_rtt_max_ms = 0
+        self.lock_waits = 0  # Times the lock had to be waited for
+        self.lock_wait_ms = 0
+        self.lock_wait_max_us = 0
+        self._lock_wait_us = 0  # Remainder under 1ms, so totals stay small ints
+
+    def received(self, op, n):
+        self.packets_in[op >> 4] += 1
+        self.bytes_in[op >> 4] += n
+
+    def sent(self, op, n):
+        self.packets_out[op >> 4] += 1
+        self.bytes_out[op >> 4] += n
+
+    def pong(self):
+        if self.ping_sent is None:
+            return
+        rtt = ticks_diff(ticks_ms(), self.ping_sent)
+        self.ping_sent = None
+        if not self.pings or rtt < self.ping_rtt_min_ms:
+            self.ping_rtt_min_ms = rtt
+        if rtt > self.ping_rtt_max_ms:
+            self.ping_rtt_max_ms = rtt
+        self.pings += 1
+        self.ping_rtt_ms += rtt
+        self.ping_rtt_last_ms = rtt
+
+    def lock_waited(self, us):
+        self.lock_waits += 1
+        if us > self.lock_wait_max_us:
+            self.lock_wait_max_us = us
+        us += self._lock_wait_us
+        self.lock_wait_ms += us // 1000
+        self._lock_wait_us = us % 1000
+
+    @staticmethod
+    def _by_type(packets, nbytes):
+        return {
+            PACKET_TYPES[i]: {"packets": packets[i], "bytes": nbytes[i]} for i in range(16) if packets[i]
+        }
+
+    def as_dict(self):
+        return {
+            "in": self._by_type(self.packets_in, self.bytes_in),
+            "out": self._by_type(self.packets_out, self.bytes_out),
+            "republishes": self.republishes,
+            "reconnects": self.reconnects,
+            "reconnect_reasons": {
+                RECONNECT_REASONS[i]: n for i, n in enumerate(self.reconnect_reasons) if n
+            },
+            "last_reconnect_reason": (
+                RECONNECT_REASONS[self.last_reconnect_reason] if self.last_reconnect_reason >= 0 else None
+            ),
+            "wifi_connects": self.wifi_connects,
+            "wifi_connect_ms": self.wifi_connect_ms,
+            "wifi_connect_last_ms": self.wifi_connect_last_ms,
+            "connects": self.connects,
+            "connect_ms": self.connect_ms,
+            "connect_last_ms": self.connect_last_ms,
+            "pings": self.pings,
+            "ping_rtt_avg_ms": self.ping_rtt_ms // self.pings if self.pings else 0,
+            "ping_rtt_last_ms": self.ping_rtt_last_ms,
+            "ping_rtt_min_ms": self.ping_rtt_min_ms,
+            "ping_rtt_max_ms": self.ping_rtt_max_ms,
+            "lock_waits": self.lock_waits,
+            "lock_wait_ms": self.lock_wait_ms,
+            "lock_wait_max_us": self.lock_wait_max_us,
+        }
+
+
+# asyncio.Lock that records in Stats how long tasks wait to acquire it.
+class TimedLock:
+    def __init__(self, stats):
+        self._lock = asyncio.Lock()
+        self._stats = stats
+
+    def locked(self):
+        return self._lock.locked()
+
+    async def acquire(self):
+        if not self._lock.locked():
+            await self._lock.acquire()
+            return
+        t = ticks_us()
+        await self._lock.acquire()
+        self._stats.lock_waited(ticks_diff(ticks_us(), t))
+
+    def release(self):
+        self._lock.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *_):
+        self._lock.release()
+
+
 config = {
     "client_id": hexlify(unique_id()),
     "server": None,
@@ -97,10 +263,12 @@ config = {
     "clean_init": True,
     "clean": True,
     "max_repubs": 4,
+    "max_inflight": 4,
     "will": None,
     "subs_cb": lambda *_: None,
     "wifi_coro": eliza,
     "connect_coro": eliza,
+    "phase_cb": lambda *_: None,
     "ssid": None,
     "wifi_pw": None,
     "queue_len": 0,
@@ -126,12 +294,36 @@ def qos_check(qos):
         raise ValueError("Only qos 0 and 1 are supported.")
 
 
+def as_bytes(s):
+    return s.encode() if isinstance(s, str) else s
+
+
+# Encode the remaining length of a packet into buf at offset i. Returns the
+# offset of the next byte.
+def pack_len(buf, i, sz):
+    while sz > 0x7F:
+        buf[i] = (sz & 0x7F) | 0x80
+        sz >>= 7
+        i += 1
+    buf[i] = sz
+    return i + 1
+
+
+# Copy a length prefixed string or bytes into buf at offset i. Returns the
+# offset of the next byte.
+def pack_str(buf, i, s):
+    n = len(s)
+    struct.pack_into("!H", buf, i, n)
+    i += 2
+    buf[i : i + n] = s
+    return i + n
+
+
 encode_properties = None
 decode_properties = None
 
 
 class MQTT_base:
-    REPUB_COUNT = 0  # TEST
     DEBUG = False
 
     def __init__(self, config):
@@ -145,6 +337,7 @@ class MQTT_base:
             raise ValueError("invalid keepalive time")
         self._response_time = config["response_time"] * 1000  # Repub if no PUBACK received (ms).
         self._max_repubs = config["max_repubs"]
+        self._max_inflight = max(config["max_inflight"], 1)  # Concurrent qos 1 publishes awaiting PUBACK
         self._clean_init = config["clean_init"]  # clean_session state on first connection
         self._clean = config["clean"]  # clean_session state on reconnect
         will = config["will"]
@@ -158,6 +351,7 @@ class MQTT_base:
         self._ssl = config["ssl"]
         self._ssl_params = config["ssl_params"]
         # Callbacks and coros
+        self._phase_cb = config["phase_cb"]  # Called with "wifi", "dns" and "connack" as each completes
         if self._events:
             self.up = asyncio.Event()
             self.down = asyncio.Event()
@@ -188,11 +382,15 @@ class MQTT_base:
             self._espnow.active(True)
 
         self.newpid = pid_gen()
-        self.rcv_pids = set()  # PUBACK and SUBACK pids awaiting ACK response
+        self._acks = {}  # PUBACK/SUBACK/UNSUBACK pid: Event set by wait_msg when the ACK arrives
+        self._inflight = 0
+        self._window = asyncio.Event()  # Set when a slot in the in-flight window frees up
         self.last_rx = ticks_ms()  # Time of last communication from broker
-        self.lock = asyncio.Lock()
+        self._stats = Stats()
+        self.lock = TimedLock(self._stats)
         self._ibuf = bytearray(IBUFSIZE)
         self._mvbuf = memoryview(self._ibuf)
+        self._obuf = bytearray(OBUFSIZE)
 
         self.mqttv5 = config.get("mqttv5")
         self.mqttv5_con_props = config.get("mqttv5_con_props")
@@ -218,16 +416,41 @@ class MQTT_base:
     def _timeout(self, t):
         return ticks_diff(ticks_ms(), t) > self._response_time
 
-    async def _as_read(self, n, sock=None):  # OSError caught by superclass
+    # Wait for sock to be ready (wait is _readable or _writable), giving up once
+    # response_time has passed since t. The caller's ._timeout() check then
+    # raises, so the deadline is the same as when the socket was polled.
+    async def _wait_io(self, wait, sock, t):
+        remaining = self._response_time - ticks_diff(ticks_ms(), t)
+        if remaining > 0:
+            try:
+                await asyncio.wait_for_ms(wait(sock), remaining + 1)
+            except asyncio.TimeoutError:
+                pass
+
+    # Runtime statistics, see Stats. queue_discards is how many incoming messages
+    # were dropped because .queue was full.
+    def stats(self):
+        stats = self._stats.as_dict()
+        stats["queue_discards"] = self.queue.discards if self._events else 0
+        stats["inflight"] = self._inflight
+        return stats
+
+    # Read n bytes into the input buffer, which only the reader task (._handle_msg())
+    # and ._connect() use, or into buf if reading from another socket.
+    async def _as_read(self, n, sock=None, buf=None):  # OSError caught by superclass
+        stats = self._stats if sock is None else None  # Only count the broker socket
         if sock is None:
             sock = self._sock
-        # Ensure input buffer is big enough to hold data. It keeps the new size
-        oflow = n - len(self._ibuf)
-        if oflow > 0:  # Grow the buffer and re-create the memoryview
-            # Avoid too frequent small allocations by adding some extra bytes
-            self._ibuf.extend(bytearray(oflow + 50))
-            self._mvbuf = memoryview(self._ibuf)
-        buffer = self._mvbuf
+        if buf is not None:
+            buffer = memoryview(buf)
+        else:
+            # Ensure input buffer is big enough to hold data. It keeps the new size
+            oflow = n - len(self._ibuf)
+            if oflow > 0:  # Grow the buffer and re-create the memoryview
+                # Avoid too frequent small allocations by adding some extra bytes
+                self._ibuf.extend(bytearray(oflow + 50))
+                self._mvbuf = memoryview(self._ibuf)
+            buffer = self._mvbuf
         size = 0
         t = ticks_ms()
         while size < n:
@@ -245,12 +468,17 @@ class MQTT_base:
                 size += msg_size
                 t = ticks_ms()
                 self.last_rx = ticks_ms()
-            await asyncio.sleep_ms(0)
+                if stats is not None:
+                    stats.bytes_read += msg_size
+            else:  # Nothing to read yet
+                await self._wait_io(_readable, sock, t)
         return buffer[:n]
 
     async def _as_write(self, bytes_wr, length=0, sock=None):
         if sock is None:
             sock = self._sock
+            # Every write to the broker is a whole packet
+            self._stats.sent(bytes_wr[0], length or len(bytes_wr))
 
         # Wrap bytes in memoryview to avoid copying during slicing
         bytes_wr = memoryview(bytes_wr)
@@ -269,11 +497,16 @@ class MQTT_base:
             if n:
                 t = ticks_ms()
                 bytes_wr = bytes_wr[n:]
-            await asyncio.sleep_ms(0)
+            if bytes_wr:  # Socket buffer is full
+                await self._wait_io(_writable, sock, t)
 
-    async def _send_str(self, s):
-        await self._as_write(struct.pack("!H", len(s)))
-        await self._as_write(s)
+    # Return the output buffer, grown if necessary to hold n bytes. Callers must
+    # hold the lock (or be in ._connect()) while the buffer is in use.
+    def _get_obuf(self, n):
+        if n > len(self._obuf):
+            # Avoid too frequent small allocations by adding some extra bytes
+            self._obuf = bytearray(n + 50)
+        return self._obuf
 
     async def _recv_len(self):
         n = 0
@@ -289,9 +522,23 @@ class MQTT_base:
             sh += 7
 
     async def _connect(self, clean):
+        stats = self._stats
+        t = ticks_ms()
+        try:
+            await self._connect_broker(clean)
+        finally:
+            stats.connects += 1
+            stats.connect_last_ms = ticks_diff(ticks_ms(), t)
+            stats.connect_ms += stats.connect_last_ms
+
+    async def _connect_broker(self, clean):
         mqttv5 = self.mqttv5  # Cache local
         self._sock = socket.socket()
         self._sock.setblocking(False)
+        # Every packet goes out in a single write, so Nagle's algorithm has nothing
+        # to coalesce and only holds back publishes sent while others await PUBACK.
+        if hasattr(socket, "TCP_NODELAY"):
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         try:
             self._sock.connect(self._addr)
         except OSError as e:
@@ -306,57 +553,61 @@ class MQTT_base:
                 import ussl as ssl
 
             self._sock = ssl.wrap_socket(self._sock, **self._ssl_params)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x00\0\0\0")
+        msg = bytearray(b"\x00\x04MQTT\x00\0\0\0")
         if mqttv5:
-            msg[5] = 0x05
+            msg[6] = 0x05
         else:
-            msg[5] = 0x04
+            msg[6] = 0x04
 
-        sz = 10 + 2 + len(self._client_id)
-        msg[6] = clean << 1
+        client_id = as_bytes(self._client_id)
+        sz = 10 + 2 + len(client_id)
+        msg[7] = clean << 1
         if self._user:
-            sz += 2 + len(self._user) + 2 + len(self._pswd)
-            msg[6] |= 0xC0
+            user, pswd = as_bytes(self._user), as_bytes(self._pswd)
+            sz += 2 + len(user) + 2 + len(pswd)
+            msg[7] |= 0xC0
         if self._keepalive:
-            msg[7] |= self._keepalive >> 8
-            msg[8] |= self._keepalive & 0x00FF
+            msg[8] |= self._keepalive >> 8
+            msg[9] |= self._keepalive & 0x00FF
         if self._lw_topic:
-            sz += 2 + len(self._lw_topic) + 2 + len(self._lw_msg)
+            lw_topic, lw_msg = as_bytes(self._lw_topic), as_bytes(self._lw_msg)
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg)
             if mqttv5:
                 # Extra for the will properties
                 sz += 1
-            msg[6] |= 0x4 | (self._lw_qos & 0x1) << 3 | (self._lw_qos & 0x2) << 3
-            msg[6] |= self._lw_retain << 5
+            msg[7] |= 0x4 | (self._lw_qos & 0x1) << 3 | (self._lw_qos & 0x2) << 3
+            msg[7] |= self._lw_retain << 5
 
         if mqttv5:
             properties = encode_properties(self.mqttv5_con_props)
             sz += len(properties)
 
-        i = 1
-        while sz > 0x7F:
-            premsg[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        premsg[i] = sz
-        await self._as_write(premsg, i + 2)
-        await self._as_write(msg)
+        # Assemble the whole CONNECT packet so it goes out in a single write
+        buf = self._get_obuf(sz + 5)
+        buf[0] = 0x10
+        i = pack_len(buf, 1, sz)
+        buf[i : i + 10] = msg
+        i += 10
         if mqttv5:
-            await self._as_write(properties)
+            buf[i : i + len(properties)] = properties
+            i += len(properties)
 
-        await self._send_str(self._client_id)
+        i = pack_str(buf, i, client_id)
         if self._lw_topic:
             if mqttv5:
                 # We don't support will properties, so we send 0x00 for properties length
-                await self._as_write(b"\x00")
-            await self._send_str(self._lw_topic)
-            await self._send_str(self._lw_msg)
+                buf[i] = 0
+                i += 1
+            i = pack_str(buf, i, lw_topic)
+            i = pack_str(buf, i, lw_msg)
         if self._user:
-            await self._send_str(self._user)
-            await self._send_str(self._pswd)
+            i = pack_str(buf, i, user)
+            i = pack_str(buf, i, pswd)
+        await self._as_write(buf, i)
         # Await CONNACK
         # read causes ECONNABORTED if broker is out; triggers a reconnect.
-        del premsg, msg
+        del msg
+        rx = self._stats.bytes_read
         packet_type = await self._as_read(1)
         if packet_type[0] != 0x20:
             raise OSError(-1, "CONNACK not received")
@@ -382,6 +633,7 @@ class MQTT_base:
         del connack_resp
         if not mqttv5:
             # If we are not on MQTTv5 we can stop here
+            self._stats.received(0x20, self._stats.bytes_read - rx)
             return
 
         connack_props_length, _ = await self._recv_len()
@@ -390,10 +642,12 @@ class MQTT_base:
             decoded_props = decode_properties(connack_props, connack_props_length)
             self.dprint("CONNACK properties: %s", decoded_props)
             self.topic_alias_maximum = decoded_props.get(0x22, 0)
+        self._stats.received(0x20, self._stats.bytes_read - rx)
 
     async def _ping(self):
         async with self.lock:
             await self._as_write(b"\xc0\0")
+            self._stats.ping_sent = ticks_ms()
 
     # Check internet connectivity by sending DNS lookup to Google's 8.8.8.8
     async def wan_ok(
@@ -403,21 +657,23 @@ class MQTT_base:
         if not self.isconnected():  # WiFi is down
             return False
         length = 32  # DNS query and response packet size
+        # Its own buffer and socket, so it doesn't need the lock or get in the
+        # way of the reader task
+        buf = bytearray(length)
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.setblocking(False)
         s.connect(("8.8.8.8", 53))
         await asyncio.sleep(1)
-        async with self.lock:
-            try:
-                await self._as_write(packet, sock=s)
-                await asyncio.sleep(2)
-                res = await self._as_read(length, s)
-                if len(res) == length:
-                    return True  # DNS response size OK
-            except OSError:  # Timeout on read: no connectivity.
-                return False
-            finally:
-                s.close()
+        try:
+            await self._as_write(packet, sock=s)
+            await asyncio.sleep(2)
+            res = await self._as_read(length, s, buf)
+            if len(res) == length:
+                return True  # DNS response size OK
+        except OSError:  # Timeout on read: no connectivity.
+            return False
+        finally:
+            s.close()
         return False
 
     async def broker_up(self):  # Test broker connectivity
@@ -443,6 +699,7 @@ class MQTT_base:
             try:
                 async with self.lock:
                     self._sock.write(b"\xe0\0")  # Close broker connection
+                    self._stats.sent(0xE0, 2)
                     await asyncio.sleep_ms(100)
             except OSError:
                 pass
@@ -461,43 +718,61 @@ class MQTT_base:
             self.dprint("Wi-Fi not started, unable to disconnect interface")
         self._sta_if.active(False)
 
-    async def _await_pid(self, pid):
-        t = ticks_ms()
-        while pid in self.rcv_pids:  # local copy
-            if self._timeout(t) or not self.isconnected():
-                break  # Must repub or bail out
-            await asyncio.sleep_ms(100)
-        else:
-            return True  # PID received. All done.
-        return False
+    # Wait for wait_msg to set the pid's Event. True if the ACK arrived, False on
+    # timeout or if the Event was released because the connection went down.
+    async def _await_ack(self, pid, evt):
+        try:
+            await asyncio.wait_for_ms(evt.wait(), self._response_time)
+        except asyncio.TimeoutError:
+            pass
+        evt.clear()
+        return pid not in self._acks
+
+    # Wake every task awaiting an ACK so it can bail out and retry after
+    # reconnection.
+    def _release_acks(self):
+        for evt in self._acks.values():
+            evt.set()
 
-    # qos == 1: coro blocks until wait_msg gets correct PID.
+    # qos == 1: coro blocks until wait_msg gets correct PID. Up to max_inflight
+    # publishes may be awaiting their PUBACK at once, further ones wait for a slot.
     # If WiFi fails completely subclass re-publishes with new PID.
     async def publish(self, topic, msg, retain, qos, properties=None):
         pid = next(self.newpid)
         if qos:
-            self.rcv_pids.add(pid)
-        async with self.lock:
-            await self._publish(topic, msg, retain, qos, 0, pid, properties)
-        if qos == 0:
-            return
-
-        count = 0
-        while 1:  # Await PUBACK, republish on timeout
-            if await self._await_pid(pid):
-                return
-            # No match
-            if count >= self._max_repubs or not self.isconnected():
-                raise OSError(-1)  # Subclass to re-publish with new PID
+            while self._inflight >= self._max_inflight:
+                self._window.clear()
+                await self._window.wait()
+            self._inflight += 1
+            evt = asyncio.Event()
+            self._acks[pid] = evt
+        try:
             async with self.lock:
-                # Add pid
-                await self._publish(topic, msg, retain, qos, dup=1, pid=pid, properties=properties)
-            count += 1
-            self.REPUB_COUNT += 1
+                await self._publish(topic, msg, retain, qos, 0, pid, properties)
+            if qos == 0:
+                return
 
+            count = 0
+            while 1:  # Await PUBACK, republish on timeout
+                if await self._await_ack(pid, evt):
+                    return
+                # No match
+                if count >= self._max_repubs or not self.isconnected():
+                    raise OSError(-1)  # Subclass to re-publish with new PID
+                async with self.lock:
+                    await self._publish(topic, msg, retain, qos, dup=1, pid=pid, properties=properties)
+                count += 1
+                self._stats.republishes += 1
+        finally:
+            if qos:
+                self._acks.pop(pid, None)
+                self._inflight -= 1
+                self._window.set()
+
+    # Assembles the whole PUBLISH packet in the output buffer and sends it with
+    # a single write. Caller must hold the lock.
     async def _publish(self, topic, msg, retain, qos, dup, pid, properties=None):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain | dup << 3
+        topic, msg = as_bytes(topic), as_bytes(msg)
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
@@ -508,72 +783,89 @@ class MQTT_base:
 
         if sz >= 2097152:
             raise MQTTException("Strings too long.")
-        i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        await self._as_write(pkt, i + 1)
-        await self._send_str(topic)
+        buf = self._get_obuf(sz + 4)
+        buf[0] = 0x30 | qos << 1 | retain | dup << 3
+        i = pack_len(buf, 1, sz)
+        i = pack_str(buf, i, topic)
         if qos > 0:
-            struct.pack_into("!H", pkt, 0, pid)
-            await self._as_write(pkt, 2)
+            struct.pack_into("!H", buf, i, pid)
+            i += 2
         if self.mqttv5:
-            await self._as_write(properties)
-        await self._as_write(msg)
+            buf[i : i + len(properties)] = properties
+            i += len(properties)
+        buf[i : i + len(msg)] = msg
+        await self._as_write(buf, i + len(msg))
 
     # Can raise OSError if WiFi fails. Subclass traps.
     async def subscribe(self, topic, qos, properties=None):
-        pkt = bytearray(b"\x82\0\0\0")
+        topic = as_bytes(topic)
         pid = next(self.newpid)
-        self.rcv_pids.add(pid)
+        evt = asyncio.Event()
+        self._acks[pid] = evt
         sz = 2 + 2 + len(topic) + 1
         if self.mqttv5:
             properties = encode_properties(properties)
             sz += len(properties)
 
-        struct.pack_into("!BH", pkt, 1, sz, pid)
-        async with self.lock:
-            await self._as_write(pkt)
-            if self.mqttv5:
-                await self._as_write(properties)
-            await self._send_str(topic)
-            # Only QoS is supported other features such as:
-            # (NL) No Local, (RAP) Retain As Published and Retain Handling.
-            # Are not supported.
-            await self._as_write(qos.to_bytes(1, "little"))
-
-        if not await self._await_pid(pid):
-            raise OSError(-1)
+        try:
+            async with self.lock:
+                buf = self._get_obuf(sz + 4)
+                buf[0] = 0x82
+                i = pack_len(buf, 1, sz)
+                struct.pack_into("!H", buf, i, pid)
+                i += 2
+                if self.mqttv5:
+                    buf[i : i + len(properties)] = properties
+                    i += len(properties)
+                i = pack_str(buf, i, topic)
+                # Only QoS is supported other features such as:
+                # (NL) No Local, (RAP) Retain As Published and Retain Handling.
+                # Are not supported.
+                buf[i] = qos
+                await self._as_write(buf, i + 1)
+
+            if not await self._await_ack(pid, evt):
+                raise OSError(-1)
+        finally:
+            self._acks.pop(pid, None)
 
     # Can raise OSError if WiFi fails. Subclass traps.
     async def unsubscribe(self, topic, properties=None):
-        pkt = bytearray(b"\xa2\0\0\0")
+        topic = as_bytes(topic)
         pid = next(self.newpid)
-        self.rcv_pids.add(pid)
+        evt = asyncio.Event()
+        self._acks[pid] = evt
         sz = 2 + 2 + len(topic)
         if self.mqttv5:
             properties = encode_properties(properties)
             sz += len(properties)
 
-        struct.pack_into("!BH", pkt, sz, pid)
-        async with self.lock:
-            await self._as_write(pkt)
-            if self.mqttv5:
-                await self._as_write(properties)
-            await self._send_str(topic)
+        try:
+            async with self.lock:
+                buf = self._get_obuf(sz + 4)
+                buf[0] = 0xA2
+                i = pack_len(buf, 1, sz)
+                struct.pack_into("!H", buf, i, pid)
+                i += 2
+                if self.mqttv5:
+                    buf[i : i + len(properties)] = properties
+                    i += len(properties)
+                i = pack_str(buf, i, topic)
+                await self._as_write(buf, i)
 
-        if not await self._await_pid(pid):
-            raise OSError(-1)
+            if not await self._await_ack(pid, evt):
+                raise OSError(-1)
+        finally:
+            self._acks.pop(pid, None)
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .setup() method. Other (internal) MQTT
     # messages processed internally.
-    # Immediate return if no data available. Called from ._handle_msg().
+    # Immediate return if no data available. Called from ._handle_msg(), which is
+    # the only task that reads from the socket, so it doesn't hold the lock while
+    # reading. Only sending a PUBACK takes the lock.
     async def wait_msg(self):
-        mqttv5 = self.mqttv5  # Cache local
         try:
             res = self._sock.read(1)  # Throws OSError on WiFi fail
         except OSError as e:
@@ -587,10 +879,21 @@ class MQTT_base:
         if res == b"":
             raise OSError(-1, "Empty response")
 
-        if res == b"\xd0":  # PINGRESP
+        stats = self._stats
+        rx = stats.bytes_read
+        op = res[0]
+        try:
+            await self._process_msg(op)
+        finally:
+            stats.received(op, stats.bytes_read - rx + 1)
+
+    # Read and handle the rest of a packet once its first byte, op, has arrived.
+    async def _process_msg(self, op):
+        mqttv5 = self.mqttv5  # Cache local
+        if op == 0xD0:  # PINGRESP
             await self._as_read(1)  # Update .last_rx time
+            self._stats.pong()
             return
-        op = res[0]
 
         if op == 0x40:  # PUBACK: save pid
             sz, _ = await self._recv_len()
@@ -610,10 +913,10 @@ class MQTT_base:
                     puback_props = await self._as_read(puback_props_sz)
                     decoded_props = decode_properties(puback_props, puback_props_sz)
                     self.dprint("PUBACK properties %s", decoded_props)
-            if pid in self.rcv_pids:
-                self.rcv_pids.discard(pid)
-            else:
+            evt = self._acks.pop(pid, None)
+            if evt is None:
                 raise OSError(-1, "Invalid pid in PUBACK packet")
+            evt.set()  # Wake the publishing task
 
         if op == 0x90:  # SUBACK
             sz, _ = await self._recv_len()
@@ -638,10 +941,21 @@ class MQTT_base:
             if reason_code >= 0x80:
                 raise OSError(-1, "SUBACK reason code 0x%x" % reason_code)
 
-            if pid in self.rcv_pids:
-                self.rcv_pids.discard(pid)
-            else:
+            evt = self._acks.pop(pid, None)
+            if evt is None:
                 raise OSError(-1, "Invalid pid in SUBACK packet")
+            evt.set()  # Wake the subscribing task
+
+        if op == 0xB0:  # UNSUBACK
+            sz, _ = await self._recv_len()
+            rcv_pid = await self._as_read(2)
+            pid = rcv_pid[0] << 8 | rcv_pid[1]
+            if sz > 2:  # MQTTv5 properties and reason codes are not used
+                await self._as_read(sz - 2)
+            evt = self._acks.pop(pid, None)
+            if evt is None:
+                raise OSError(-1, "Invalid pid in UNSUBACK packet")
+            evt.set()  # Wake the unsubscribing task
 
         if op == 0xE0:  # DISCONNECT
             if mqttv5:
@@ -687,7 +1001,7 @@ class MQTT_base:
         # In event mode we must copy the message otherwise .queue contents will be wrong:
         # every entry would contain the same message.
         # In callback mode not copying the message is OK so long as the callback is purely
-        # synchronous. Overruns can't occur because of the lock.
+        # synchronous. Overruns can't occur because there is only one reader task.
         if self._events or MSG_BYTES:
             msg = bytes(msg)
         retained = op & 0x01
@@ -699,7 +1013,8 @@ class MQTT_base:
         if op & 6 == 2:  # qos 1
             pkt = bytearray(b"\x40\x02\0\0")  # Send PUBACK
             struct.pack_into("!H", pkt, 2, pid)
-            await self._as_write(pkt)
+            async with self.lock:
+                await self._as_write(pkt)
         elif op & 6 == 4:  # qos 2 not supported
             raise OSError(-1, "QoS 2 not supported")
 
@@ -725,6 +1040,16 @@ class MQTTClient(MQTT_base):
             esp.sleep_type(0)  # Improve connection integrity at cost of power consumption.
 
     async def wifi_connect(self, quick=False):
+        stats = self._stats
+        t = ticks_ms()
+        try:
+            await self._wifi_connect(quick)
+        finally:
+            stats.wifi_connects += 1
+            stats.wifi_connect_last_ms = ticks_diff(ticks_ms(), t)
+            stats.wifi_connect_ms += stats.wifi_connect_last_ms
+
+    async def _wifi_connect(self, quick):
         s = self._sta_if
         if ESP8266:
             if s.isconnected():  # 1st attempt, already connected.
@@ -790,9 +1115,11 @@ class MQTTClient(MQTT_base):
     async def connect(self, *, quick=False):  # Quick initial connect option for battery apps
         if not self._has_connected:
             await self.wifi_connect(quick)  # On 1st call, caller handles error
+            self._phase_cb("wifi")
             # Note this blocks if DNS lookup occurs. Do it once to prevent
             # blocking during later internet outage:
             self._addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+            self._phase_cb("dns")
         self._in_connect = True  # Disable low level ._isconnected check
         try:
             is_clean = self._clean
@@ -816,8 +1143,8 @@ class MQTTClient(MQTT_base):
             self._close()
             self._in_connect = False  # Caller may run .isconnected()
             raise
-        self.rcv_pids.clear()
         # If we get here without error broker/LAN must be up.
+        self._phase_cb("connack")
         self._isconnected = True
         self._in_connect = False  # Low level code can now check connectivity.
         if not self._events:
@@ -827,7 +1154,7 @@ class MQTTClient(MQTT_base):
             asyncio.create_task(self._keep_connected())
             # Runs forever unless user issues .disconnect()
 
-        asyncio.create_task(self._handle_msg())  # Task quits on connection fail.
+        self._tasks.append(asyncio.create_task(self._handle_msg()))  # Task quits on connection fail.
         self._tasks.append(asyncio.create_task(self._keep_alive()))
         if self.DEBUG:
             self._tasks.append(asyncio.create_task(self._memory()))
@@ -837,32 +1164,39 @@ class MQTTClient(MQTT_base):
             asyncio.create_task(self._connect_handler(self))  # User handler.
 
     # Launched by .connect(). Runs until connectivity fails. Checks for and
-    # handles incoming messages.
+    # handles incoming messages. It sleeps until the socket has something to read
+    # rather than polling it, and doesn't take the lock, so publishing never has
+    # to wait for it. ._kill_tasks() cancels it along with the other tasks.
     async def _handle_msg(self):
+        sock = self._sock
         try:
-            while self.isconnected():
-                async with self.lock:
+            while self.isconnected() and self._sock is sock:
+                await _readable(sock)
+                if self._sock is sock:
                     await self.wait_msg()  # Immediate return if no message
-                await asyncio.sleep_ms(0)  # Let other tasks get lock
 
         except OSError:
             pass
-        self._reconnect()  # Broker or WiFi fail.
+        if self._sock is sock:  # Not already replaced by a new connection
+            self._reconnect(RECONNECT_READ)  # Broker or WiFi fail.
 
     # Keep broker alive MQTT spec 3.1.2.10 Keep Alive.
     # Runs until ping failure or no response in keepalive period.
     async def _keep_alive(self):
+        reason = RECONNECT_WIFI
         while self.isconnected():
             pings_due = ticks_diff(ticks_ms(), self.last_rx) // self._ping_interval
             if pings_due >= 4:
                 self.dprint("Reconnect: broker fail.")
+                reason = RECONNECT_TIMEOUT
                 break
             await asyncio.sleep_ms(self._ping_interval)
             try:
                 await self._ping()
             except OSError:
+                reason = RECONNECT_PING
                 break
-        self._reconnect()  # Broker or WiFi fail.
+        self._reconnect(reason)  # Broker or WiFi fail.
 
     async def _kill_tasks(self, kill_skt):  # Cancel running tasks
         for task in self._tasks:
@@ -884,12 +1218,19 @@ class MQTTClient(MQTT_base):
             return True
 
         if self._isconnected and not self._sta_if.isconnected():  # It's going down.
-            self._reconnect()
+            self._reconnect(RECONNECT_WIFI)
         return self._isconnected
 
-    def _reconnect(self):  # Schedule a reconnection if not underway.
+    # Schedule a reconnection if not underway. reason is one of the RECONNECT_
+    # constants.
+    def _reconnect(self, reason):
         if self._isconnected:
             self._isconnected = False
+            self._stats.reconnects += 1
+            self._stats.reconnect_reasons[reason] += 1
+            self._stats.last_reconnect_reason = reason
+            self._stats.ping_sent = None
+            self._release_acks()  # Publishes awaiting PUBACK fail fast and republish
             asyncio.create_task(self._kill_tasks(True))  # Shut down tasks and socket
             if self._events:  # Signal an outage
                 self.down.set()
@@ -941,7 +1282,7 @@ class MQTTClient(MQTT_base):
                 return await super().subscribe(topic, qos, properties)
             except OSError:
                 pass
-            self._reconnect()  # Broker or WiFi fail.
+            self._reconnect(RECONNECT_SUBSCRIBE)  # Broker or WiFi fail.
 
     async def unsubscribe(self, topic, properties=None):
         while 1:
@@ -950,7 +1291,7 @@ class MQTTClient(MQTT_base):
                 return await super().unsubscribe(topic, properties)
             except OSError:
                 pass
-            self._reconnect()  # Broker or WiFi fail.
+            self._reconnect(RECONNECT_SUBSCRIBE)  # Broker or WiFi fail.
 
     async def publish(self, topic, msg, retain=False, qos=0, properties=None):
         qos_check(qos)
@@ -960,4 +1301,4 @@ class MQTTClient(MQTT_base):
                 return await super().publish(topic, msg, retain, qos, properties)
             except OSError:
                 pass
-            self._reconnect()  # Broker or WiFi fail.
+            self._reconnect(RECONNECT_PUBLISH)  # Broker or WiFi fail.
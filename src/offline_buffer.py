@@ -0,0 +1,189 @@
+import os
+import struct
+import asyncio
+import logger
+
+# Each record is stored as a three byte header (topic length and payload length) followed by the
+# topic and the payload
+HEADER_FORMAT = '<BH'
+HEADER_SIZE = 3
+
+# A fixed-size store-and-forward buffer for sensor readings. The storage is allocated once up front
+# so queueing readings never fragments the heap. When the buffer is full the oldest reading is moved
+# out to a capped file on flash if one is configured, otherwise it's discarded to make room.
+class OfflineBuffer:
+    def __init__(self, size, spill_file=None, spill_size=0):
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._size = size
+        self._header = bytearray(HEADER_SIZE)
+        self._ri = 0
+        self._wi = 0
+        self._used = 0
+        self._count = 0
+        self._evt = asyncio.Event()
+        self.discards = 0
+        # Readings that were taken out but couldn't be published, which go out again before anything else
+        self._returned = []
+
+        self._spill_file = spill_file if spill_size else None
+        self._spill_size = spill_size
+        self._spill_pos = 0
+        self._spill_end = 0
+        self._spill_count = 0
+
+        if self._spill_file is not None:
+            self._load_spill_file()
+
+    def __len__(self):
+        return len(self._returned) + self._count + self._spill_count
+
+    def put(self, topic, payload):
+        topic = topic.encode() if isinstance(topic, str) else topic
+        payload = payload.encode() if isinstance(payload, str) else payload
+        record_size = HEADER_SIZE + len(topic) + len(payload)
+
+        if record_size > self._size:
+            self.discards += 1
+            logger.log(f'Reading of {record_size} bytes is too large for the offline buffer, discarding')
+            return
+
+        while self._size - self._used < record_size:
+            self._evict()
+
+        struct.pack_into(HEADER_FORMAT, self._header, 0, len(topic), len(payload))
+        self._write(self._header)
+        self._write(topic)
+        self._write(payload)
+        self._count += 1
+        self._evt.set()
+
+    # Put back a reading taken out of the buffer that couldn't be published, so it's the next one returned.
+    # Everything else in the buffer is newer than it, including anything moved out to flash since.
+    def put_back(self, topic, payload):
+        self._returned.insert(0, (topic, payload))
+        self._evt.set()
+
+    def __aiter__(self):
+        return self
+
+    # Returns the oldest reading as a (topic, payload) tuple, waiting until there is one. Anything
+    # that has been moved out to flash is always older than what's still in memory so that's read first.
+    async def __anext__(self):
+        while not len(self):
+            self._evt.clear()
+            await self._evt.wait()
+
+        if self._returned:
+            return self._returned.pop(0)
+
+        if self._spill_count:
+            topic, payload = self._read_spill_record()
+        else:
+            topic, payload = self._read_record()
+
+        return topic.decode(), payload
+
+    def _write(self, data):
+        data = memoryview(data)
+        n = len(data)
+        first = min(n, self._size - self._wi)
+        self._mv[self._wi:self._wi + first] = data[:first]
+        if first < n:
+            self._mv[:n - first] = data[first:]
+        self._wi = (self._wi + n) % self._size
+        self._used += n
+
+    def _read(self, n):
+        first = min(n, self._size - self._ri)
+        data = bytes(self._mv[self._ri:self._ri + first])
+        if first < n:
+            data += bytes(self._mv[:n - first])
+        self._ri = (self._ri + n) % self._size
+        self._used -= n
+        return data
+
+    def _read_record(self):
+        topic_length, payload_length = struct.unpack(HEADER_FORMAT, self._read(HEADER_SIZE))
+        topic = self._read(topic_length)
+        payload = self._read(payload_length)
+        self._count -= 1
+        return topic, payload
+
+    # Make room in memory by removing the oldest reading, keeping it on flash if there's space
+    def _evict(self):
+        topic, payload = self._read_record()
+        record_size = HEADER_SIZE + len(topic) + len(payload)
+
+        if self._spill_file is not None and self._spill_end + record_size <= self._spill_size:
+            struct.pack_into(HEADER_FORMAT, self._header, 0, len(topic), len(payload))
+
+            with open(self._spill_file, 'ab') as file:
+                file.write(self._header)
+                file.write(topic)
+                file.write(payload)
+
+            self._spill_end += record_size
+            self._spill_count += 1
+        else:
+            self.discards += 1
+            logger.log(f'Offline buffer is full, discarded reading for {topic.decode()}')
+
+    def _read_spill_record(self):
+        with open(self._spill_file, 'rb') as file:
+            file.seek(self._spill_pos)
+            topic_length, payload_length = struct.unpack(HEADER_FORMAT, file.read(HEADER_SIZE))
+            topic = file.read(topic_length)
+            payload = file.read(payload_length)
+
+        self._spill_pos += HEADER_SIZE + topic_length + payload_length
+        self._spill_count -= 1
+
+        if self._spill_count == 0:
+            self._remove_spill_file()
+
+        return topic, payload
+
+    # Readings spilled to flash survive a restart, so pick up where we left off
+    def _load_spill_file(self):
+        try:
+            with open(self._spill_file, 'rb') as file:
+                while True:
+                    header = file.read(HEADER_SIZE)
+
+                    if not header:
+                        break
+
+                    # A record that was only partially written before a restart means the rest of the
+                    # file can't be trusted
+                    if len(header) < HEADER_SIZE:
+                        logger.log(f'{self._spill_file} is truncated, discarding it')
+                        self._spill_count = 0
+                        break
+
+                    topic_length, payload_length = struct.unpack(HEADER_FORMAT, header)
+
+                    if len(file.read(topic_length + payload_length)) < topic_length + payload_length:
+                        logger.log(f'{self._spill_file} is truncated, discarding it')
+                        self._spill_count = 0
+                        break
+
+                    self._spill_end += HEADER_SIZE + topic_length + payload_length
+                    self._spill_count += 1
+        except OSError:
+            return
+
+        if self._spill_count == 0:
+            self._remove_spill_file()
+        else:
+            logger.log(f'Loaded {self._spill_count} readings from {self._spill_file}')
+
+    def _remove_spill_file(self):
+        try:
+            os.remove(self._spill_file)
+        except OSError:
+            pass
+
+        self._spill_pos = 0
+        self._spill_end = 0
+        self._spill_count = 0
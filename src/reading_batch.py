@@ -0,0 +1,36 @@
+import json
+
+# Collects readings from every sensor into a single JSON lines envelope, one {"topic": ..., "reading": ...}
+# object per line, so they can be sent to the broker as one message instead of one per sensor. The
+# envelope is built in a buffer allocated once up front.
+class ReadingBatch:
+    def __init__(self, max_size):
+        self._buf = bytearray(max_size)
+        self._mv = memoryview(self._buf)
+        self._max_size = max_size
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    # Returns False if the line doesn't fit in what's left of the envelope, in which case it needs to be
+    # flushed before trying again
+    def add(self, topic, reading):
+        line = json.dumps({'topic': topic, 'reading': reading}).encode()
+        end = self._size + len(line) + 1
+
+        if end > self._max_size:
+            return False
+
+        self._mv[self._size:end - 1] = line
+        self._buf[end - 1] = 0x0A
+        self._size = end
+
+        return True
+
+    # Returns the envelope as a view onto the buffer, which is only valid until the next call to add()
+    def flush(self):
+        envelope = self._mv[:self._size]
+        self._size = 0
+
+        return envelope
@@ -0,0 +1,121 @@
+import json
+import struct
+
+# Sensor readings can be sent in one of three wire formats, configured per sensor:
+#   json   - the default, a JSON object
+#   struct - a fixed-layout frame of a header byte, a bitmask of the fields present, the timestamp as
+#            milliseconds, then each field present in FIELDS order
+#   cbor   - a header byte followed by a CBOR map of the reading
+# The high nibble of the header byte is the format and the low nibble the schema version, so consumers
+# can tell them apart (a JSON payload always starts with '{').
+STRUCT_V1 = 0x11
+CBOR_V1 = 0x21
+
+STRUCT_HEADER_FORMAT = '<BIQ'
+STRUCT_HEADER_SIZE = 13
+
+# Every field a sensor can report, in the order they're packed in the struct format. New fields must only
+# ever be added to the end so older payloads can still be decoded. Booleans are packed as a single byte.
+FIELDS = (
+    ('temperature', '<f', 4),
+    ('humidity', '<f', 4),
+    ('dew_point', '<f', 4),
+    ('pressure', '<f', 4),
+    ('aqi', '<B', 1),
+    ('tvoc', '<H', 2),
+    ('eco2', '<H', 2),
+    ('pm_1_0', '<H', 2),
+    ('pm_2_5', '<H', 2),
+    ('pm_10', '<H', 2),
+    ('particles_0_3um', '<H', 2),
+    ('particles_0_5um', '<H', 2),
+    ('particles_1_0um', '<H', 2),
+    ('particles_2_5um', '<H', 2),
+    ('particles_5_0um', '<H', 2),
+    ('particles_10um', '<H', 2),
+    ('triggered', '<B', 1),
+)
+
+# Binary payloads are encoded into this buffer, which is copied into the offline buffer straight away
+_buf = bytearray(256)
+_mv = memoryview(_buf)
+
+def encode(reading, payload_format='json'):
+    if payload_format == 'json':
+        return json.dumps(reading)
+
+    if payload_format == 'struct':
+        return _encode_struct(reading)
+
+    if payload_format == 'cbor':
+        return _encode_cbor(reading)
+
+    raise ValueError(f'Unknown payload format {payload_format}')
+
+
+
+def _encode_struct(reading):
+    mask = 0
+    i = STRUCT_HEADER_SIZE
+
+    for (bit, (name, fmt, size)) in enumerate(FIELDS):
+        if name in reading:
+            mask |= 1 << bit
+            struct.pack_into(fmt, _buf, i, reading[name])
+            i += size
+
+    if bin(mask).count('1') != len(reading) - 1:
+        raise ValueError(f'Reading has fields that cannot be encoded: {reading}')
+
+    struct.pack_into(STRUCT_HEADER_FORMAT, _buf, 0, STRUCT_V1, mask, reading['timestamp'])
+
+    return _mv[:i]
+
+
+
+def _encode_cbor(reading):
+    _buf[0] = CBOR_V1
+    i = _cbor_head(1, 5, len(reading))
+
+    for (key, value) in reading.items():
+        key = key.encode()
+        i = _cbor_head(i, 3, len(key))
+        _buf[i:i + len(key)] = key
+        i += len(key)
+
+        if value is True or value is False:
+            _buf[i] = 0xF5 if value else 0xF4
+            i += 1
+        elif value is None:
+            _buf[i] = 0xF6
+            i += 1
+        elif isinstance(value, float):
+            _buf[i] = 0xFA
+            struct.pack_into('>f', _buf, i + 1, value)
+            i += 5
+        elif value < 0:
+            i = _cbor_head(i, 1, -1 - value)
+        else:
+            i = _cbor_head(i, 0, value)
+
+    return _mv[:i]
+
+
+
+# Write a CBOR major type and argument at offset i, returning the offset of the next byte
+def _cbor_head(i, major, n):
+    if n < 24:
+        _buf[i] = major << 5 | n
+        return i + 1
+    elif n < 0x100:
+        struct.pack_into('>BB', _buf, i, major << 5 | 24, n)
+        return i + 2
+    elif n < 0x10000:
+        struct.pack_into('>BH', _buf, i, major << 5 | 25, n)
+        return i + 3
+    elif n < 0x100000000:
+        struct.pack_into('>BI', _buf, i, major << 5 | 26, n)
+        return i + 5
+    else:
+        struct.pack_into('>BQ', _buf, i, major << 5 | 27, n)
+        return i + 9
@@ -0,0 +1,115 @@
+import gc
+import heapq
+import asyncio
+from time import ticks_ms, ticks_diff
+
+class Job:
+    def __init__(self, name, interval, coroutine, args):
+        self.name = name
+        self.interval = interval
+        self.coroutine = coroutine
+        self.args = args
+        self.running = False
+
+        self.runs = 0
+        self.overruns = 0
+        self.last_jitter = 0
+        self.max_jitter = 0
+        self.last_duration = 0
+        self.max_duration = 0
+
+# Runs every sensor read from a single task rather than one task per sensor each with its own sleep.
+# Jobs are kept in a min-heap ordered by when they're next due, and due times are rounded up to a common
+# tick so sensors with the same interval are read together and the CPU only wakes once for all of them.
+# Reads due on the same tick run concurrently and gc.collect() runs once after the last of them finishes.
+class Scheduler:
+    def __init__(self, tick=1000):
+        self._tick = tick
+        self._jobs = []
+        self._queue = []
+        # Milliseconds since the scheduler was created, kept separately because ticks_ms() wraps around
+        self._clock = 0
+        self._last_ticks = ticks_ms()
+
+    # Run coroutine(*args) every interval milliseconds. The run loop only yields when the next job isn't
+    # due yet, so an interval that isn't positive would keep it from ever giving other tasks a turn.
+    def add(self, name, interval, coroutine, *args):
+        if interval <= 0:
+            raise ValueError(f'Interval for {name} must be positive, got {interval}')
+
+        self._jobs.append(Job(name, interval, coroutine, args))
+
+    def stats(self):
+        return {job.name: {
+            'interval_ms': job.interval,
+            'runs': job.runs,
+            'overruns': job.overruns,
+            'last_jitter_ms': job.last_jitter,
+            'max_jitter_ms': job.max_jitter,
+            'last_duration_ms': job.last_duration,
+            'max_duration_ms': job.max_duration,
+        } for job in self._jobs}
+
+    async def run(self):
+        for index in range(len(self._jobs)):
+            heapq.heappush(self._queue, (0, index))
+
+        while self._queue:
+            delay = self._queue[0][0] - self._now()
+
+            if delay > 0:
+                await asyncio.sleep_ms(delay)
+
+            now = self._now()
+            # The number of reads started on this tick that are still running
+            pending = [0]
+
+            while self._queue and self._queue[0][0] <= now:
+                due, index = heapq.heappop(self._queue)
+                job = self._jobs[index]
+
+                job.last_jitter = now - due
+                job.max_jitter = max(job.max_jitter, job.last_jitter)
+
+                # The previous read is taking longer than the interval, so skip this one rather than
+                # having two reads of the same sensor running at once
+                if job.running:
+                    job.overruns += 1
+                else:
+                    pending[0] += 1
+                    asyncio.create_task(self._run(job, pending))
+
+                heapq.heappush(self._queue, (self._next_due(due, job.interval, now), index))
+
+    async def _run(self, job, pending):
+        job.running = True
+        start = ticks_ms()
+
+        try:
+            await job.coroutine(*job.args)
+        finally:
+            job.running = False
+            job.runs += 1
+            job.last_duration = ticks_diff(ticks_ms(), start)
+            job.max_duration = max(job.max_duration, job.last_duration)
+
+            pending[0] -= 1
+
+            if pending[0] == 0:
+                gc.collect()
+
+    def _next_due(self, due, interval, now):
+        due += interval
+
+        # Skip any reads that were missed rather than running them all back to back to catch up
+        if due <= now:
+            due = now + interval
+
+        return -(-due // self._tick) * self._tick
+
+    def _now(self):
+        t = ticks_ms()
+        self._clock += ticks_diff(t, self._last_ticks)
+        self._last_ticks = t
+
+        return self._clock
@@ -1,66 +1,67 @@
-from math import log
 import gc
-import time
 import json
 import asyncio
 from machine import Pin, WDT, I2C
-import dht
 import logger
 from config import config
-from lib import ens160
-from lib import bme280_float as bme280
-from lib import sht30
-from lib import pms5003
-from lib import vl53l1x
-
-try:
-    sensor_dht22 = next(sensor for sensor in config['sensors'] if sensor['type'] == 'dht22')
-except StopIteration:
-    sensor_dht22 = False
-
-try:
-    sensor_bme280 = next(sensor for sensor in config['sensors'] if sensor['type'] == 'bme280')
-except StopIteration:
-    sensor_bme280 = False
-
-try:
-    sensor_sht30 = next(sensor for sensor in config['sensors'] if sensor['type'] == 'sht30')
-    sensor_sht30['heater_on_count'] = 0
-    sensor_sht30['heater_enabled_at'] = 0
-except StopIteration:
-    sensor_sht30 = False
-
-try:
-    sensor_pms5003 = next(sensor for sensor in config['sensors'] if sensor['type'] == 'pms5003')
-except StopIteration:
-    sensor_pms5003 = False
-
-try:
-    sensor_ens160 = next(sensor for sensor in config['sensors'] if sensor['type'] == 'ens160')
-except StopIteration:
-    sensor_ens160 = False
-
-try:
-    sensor_vl53l1x = next(sensor for sensor in config['sensors'] if sensor['type'] == 'vl53l1x')
-except StopIteration:
-    sensor_vl53l1x = False
-
-if sensor_bme280 or sensor_sht30 or sensor_ens160 or sensor_vl53l1x:
+from offline_buffer import OfflineBuffer
+from reading_batch import ReadingBatch
+from scheduler import Scheduler
+import reading_format
+import boot_profile
+import metrics
+from drivers import DRIVERS, get_driver
+from mqtt import MQTTException, config as mqtt_config
+
+# Look up the driver for each configured sensor, which only imports the drivers for the sensor types
+# that are actually attached. There can be more than one sensor of the same type, e.g. two SHT30s at
+# different I2C addresses.
+sensor_drivers = []
+
+for sensor in config['sensors']:
+    if sensor.get('type') in DRIVERS:
+        sensor_drivers.append((sensor, get_driver(sensor['type'])))
+    else:
+        logger.log(f"Unknown sensor type {sensor.get('type')}, skipping")
+
+if any(driver.uses_i2c for (sensor, driver) in sensor_drivers):
     i2c = I2C(0, sda=Pin(config['sda_pin']), scl=Pin(config['scl_pin']), timeout=50000)
+else:
+    i2c = None
 
-if config['disable_watchdog'] is not True:
-    if sensor_pms5003:
-        # The PMS5003 is only read every three minutes to prolong the sensor lifetime so
-        # the watchdog timeout needs to be several times that, rather than two minutes
-        # for the other sensors
-        wdt = WDT(timeout=600000)
-    else:
-        wdt = WDT(timeout=120000)
+# The watchdog timeout is long enough for the sensor that's read least often, e.g. ten minutes rather
+# than two when a PMS5003 is attached
+watchdog_timeout = max([120000] + [driver.watchdog_timeout for (sensor, driver) in sensor_drivers])
+
+# Sensors that are polled every few milliseconds would hide one read on an interval that has stopped
+# responding, so they only feed the watchdog when there are no sensors read on an interval
+interval_sensors = any(driver.poll_interval is None for (sensor, driver) in sensor_drivers)
 
-if sensor_ens160:
-    # Global variables to hold the temperature and humidity for calibrating the ENS160
-    temperature_calibration = 25
-    humidity_calibration = 50
+if config['disable_watchdog'] is not True:
+    wdt = WDT(timeout=watchdog_timeout)
+
+# Readings are queued here and published in order by a single background task so the sensor readers
+# never stall waiting on the broker, and anything read during a wifi or broker outage is sent afterwards
+offline_buffer = OfflineBuffer(
+    size=config['offline_buffer_size'],
+    spill_file='readings.buf',
+    spill_size=config['offline_buffer_spill_size'],
+)
+
+# When batching is enabled, readings from all sensors are also collected and sent together as a single
+# envelope message on the batch topic
+if config['batch'] is not None:
+    reading_batch = ReadingBatch(max_size=config['batch'].get('max_size', 1024))
+else:
+    reading_batch = None
+
+# All of the periodic sensor reads are run from here, sensors are read every 30 seconds unless they
+# have their own interval configured
+scheduler = Scheduler(tick=int(config['sensor_tick'] * 1000))
+
+# How long the broker takes to acknowledge each reading, which includes waiting out any wifi or broker
+# outage
+publish_span = metrics.span('mqtt_publish')
 
 gc.collect()
 
@@ -69,327 +70,138 @@ gc.collect()
 async def read_sensors(client):
     logger.log('Reading sensors...')
 
-    if sensor_dht22:
-        asyncio.create_task(_read_dht22(client=client))
-
-    if sensor_bme280:
-        asyncio.create_task(_read_bme280(client=client))
-
-    if sensor_sht30:
-        asyncio.create_task(_read_sht30(client=client))
-
-    if sensor_pms5003:
-        asyncio.create_task(_read_pms5003(client=client))
-
-    if sensor_ens160:
-        asyncio.create_task(_read_ens160(client=client))
-
-    if sensor_vl53l1x:
-        asyncio.create_task(_read_vl53l1x(client=client))
-
-
-
-async def _read_dht22(client):
-    global temperature_calibration
-    global humidity_calibration
-
-    sensor = dht.DHT22(Pin(sensor_dht22['rx_pin']))
-
-    while True:
-        try:
-            sensor.measure()
-
-            temperature = sensor.temperature()
-            humidity = sensor.humidity()
-            dew_point = calculate_dew_point(temperature=temperature, humidity=humidity)
-            timestamp = generate_timestamp()
+    asyncio.create_task(_publish_buffered_readings(client=client))
 
-            if sensor_ens160:
-                temperature_calibration = temperature
-                humidity_calibration = humidity
+    if reading_batch is not None:
+        scheduler.add('batch', config['batch'].get('interval', 60) * 1000, _flush_reading_batch)
 
-            logger.log(f'Sensor read at {timestamp}, new values: {temperature} & {humidity}%. Dew point is {dew_point}')
+    if config['metrics'] is not None:
+        scheduler.add('metrics', config['metrics'].get('interval', 300) * 1000, _publish_metrics)
 
-            current_data = {
-                "timestamp": timestamp,
-                "temperature": temperature,
-                "humidity": humidity
-            }
-
-            if sensor_dht22.get('enable_dew_point') is True:
-                current_data.update({
-                    'dew_point': dew_point
-                })
-
-            await publish_sensor_reading(reading=current_data, client=client, topic=sensor_dht22['topic'])
-
-            # The PMS5003 sensor is only read once every three minutes and the watchdog timeout when a PMS5003 is configured is
-            # ten minutes, so we need to skip the every-30-seconds WDT feed for this sensor if there is also a PMS5003 attached
-            if config['disable_watchdog'] is not True and not sensor_pms5003:
-                wdt.feed()
-
-        except Exception as e:
-            await logger.publish_error_message(error={'error': 'Failed to read sensor'}, exception=e, client=client)
-
-        gc.collect()
-        await asyncio.sleep(30)
-
-
-
-async def _read_bme280(client):
-    global temperature_calibration
-    global humidity_calibration
-
-    sensor = bme280.BME280(i2c=i2c, address=sensor_bme280['i2c_address'])
-
-    while True:
+    for (sensor, driver_class) in sensor_drivers:
         try:
-            (temperature, pressure, humidity) = sensor.read_compensated_data()
-            dew_point = sensor.dew_point
-            timestamp = generate_timestamp()
-
-            if sensor_ens160:
-                temperature_calibration = temperature
-                humidity_calibration = humidity
-
-            logger.log(f'Sensor read at {timestamp}, new values: {temperature}C, {humidity}%, and {pressure} Pa. Dew point is {dew_point}')
-
-            if sensor_bme280.get('enable_pressure_only') is True:
-                current_data = {
-                    "timestamp": timestamp,
-                    "pressure": pressure/100
-                }
-            else:
-                current_data = {
-                    "timestamp": timestamp,
-                    "temperature": temperature,
-                    "humidity": humidity,
-                }
-
-                if sensor_bme280['enable_additional_data'] is True:
-                    current_data.update({
-                        "dew_point": dew_point,
-                        "pressure": pressure/100
-                    })
-
-            await publish_sensor_reading(reading=current_data, client=client, topic=sensor_bme280['topic'])
-
-            # The PMS5003 sensor is only read once every three minutes and the watchdog timeout when a PMS5003 is configured is
-            # ten minutes, so we need to skip the every-30-seconds WDT feed for this sensor if there is also a PMS5003 attached
-            if config['disable_watchdog'] is not True and not sensor_pms5003:
-                wdt.feed()
-
+            driver = driver_class(sensor, i2c)
         except Exception as e:
-            await logger.publish_error_message(error={'error': 'Failed to read sensor'}, exception=e, client=client)
-
-        gc.collect()
-        await asyncio.sleep(30)
-
-
-
-async def _read_sht30(client):
-    global temperature_calibration
-    global humidity_calibration
-
-    sensor = sht30.SHT30(i2c=i2c, address=sensor_sht30['i2c_address'])
-
-    while True:
-        try:
-            (temperature, humidity) = sensor.measure()
-            dew_point = calculate_dew_point(temperature, humidity)
-            timestamp = generate_timestamp()
-
-            if sensor_ens160:
-                temperature_calibration = temperature
-                humidity_calibration = humidity
-
-            logger.log(f'Sensor read at {timestamp}, new values: {temperature}C, {humidity}%. Dew point is {dew_point}')
-
-            current_data = {
-                "timestamp": timestamp,
-                "temperature": temperature,
-                "humidity": humidity
-            }
+            await logger.publish_error_message(error={'error': f"Failed to set up {sensor['type']} sensor"}, exception=e, client=client)
+            continue
 
-            if sensor_sht30.get('enable_dew_point') is True:
-                current_data.update({'dew_point': dew_point})
+        # Only the sensors that are read least often feed the watchdog, otherwise the others would
+        # keep the board from restarting when one of those stops responding
+        driver.feeds_watchdog = driver.watchdog_timeout == watchdog_timeout and (driver.poll_interval is None or not interval_sensors)
 
-            await publish_sensor_reading(reading=current_data, client=client, topic=sensor_sht30['topic'])
+        # How long each read of the sensor and queueing up its reading take, see metrics.py
+        driver.read_span = metrics.span(f"read:{sensor['topic']}")
+        driver.publish_span = metrics.span(f"publish:{sensor['topic']}")
 
-            if sensor_sht30.get('enable_heater') is True:
-                is_heater_on = sensor.is_heater_on()
+        if driver.poll_interval is not None:
+            asyncio.create_task(_poll_sensor(client=client, driver=driver))
+        else:
+            interval = int(sensor.get('interval', driver.default_interval) * 1000)
 
-                HIGH_HUMIDITY = 95
+            try:
+                scheduler.add(sensor['topic'], interval, _read_sensor, client, driver)
+            except ValueError as e:
+                await logger.publish_error_message(error={'error': f"Invalid interval for {sensor['type']} sensor"}, exception=e, client=client)
 
-                if is_heater_on is None:
-                    sensor_status = sensor.status()
-                    await logger.publish_log_message(message={'message':f'Received unexpected response from heater status check: {sensor_status}'}, client=client)
+    await scheduler.run()
 
-                # Initial state of high humidity, heater not on, and hasn't been on in the last five minutes
-                if humidity > HIGH_HUMIDITY and sensor_sht30['heater_on_count'] == 0 and (timestamp - sensor_sht30['heater_enabled_at']) > 300000 and is_heater_on is False:
-                    await logger.publish_log_message(message={'message': f'Humidity is {humidity}, enabling heater'}, client=client)
 
-                    sensor.turn_heater_on()
-                    sensor_sht30['heater_on_count'] = sensor_sht30['heater_on_count'] + 1
-                    sensor_sht30.update({
-                        'heater_enabled_at': timestamp
-                    })
 
-                # Humidity has reduced so we can turn the heater off regardless of how long it's been on
-                elif humidity <= HIGH_HUMIDITY and is_heater_on is True:
-                    await logger.publish_log_message(message={'message': f'Humidity is {humidity}, disabling heater'}, client=client)
+async def _read_sensor(client, driver):
+    try:
+        start = driver.read_span.start()
+        reading = await driver.read(client)
+        driver.read_span.stop(start)
 
-                    sensor.turn_heater_off()
-                    sensor_sht30['heater_on_count'] = 0
+        if reading is not None:
+            start = driver.publish_span.start()
+            await publish_sensor_reading(reading=reading, client=client, topic=driver.topic, payload_format=driver.payload_format)
+            driver.publish_span.stop(start)
 
-                # Heater is on but humidity is still high and the maximum heater count hasn't been reached
-                elif humidity > HIGH_HUMIDITY and is_heater_on is True and 0 < sensor_sht30['heater_on_count'] < 5:
-                    await logger.publish_log_message(message={'message': f"Humidity is {humidity}, incrementing heater_on_count to {sensor_sht30['heater_on_count']}"}, client=client)
+        # A sensor that's being polled won't have anything to publish most of the time, but getting this
+        # far still means it's responding
+        elif driver.poll_interval is None:
+            return
 
-                    sensor_sht30['heater_on_count'] = sensor_sht30['heater_on_count'] + 1
-
-                # The heater is on and has been on for the last five readings so we'll turn it off again
-                elif is_heater_on is True and sensor_sht30['heater_on_count'] >= 5:
-                    await logger.publish_log_message(message={'message': f'Humidity is {humidity}, heater_on_count has reached 5, disabling heater'}, client=client)
-
-                    sensor.turn_heater_off()
-                    sensor_sht30['heater_on_count'] = 0
-
-            # The PMS5003 sensor is only read once every three minutes and the watchdog timeout when a PMS5003 is configured is
-            # ten minutes, so we need to skip the every-30-seconds WDT feed for this sensor if there is also a PMS5003 attached
-            if config['disable_watchdog'] is not True and not sensor_pms5003:
-                wdt.feed()
-
-        except Exception as e:
-            await logger.publish_error_message(error={'error': 'Failed to read sensor'}, exception=e, client=client)
+        if config['disable_watchdog'] is not True and driver.feeds_watchdog:
+            wdt.feed()
 
-        gc.collect()
-        await asyncio.sleep(30)
+    except Exception as e:
+        await logger.publish_error_message(error={'error': 'Failed to read sensor'}, exception=e, client=client)
 
 
 
-async def _read_pms5003(client):
+async def _poll_sensor(client, driver):
     while True:
-        try:
-            current_data = await pms5003.read_data(rx_pin=sensor_pms5003['rx_pin'])
-
-            if current_data is None:
-                await logger.publish_error_message(error={'error': 'No valid data'}, client=client)
-
-                continue
-
-            current_data['timestamp'] = generate_timestamp()
-
-            await publish_sensor_reading(reading=current_data, client=client, topic=sensor_pms5003['topic'])
-
-            if config['disable_watchdog'] is not True:
-                wdt.feed()
-
-        except Exception as e:
-            await logger.publish_error_message(error={'error': 'Failed to read sensor'}, exception=e, client=client)
-
-        await asyncio.sleep(180)
-        gc.collect()
+        await _read_sensor(client=client, driver=driver)
+        await asyncio.sleep_ms(driver.poll_interval)
 
 
 
-async def _read_ens160(client):
-    global temperature_calibration
-    global humidity_calibration
+async def publish_sensor_reading(reading, client, topic, payload_format='json'):
+    if reading_batch is None or config['batch'].get('per_sensor_topics', False) is True:
+        offline_buffer.put(topic, reading_format.encode(reading, payload_format))
 
-    sensor = ens160.ENS160(i2c=i2c, address=sensor_ens160['i2c_address'], temperature=temperature_calibration, humidity=humidity_calibration)
+    if reading_batch is not None and not reading_batch.add(topic, reading):
+        flush_reading_batch()
 
-    while True:
-        try:
-            (aqi, tvoc, eco2) = sensor.get_readings()
-            timestamp = generate_timestamp()
+        if not reading_batch.add(topic, reading):
+            logger.log(f'Reading for {topic} is larger than the batch max_size, leaving it out of the batch')
 
-            logger.log('Sensor read at {}. AQI {}, TVOC {}, ECO2 {}'.format(timestamp, aqi, tvoc, eco2))
 
-            if aqi == 0:
-                await logger.publish_log_message({'message': 'Received 0 reading for AQI, skipping'}, client=client)
-            else:
-                current_data = {
-                    'timestamp': timestamp,
-                    'aqi': aqi,
-                    'tvoc': tvoc,
-                    'eco2': eco2,
-                }
 
-                await publish_sensor_reading(reading=current_data, client=client, topic=sensor_ens160['topic'])
+def flush_reading_batch():
+    if len(reading_batch):
+        offline_buffer.put(config['batch']['topic'], reading_batch.flush())
 
-                # The PMS5003 sensor is only read once every three minutes and the watchdog timeout when a PMS5003 is configured is
-                # ten minutes, so we need to skip the every-30-seconds WDT feed for this sensor if there is also a PMS5003 attached
-                if config['disable_watchdog'] is not True and not sensor_pms5003:
-                    wdt.feed()
 
-        except Exception as e:
-            await logger.publish_error_message(error={'error': 'Failed to read sensor'}, exception=e, client=client)
 
-        gc.collect()
-        await asyncio.sleep(30)
+async def _flush_reading_batch():
+    flush_reading_batch()
 
 
 
-async def _read_vl53l1x(client):
-    sensor = vl53l1x.VL53L1X(i2c=i2c, address=sensor_vl53l1x['i2c_address'])
-
-    last_trigger = 0
-    triggered = False
+async def _publish_buffered_readings(client):
+    # Readings that have been sent and are waiting on the broker's acknowledgement, oldest first, as
+    # (topic, payload, when it was started, the task publishing it)
+    pending = []
 
     while True:
-        try:
-            distance = sensor.read()
-
-            if sensor.status != 'OK':
-                continue
-
-            timestamp = generate_timestamp()
-
-            # If the threshold is breached AND it's not currently triggered AND the last trigger timestamp is more than the ignore period, send a trigger message
-            if distance < sensor_vl53l1x['trigger_threshold_mm'] and triggered is False and (timestamp - last_trigger > (sensor_vl53l1x['ignore_trigger_period'] * 1000)):
-                await logger.publish_log_message({'message': 'Distance threshold breached'}, client=client)
-
-                await publish_sensor_reading(reading={'timestamp': timestamp, 'triggered': True}, client=client, topic=sensor_vl53l1x['topic'])
-
-                gc.collect()
+        # Keep up to max_inflight readings going at once rather than waiting for each acknowledgement in
+        # turn, but don't wait on new readings while there are acknowledgements to collect
+        if len(pending) < mqtt_config['max_inflight'] and (len(offline_buffer) or not pending):
+            topic, payload = await offline_buffer.__anext__()
 
-                last_trigger = timestamp
-                triggered = True
+            # This waits out any wifi or broker outage and republishes after reconnecting until the
+            # broker acknowledges the reading, so nothing taken while offline is lost
+            task = asyncio.create_task(client.publish(topic, payload, qos=1, retain=True))
+            pending.append((topic, payload, publish_span.start(), task))
 
-            # If the threshold is breached but it's already been triggered, update the last trigger timestamp so the ignore period remains current
-            elif distance < sensor_vl53l1x['trigger_threshold_mm'] and triggered is True:
-                last_trigger = timestamp
+            continue
 
-            # If the threshold is no longer breached AND it's currently triggered AND the last trigger time is greater than the ignore period, reset back to false
-            elif distance > sensor_vl53l1x['trigger_threshold_mm'] and triggered is True and (last_trigger < timestamp - (sensor_vl53l1x['ignore_trigger_period'] * 1000)):
-                await logger.publish_log_message({'message': 'Distance threshold not breached in last period, resetting trigger'}, client=client)
-
-                await publish_sensor_reading(reading={'timestamp': timestamp, 'triggered': False}, client=client, topic=sensor_vl53l1x['topic'])
-
-                triggered = False
+        topic, payload, start, task = pending.pop(0)
 
+        try:
+            await task
+        except MQTTException as e:
+            # The reading can never be sent, such as when it's too large
+            await logger.publish_error_message(error={'error': f'Failed to publish reading to {topic}, discarding it'}, exception=e, client=client)
         except Exception as e:
-            await logger.publish_error_message(error={'error': 'Failed to read sensor'}, exception=e, client=client)
-
-        await asyncio.sleep_ms(50)
-
-
-
-def generate_timestamp():
-    return (time.time() + 946684800) * 1000
-
-
+            offline_buffer.put_back(topic, payload)
 
-async def publish_sensor_reading(reading, client, topic):
-    await client.publish(topic, json.dumps(reading), qos=1, retain=True)
+            await logger.publish_error_message(error={'error': f'Failed to publish reading to {topic}, will retry'}, exception=e, client=client)
+            await asyncio.sleep(1)
+        else:
+            publish_span.stop(start)
+            await boot_profile.publish(client, phase='first_publish')
 
 
 
-# Thanks to https://gist.github.com/sourceperl/45587ea99ff123745428?permalink_comment_id=5119362#gistcomment-5119362
-def calculate_dew_point(temperature, humidity):
-    a = 17.625
-    b = 243.04
-    alpha = log(humidity/100.0) + ((a * temperature) / (b + temperature))
+async def _publish_metrics():
+    offline_buffer.put(config['metrics']['topic'], json.dumps({
+        'timestamp': logger.get_current_time(),
+        'metrics': metrics.stats(),
+    }))
 
-    return (b * alpha) / (a - alpha)
+    if config['metrics'].get('reset', False) is True:
+        metrics.reset()
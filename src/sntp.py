@@ -0,0 +1,269 @@
+import time
+import errno
+import socket
+import struct
+import asyncio
+from machine import RTC
+import logger
+
+# Seconds between 1900 (the NTP epoch) and 1970
+NTP_DELTA = 2208988800
+# Older MicroPython ports count time.time() from 2000 rather than 1970
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+# Samples taken on each sync, of which the one with the lowest round trip delay is used since it's the
+# least affected by queueing along the way
+SAMPLES = 4
+SAMPLE_TIMEOUT = 1000
+# Corrections are spread out rather than applied at once, adjusting the clock by at most 1ms for
+# every 2000ms that pass (500ppm) so timestamps never jump backwards. The clock is only ever stepped
+# if it's behind by more than this many milliseconds.
+SLEW_DIVISOR = 2000
+STEP_THRESHOLD = 1000
+MAX_DRIFT_PPM = 500
+# The time between syncs doubles while the clock is staying within TRACKING_MS of the server, and
+# halves again if it falls further behind than that, between these limits in seconds
+MIN_INTERVAL = 3600
+MAX_INTERVAL = 86400
+UNSYNCED_INTERVAL = 60
+TRACKING_MS = 50
+
+host = 'pool.ntp.org'
+
+_addr = None
+_packet = bytearray(48)
+_synced = False
+_last = 0
+_last_sync = None
+
+# Corrected time is the RTC time plus an offset. At the last sync the offset was _offset, and since
+# then _slew is gradually being added on top of that while the estimated drift of the RTC is added
+# continuously.
+_ref = 0
+_offset = 0
+_slew = 0
+_drift = 0
+
+# Milliseconds since 1970 according to the corrected clock, which never goes backwards
+def time_ms():
+    global _last
+
+    now = _rtc_ms()
+    elapsed = now - _ref
+    max_slew = elapsed // SLEW_DIVISOR
+    slew = min(max(_slew, -max_slew), max_slew)
+
+    t = now + _offset + slew + int(elapsed * _drift / 1000000)
+
+    if t < _last:
+        t = _last
+
+    _last = t
+
+    return t
+
+
+
+# Set the RTC to the time from the NTP server in one step. This is done once at boot before any
+# readings have been taken (or on the first successful sync if that fails), so it's the only time the
+# clock is allowed to go backwards.
+async def settime():
+    global _last, _last_sync, _synced, _ref, _offset, _slew, _drift
+
+    (offset, delay) = await _measure()
+
+    _set_rtc(_rtc_ms() + offset)
+
+    _ref = _rtc_ms()
+    _offset = 0
+    _slew = 0
+    _drift = 0
+    _last = 0
+    _last_sync = (_ref, 0)
+    _synced = True
+
+    return (offset, delay)
+
+
+
+# Bring the corrected clock back in line with the NTP server by slewing it, and update the estimate of
+# how fast the RTC drifts. Returns the remaining error in milliseconds and the round trip delay.
+async def sync():
+    global _last_sync, _ref, _offset, _slew, _drift
+
+    if not _synced:
+        return await settime()
+
+    (measured, delay) = await _measure()
+
+    now = _rtc_ms()
+    correction = time_ms() - now
+    error = measured - correction
+
+    # The offset between the RTC and the server changes at the rate the RTC drifts, and averaging with
+    # the previous estimate smooths out the error of each measurement
+    (last_sync_time, last_sync_offset) = _last_sync
+
+    if now - last_sync_time >= MIN_INTERVAL * 1000:
+        drift = (measured - last_sync_offset) * 1000000 / (now - last_sync_time)
+        _drift = min(max(drift if _drift == 0 else (_drift + drift) / 2, -MAX_DRIFT_PPM), MAX_DRIFT_PPM)
+        _last_sync = (now, measured)
+
+    _ref = now
+    _offset = correction
+
+    if error > STEP_THRESHOLD:
+        _offset = measured
+        _slew = 0
+    else:
+        _slew = error
+
+    # Keep the RTC itself, and so the times in log messages, within a second of the corrected clock
+    if abs(_offset) >= 1000:
+        _set_rtc(now + _offset)
+
+        _ref += _offset
+        _last_sync = (_last_sync[0] + _offset, _last_sync[1] - _offset)
+        _offset = 0
+
+    return (error, delay)
+
+
+
+# Keep the clock in sync, adjusting how often based on how well it's tracking the server
+async def run(client):
+    interval = MIN_INTERVAL if _synced else UNSYNCED_INTERVAL
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            (error, delay) = await sync()
+
+            if abs(error) <= TRACKING_MS:
+                interval = min(max(interval * 2, MIN_INTERVAL), MAX_INTERVAL)
+            else:
+                interval = max(interval // 2, MIN_INTERVAL)
+
+            await logger.publish_log_message({
+                'message': f'Successfully synced with NTP server {host}',
+                'error_ms': error,
+                'delay_ms': delay,
+                'drift_ppm': int(_drift),
+                'next_sync_s': interval,
+            }, client=client)
+        except OSError as e:
+            if not _synced:
+                interval = UNSYNCED_INTERVAL
+
+            await logger.publish_error_message(error={'error': f'Failed to contact NTP server at {host}'}, exception=e, client=client)
+
+
+
+# Returns the offset in milliseconds between the RTC and the server, and the round trip delay, from
+# whichever sample had the lowest delay
+async def _measure():
+    global _addr
+
+    if _addr is None:
+        # This blocks while the lookup happens, so it's only done once unless the server stops responding
+        _addr = socket.getaddrinfo(host, 123)[0][-1]
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+
+    best = None
+
+    try:
+        for _ in range(SAMPLES):
+            try:
+                sample = await _sample(sock)
+            except OSError:
+                continue
+
+            if best is None or sample[1] < best[1]:
+                best = sample
+    finally:
+        sock.close()
+
+    if best is None:
+        _addr = None
+        raise OSError(errno.ETIMEDOUT, 'No response from NTP server')
+
+    return best
+
+
+
+async def _sample(sock):
+    packet = _packet
+
+    for i in range(48):
+        packet[i] = 0
+
+    # No leap indicator, version 4, client mode
+    packet[0] = 0x23
+
+    t1 = _rtc_ms()
+    _pack_ntp_time(packet, 40, t1)
+    sock.sendto(packet, _addr)
+
+    while True:
+        remaining = SAMPLE_TIMEOUT - (_rtc_ms() - t1)
+
+        if remaining <= 0:
+            raise OSError(errno.ETIMEDOUT, 'Timed out waiting for NTP response')
+
+        # Sleep until the reply arrives rather than checking the socket over and over
+        try:
+            await asyncio.wait_for_ms(_readable(sock), remaining)
+        except asyncio.TimeoutError:
+            raise OSError(errno.ETIMEDOUT, 'Timed out waiting for NTP response')
+
+        try:
+            response = sock.recv(48)
+            t4 = _rtc_ms()
+        except OSError as e:
+            if e.args[0] not in (errno.EAGAIN, errno.ETIMEDOUT):
+                raise
+
+            continue
+
+        # Skip anything that isn't a reply to this request from a synchronised server, such as a late
+        # reply to an earlier sample that timed out, and keep waiting for the right one
+        if len(response) >= 48 and response[0] & 0x07 == 4 and response[0] >> 6 != 3 and response[1] != 0 and _unpack_ntp_time(response, 24) == t1:
+            break
+
+    t2 = _unpack_ntp_time(response, 32)
+    t3 = _unpack_ntp_time(response, 40)
+
+    return (((t2 - t1) + (t3 - t4)) // 2, (t4 - t1) - (t3 - t2))
+
+
+
+# Suspend the task until sock has something to read, the same way mqtt.py waits on the broker
+async def _readable(sock):
+    yield asyncio.core._io_queue.queue_read(sock)
+
+
+
+def _rtc_ms():
+    return time.time_ns() // 1000000 + EPOCH_OFFSET * 1000
+
+
+
+def _set_rtc(t):
+    tm = time.gmtime(t // 1000 - EPOCH_OFFSET)
+    RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], (t % 1000) * 1000))
+
+
+
+def _pack_ntp_time(buf, offset, t):
+    # Round the fraction up so it comes back as the same number of milliseconds when it's unpacked
+    struct.pack_into('!II', buf, offset, t // 1000 + NTP_DELTA, (((t % 1000) << 32) + 999) // 1000)
+
+
+
+def _unpack_ntp_time(buf, offset):
+    (seconds, fraction) = struct.unpack_from('!II', buf, offset)
+
+    return (seconds - NTP_DELTA) * 1000 + ((fraction * 1000) >> 32)
@@ -0,0 +1,137 @@
+BLOCK_SIZE = 512
+
+# Entry types from the tar header
+REGULAR = '0'
+DIRECTORY = '5'
+PAX_HEADER = 'x'
+PAX_GLOBAL_HEADER = 'g'
+
+# Reads the entries of a tar archive one after another from a stream (such as a response being
+# decompressed as it's downloaded) without needing to seek or hold more than one block in memory
+class TarReader:
+    def __init__(self, stream):
+        self._stream = stream
+        self._header = bytearray(BLOCK_SIZE)
+        self._mv = memoryview(self._header)
+        self._remaining = 0
+        self._padding = 0
+        self._pax_path = None
+        # Any keywords from a global extended header, such as the commit hash GitHub adds as 'comment'
+        self.pax_global = {}
+
+    # Returns the (name, type, size) of the next file or directory, skipping over what's left of the
+    # current one, or None at the end of the archive
+    def next(self):
+        self._skip(self._remaining + self._padding)
+
+        while True:
+            if not self._read_exactly(self._mv):
+                return None
+
+            # The archive ends with two empty blocks
+            if self._header[0] == 0:
+                return None
+
+            name = self._field(0, 100)
+            size = int(self._field(124, 12) or '0', 8)
+            entry_type = chr(self._header[156]) if self._header[156] else REGULAR
+            prefix = self._field(345, 155) if self._header[257:262] == b'ustar' else ''
+
+            self._remaining = size
+            self._padding = -size % BLOCK_SIZE
+
+            if entry_type in (PAX_HEADER, PAX_GLOBAL_HEADER):
+                records = self._read_pax(size)
+
+                if entry_type == PAX_GLOBAL_HEADER:
+                    self.pax_global.update(records)
+                else:
+                    self._pax_path = records.get('path')
+
+                continue
+
+            if self._pax_path is not None:
+                name = self._pax_path
+                self._pax_path = None
+            elif prefix:
+                name = f'{prefix}/{name}'
+
+            return name, entry_type, size
+
+    # Read up to len(buf) bytes of the current entry into buf, returning how many were read
+    def readinto(self, buf):
+        n = min(len(buf), self._remaining)
+
+        if n == 0:
+            return 0
+
+        mv = memoryview(buf)[:n]
+
+        if not self._read_exactly(mv):
+            raise ValueError('Archive ended unexpectedly')
+
+        self._remaining -= n
+
+        return n
+
+    def _field(self, offset, length):
+        field = bytes(self._header[offset:offset + length])
+
+        return field.split(b'\0', 1)[0].decode().strip()
+
+    # Extended headers are a series of "<length> <keyword>=<value>\n" records
+    def _read_pax(self, size):
+        data = bytearray(size)
+
+        if not self._read_exactly(memoryview(data)):
+            raise ValueError('Archive ended unexpectedly')
+
+        self._remaining = 0
+        self._skip(self._padding)
+        self._padding = 0
+
+        data = bytes(data)
+        records = {}
+        pos = 0
+
+        while pos < size:
+            space = data.find(b' ', pos)
+
+            if space < 0:
+                break
+
+            length = int(data[pos:space])
+            keyword, value = data[space + 1:pos + length - 1].decode().split('=', 1)
+            records[keyword] = value
+            pos += length
+
+        return records
+
+    def _skip(self, n):
+        while n:
+            chunk = min(n, BLOCK_SIZE)
+
+            if not self._read_exactly(self._mv[:chunk]):
+                raise ValueError('Archive ended unexpectedly')
+
+            n -= chunk
+
+        self._remaining = 0
+        self._padding = 0
+
+    # Returns False if the stream ended before anything was read
+    def _read_exactly(self, mv):
+        pos = 0
+
+        while pos < len(mv):
+            n = self._stream.readinto(mv[pos:])
+
+            if not n:
+                if pos == 0:
+                    return False
+
+                raise ValueError('Archive ended unexpectedly')
+
+            pos += n
+
+        return True
@@ -3,11 +3,54 @@
 
 import os
 import gc
-from lib import mrequests
+import asyncio
+import json
+import hashlib
+from binascii import hexlify
+from lib.mrequests import amrequests
 from logger import publish_log_message
+import code_rollback
+from code_rollback import STAGING_DIR
+from tarball import TarReader, REGULAR
+
+# Seconds to wait for GitHub to respond or send more data before giving up on the update
+HTTP_TIMEOUT = 30
+# Archives are downloaded to here before being extracted
+ARCHIVE_FILE = '.archive'
+# The git blob SHA of every file that was last downloaded, keyed by its path, so only files that have
+# changed upstream need to be fetched and files that have been removed upstream can be deleted
+MANIFEST_FILE = '.manifest.json'
+
+# Returns the SHA-1 of a local file the same way git hashes blobs, which is what the GitHub contents API
+# returns for each file, or None if the file doesn't exist
+def git_blob_sha(filename, buf):
+    try:
+        size = os.stat(filename)[6]
+    except OSError:
+        return None
+
+    sha = hashlib.sha1('blob {}\0'.format(size).encode())
+    mv = memoryview(buf)
+
+    with open(filename, 'rb') as file:
+        while True:
+            n = file.readinto(buf)
+
+            if not n:
+                break
+
+            sha.update(mv[:n])
+
+    return hexlify(sha.digest()).decode()
+
+
 
 class Updater:
-    def __init__(self, username, repository, client, ref="main", api_token=None):
+    # mode is either 'api' to list the repository and fetch each file separately, or 'archive' to
+    # download the whole repository in one go from archive_url (a GitHub tarball of ref by default)
+    def __init__(self, username, repository, client, ref="main", api_token=None, mode='api', archive_url=None):
+        self.mode = mode
+        self.archive_url = archive_url or 'https://api.github.com/repos/{}/{}/tarball/{}'.format(username, repository, ref)
         self.api_repository_contents_url = 'https://api.github.com/repos/{}/{}/contents/src?ref={}'.format(username, repository, ref)
         self.api_commits_url = 'https://api.github.com/repos/{}/{}/commits?per_page=1&sha={}'.format(username, repository, ref)
         self.headers = {
@@ -18,40 +61,96 @@ class Updater:
             self.headers[b'Authorization'] = 'token {}'.format(api_token)
 
         self.client = client
+        # Requests to the same host one after another reuse the same connection, rather than each
+        # needing a new TLS handshake. Everything is downloaded with asyncio streams so the MQTT client
+        # and sensor readings carry on while waiting for GitHub.
+        # Nothing else stops a stalled download now the watchdog is still being fed during it, so give
+        # up on any request that goes this long without the server sending anything
+        self.session = amrequests.Session(headers=self.headers, timeout=HTTP_TIMEOUT)
+        self.buf = bytearray(1024)
+        self.manifest = {}
+        self.seen = set()
+        self.staged = []
+        self.complete = True
+        self.fetched = 0
+        self.unchanged = 0
+        self.commit_hash = None
 
     async def _get_repository_contents(self, api_repository_contents_url):
         await publish_log_message(message={'message': 'Getting repository contents from {}'.format(api_repository_contents_url)}, client=self.client)
 
         gc.collect()
 
-        response = mrequests.get(api_repository_contents_url, headers=self.headers)
+        response = await self.session.get(api_repository_contents_url)
 
         if response.status_code == 200:
-            json = response.json()
-            response.close()
+            await self._process_listing(response, '')
+        else:
+            self.complete = False
+
+            await publish_log_message(message={'error': 'Failed to get repository contents, status code was {}'.format(response.status_code)}, client=self.client)
+            await response.close()
 
             gc.collect()
 
-            for file in json:
-                await self._process_item(file)
-        else:
-            publish_log_message(message={'error': 'Failed to get repository contents, status code was {}'.format(response.status_code)}, client=self.client)
-            response.close()
 
-            gc.collect()
 
+    # Go through a directory listing one entry at a time as it's downloaded, rather than reading the
+    # whole listing into memory first. Only the details needed to fetch changed files and
+    # subdirectories are kept, and they're fetched once the listing has been read to the end so the
+    # connection is free to be reused for them.
+    async def _process_listing(self, response, path):
+        changed = []
+        dirs = []
+
+        try:
+            async for file in response.iter_json_array():
+                self._process_item(file, path, changed, dirs)
+                file = None
+        finally:
+            await response.close()
+
+        gc.collect()
+
+        for url, filename, sha, size in changed:
+            await self._get_file(url, filename, sha, size)
+
+        for url, dir_name in dirs:
+            await self._get_dir(url, dir_name)
 
 
-    async def _process_item(self, file):
+
+    def _process_item(self, file, path, changed, dirs):
         if file['type'] == 'file':
-            await self._get_file(file['download_url'], file['name'])
+            filename = path + file['name']
+            self.seen.add(filename)
+
+            if self._is_unchanged(filename, file['sha'], file['size']):
+                self.manifest[filename] = file['sha']
+                self.unchanged += 1
+            else:
+                changed.append((file['download_url'], filename, file['sha'], file['size']))
 
         if file['type'] == 'dir':
-            await self._get_dir(file['url'], file['name'])
+            dirs.append((file['url'], path + file['name']))
+
+
 
+    # The manifest and the file's size are enough to go on if they both match, otherwise the file is
+    # hashed in case it's the same as upstream but missing from the manifest
+    def _is_unchanged(self, filename, sha, size):
+        if self.manifest.get(filename) == sha:
+            try:
+                if os.stat(filename)[6] == size:
+                    return True
+            except OSError:
+                return False
 
+        return git_blob_sha(filename, self.buf) == sha
 
-    async def _get_file(self, url, filename):
+
+
+    async def _get_file(self, url, filename, sha, size):
         gc.collect()
 
         await publish_log_message(message={
@@ -61,30 +160,43 @@ class Updater:
 
         gc.collect()
 
-        buf = bytearray(1024)
-
-        response = mrequests.get(url, headers=self.headers)
+        response = await self.session.get(url)
 
         gc.collect()
 
         if response.status_code == 200:
             gc.collect()
 
-            response.save(filename, buf=buf)
+            # Nothing is changed on the board itself until every file has been downloaded and checked
+            staged_filename = '{}/{}'.format(STAGING_DIR, filename)
+            code_rollback.make_dirs(staged_filename)
+
+            await response.save(staged_filename, buf=self.buf)
 
             gc.collect()
 
-            await publish_log_message(message={
-                'message': 'Sucessfully saved {}'.format(filename),
-                'mem_free': gc.mem_free(),
-                }, client=self.client)
+            if os.stat(staged_filename)[6] == size and git_blob_sha(staged_filename, self.buf) == sha:
+                self.staged.append(filename)
+                self.manifest[filename] = sha
+                self.fetched += 1
+
+                await publish_log_message(message={
+                    'message': 'Sucessfully saved {}'.format(filename),
+                    'mem_free': gc.mem_free(),
+                    }, client=self.client)
+            else:
+                self.complete = False
+
+                await publish_log_message(message={'error': 'Downloaded {} does not match its size or SHA'.format(filename)}, client=self.client)
 
             gc.collect()
 
         else:
+            self.complete = False
+
             await publish_log_message(message={'error': 'Failed to get {}, status code was {}'.format(filename, response.status_code)}, client=self.client)
 
-        response.close()
+        await response.close()
         gc.collect()
 
 
@@ -94,23 +206,166 @@ class Updater:
 
         gc.collect()
 
-        response = mrequests.get(url, headers=self.headers)
-        json = response.json()
-        response.close()
+        response = await self.session.get(url)
+
+        if response.status_code != 200:
+            self.complete = False
+
+            await publish_log_message(message={'error': 'Failed to get directory {}, status code was {}'.format(dir_name, response.status_code)}, client=self.client)
+            await response.close()
+
+            return
+
+        await self._process_listing(response, dir_name + '/')
+
+
+
+    # Returns the files from the last update that are no longer in the repository
+    async def _get_removed_files(self):
+        removed = [filename for filename in self.manifest if filename not in self.seen]
+
+        for filename in removed:
+            del self.manifest[filename]
+
+            await publish_log_message(message={'message': 'Deleting {}'.format(filename)}, client=self.client)
+
+        return removed
+
+
+
+    def _read_manifest(self):
+        try:
+            with open(MANIFEST_FILE, 'r') as file:
+                self.manifest = json.load(file)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+
+
+    def _write_manifest(self):
+        with open('{}/{}'.format(STAGING_DIR, MANIFEST_FILE), 'w') as file:
+            json.dump(self.manifest, file)
+
+        self.staged.append(MANIFEST_FILE)
+
+
+
+    # Downloads a .tar.gz (or uncompressed .tar) of the repository to ARCHIVE_FILE, then extracts the
+    # files under its src directory into STAGING_DIR a block at a time, so only one request is needed and
+    # the archive never has to fit in memory. The download is saved to flash first because decompressing
+    # can only read from a stream that blocks, which would hold up everything else while waiting on the
+    # network. The src directory can either be at the top of the archive or inside a single top-level
+    # directory, which is how GitHub lays out tarballs.
+    async def _get_archive(self, url):
+        await publish_log_message(message={'message': 'Getting repository archive from {}'.format(url)}, client=self.client)
 
         gc.collect()
 
+        # GitHub redirects tarball requests to codeload.github.com
+        response = await self.session.get(url, max_redirects=2)
+
         try:
-            os.mkdir(dir_name)
-        except:
-            pass
+            if response.status_code != 200:
+                self.complete = False
 
-        os.chdir(dir_name)
+                await publish_log_message(message={'error': 'Failed to get repository archive, status code was {}'.format(response.status_code)}, client=self.client)
 
-        for file in json:
-            await self._process_item(file)
+                return
 
-        os.chdir('..')
+            size = await response.save(ARCHIVE_FILE, buf=self.buf)
+        finally:
+            await response.close()
+            gc.collect()
+
+        await publish_log_message(message={
+            'message': 'Downloaded {} bytes, extracting...'.format(size),
+            'mem_free': gc.mem_free(),
+            }, client=self.client)
+
+        try:
+            with open(ARCHIVE_FILE, 'rb') as file:
+                stream = file if url.endswith('.tar') else self._decompress(file)
+                tar = TarReader(stream)
+
+                while True:
+                    entry = tar.next()
+
+                    if entry is None:
+                        break
+
+                    name, entry_type, size = entry
+                    parts = name.split('/')
+
+                    if parts[0] != 'src':
+                        parts = parts[1:]
+
+                    if entry_type != REGULAR or len(parts) < 2 or parts[0] != 'src':
+                        continue
+
+                    await self._extract_file(tar, '/'.join(parts[1:]), size)
+
+                # GitHub stores the commit the tarball was made from in the archive's global header
+                if 'comment' in tar.pax_global:
+                    self.commit_hash = tar.pax_global['comment'][0:7]
+        finally:
+            os.remove(ARCHIVE_FILE)
+            gc.collect()
+
+
+
+    def _decompress(self, stream):
+        try:
+            import deflate
+
+            return deflate.DeflateIO(stream, deflate.GZIP)
+        except ImportError:
+            # MicroPython before 1.21
+            import zlib
+
+            return zlib.DecompIO(stream, 31)
+
+
+
+    # Write a file from the archive into STAGING_DIR, hashing it at the same time, then only keep it if
+    # it's different from what's on the board
+    async def _extract_file(self, tar, filename, size):
+        self.seen.add(filename)
+
+        staged_filename = '{}/{}'.format(STAGING_DIR, filename)
+        code_rollback.make_dirs(staged_filename)
+
+        sha = hashlib.sha1('blob {}\0'.format(size).encode())
+        mv = memoryview(self.buf)
+
+        with open(staged_filename, 'wb') as file:
+            while True:
+                n = tar.readinto(self.buf)
+
+                if not n:
+                    break
+
+                sha.update(mv[:n])
+                file.write(mv[:n])
+
+        sha = hexlify(sha.digest()).decode()
+
+        # Compared against the manifest from the last update, so it's only recorded once the check is done
+        if self._is_unchanged(filename, sha, size):
+            os.remove(staged_filename)
+            self.manifest[filename] = sha
+            self.unchanged += 1
+
+            # Let everything else run between files, since nothing else here waits on anything
+            await asyncio.sleep(0)
+        else:
+            self.staged.append(filename)
+            self.manifest[filename] = sha
+            self.fetched += 1
+
+            await publish_log_message(message={
+                'message': 'Extracted {}'.format(filename),
+                'mem_free': gc.mem_free(),
+                }, client=self.client)
 
 
 
@@ -119,23 +374,81 @@ class Updater:
 
         gc.collect()
 
-        response = mrequests.get(api_commits_url, headers=self.headers)
-        json = response.json()
-        response.close()
+        response = await self.session.get(api_commits_url)
 
-        gc.collect()
+        try:
+            if response.status_code != 200:
+                self.complete = False
 
-        commit_hash = json[0]['sha'][0:7]
+                await publish_log_message(message={'error': 'Failed to get latest commit hash, status code was {}'.format(response.status_code)}, client=self.client)
+
+                return
+
+            commits = await response.json()
+        finally:
+            await response.close()
+            gc.collect()
+
+        commit_hash = commits[0]['sha'][0:7]
 
         gc.collect()
 
+        await self._write_commit_hash(commit_hash)
+
+
+
+    async def _write_commit_hash(self, commit_hash):
         await publish_log_message(message={'message': 'Latest commit hash is {}, writing to .version file...'.format(commit_hash)}, client=self.client)
 
-        with open('.version', 'w') as file:
+        with open('{}/.version'.format(STAGING_DIR), 'w') as file:
             file.write(commit_hash)
 
+        self.staged.append('.version')
+
 
 
+    # Downloads every changed file into STAGING_DIR, then swaps them all in at once and deletes any files
+    # that were removed upstream. If anything couldn't be downloaded, nothing on the board is changed and
+    # False is returned. The new code is rolled back if it doesn't come online (see code_rollback).
     async def update(self):
-        await self._get_repository_contents(self.api_repository_contents_url)
-        await self._write_version_file(self.api_commits_url)
+        try:
+            return await self._update()
+        finally:
+            await self.session.close()
+
+
+
+    async def _update(self):
+        self._read_manifest()
+
+        code_rollback.remove_dir(STAGING_DIR)
+        os.mkdir(STAGING_DIR)
+
+        if self.mode == 'archive':
+            await self._get_archive(self.archive_url)
+        else:
+            await self._get_repository_contents(self.api_repository_contents_url)
+
+        if not self.complete:
+            code_rollback.remove_dir(STAGING_DIR)
+            return False
+
+        removed = await self._get_removed_files()
+
+        # Archives that don't say which commit they're from leave the .version file as it was
+        if self.commit_hash is not None:
+            await self._write_commit_hash(self.commit_hash)
+        elif self.mode != 'archive':
+            await self._write_version_file(self.api_commits_url)
+
+            if not self.complete:
+                code_rollback.remove_dir(STAGING_DIR)
+                return False
+
+        self._write_manifest()
+
+        await publish_log_message(message={'message': 'Fetched {} changed files, {} were unchanged, swapping them in...'.format(self.fetched, self.unchanged)}, client=self.client)
+
+        code_rollback.commit(self.staged, removed)
+
+        return True
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Measures how much memory mrequests allocates while saving a response, comparing Response.saveinto()
+# without a buffer (a new bytes object for every read) against passing it a preallocated buffer that's
+# read into over and over, for both chunked responses and ones with a Content-Length. With no URL a
+# local HTTP server is started to download from (CPython only). Given a URL, it can also be run with the
+# MicroPython unix port or on the board itself with `mpremote run` once src/lib is copied across:
+#
+#   python tools/bench_http_alloc.py [response size in KB, default 256] [url]
+#
+# Each download is run several times, and for each one the buffers allocated to hold data read from the
+# socket and the memoryviews made onto buffers are counted, along with the total size of those buffers,
+# by standing in for the socket's file object and for the file the response is saved to. Every one of
+# these is a separate allocation, and the counts are the same on every run. Reading into part of the
+# buffer, such as a 1000 byte chunk into a 1024 byte buffer, makes a memoryview for each read on CPython,
+# which MicroPython doesn't need since its readinto() takes a length. On MicroPython the total number of
+# bytes allocated by everything, as measured with gc.mem_alloc() while the garbage collector is disabled,
+# is shown as well. CPython has no equivalent, since it frees most objects as soon as they're finished
+# with and doesn't keep a running count of allocations.
+
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib.mrequests.mrequests import MICROPY, Session  # noqa: E402
+
+BUF_SIZE = 1024
+CHUNK_SIZE = 1000
+ITERATIONS = 5
+
+
+# Counts the buffers and memoryviews that pass through it. A memoryview that's been seen before, such as
+# one mrequests keeps to read a byte at a time, isn't counted again.
+class Counter:
+    def __init__(self):
+        self.buffers = 0
+        self.buffer_bytes = 0
+        self.views = 0
+        self._seen = []
+
+    def buffer(self, data):
+        self.buffers += 1
+        self.buffer_bytes += len(data)
+
+        return data
+
+    def view(self, buf):
+        if isinstance(buf, memoryview) and not any(v is buf for v in self._seen):
+            # Keep hold of it so a later view can't reuse its memory and look like the same one
+            self._seen.append(buf)
+            self.views += 1
+
+
+# Stands in for the socket's file object, counting every read that returns a new buffer
+class CountingFile:
+    def __init__(self, f, counter):
+        self.f = f
+        self.counter = counter
+
+    def read(self, *args):
+        return self.counter.buffer(self.f.read(*args))
+
+    def readline(self, *args):
+        return self.counter.buffer(self.f.readline(*args))
+
+    def readinto(self, buf, *args):
+        self.counter.view(buf)
+
+        return self.f.readinto(buf, *args)
+
+
+# Stands in for a file so only the allocations made by mrequests are counted
+class NullWriter:
+    def __init__(self, counter):
+        self.counter = counter
+        self.written = 0
+
+    def write(self, data):
+        self.counter.view(data)
+        self.written += len(data)
+        return len(data)
+
+
+def start_server(size):
+    import http.server
+    import socketserver
+    import threading
+
+    body = b'x' * size
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.send_response(200)
+
+            if self.path == '/chunked':
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                for i in range(0, size, CHUNK_SIZE):
+                    chunk = body[i:i + CHUNK_SIZE]
+                    self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+
+                self.wfile.write(b'0\r\n\r\n')
+            else:
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+
+    return base + '/chunked', base + '/length'
+
+
+def run(session, url, buf):
+    counter = Counter()
+    writer = NullWriter(counter)
+    response = session.get(url)
+    sf = response._sf
+    response._sf = CountingFile(sf, counter)
+    allocated = None
+
+    if MICROPY:
+        gc.collect()
+        gc.disable()
+        start = gc.mem_alloc()
+        response.saveinto(writer, buf)
+        allocated = gc.mem_alloc() - start
+        gc.enable()
+    else:
+        response.saveinto(writer, buf)
+
+    # Put the real file object back before the connection goes back to the session
+    response._sf = sf
+    response.close()
+
+    return (counter.buffers, counter.buffer_bytes, counter.views, allocated), writer.written
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 256 * 1024
+
+    if len(sys.argv) > 2:
+        urls = [sys.argv[2]]
+    else:
+        urls = start_server(size)
+
+    buf = bytearray(BUF_SIZE)
+
+    print(f"{'url':<40} {'buffer':<8} {'bytes saved':>12} {'buffers':>8} {'bytes':>10} {'views':>8} {'mem_alloc':>10} {'runs':>5}")
+
+    with Session() as session:
+        for url in urls:
+            for name, b in (('none', None), (str(BUF_SIZE), buf)):
+                results = set()
+
+                for _ in range(ITERATIONS):
+                    counts, written = run(session, url, b)
+                    results.add(counts)
+
+                # Anything that differed between runs is shown as the range it varied over
+                columns = [
+                    str(min(c)) if min(c) == max(c) else f'{min(c)}-{max(c)}'
+                    for c in zip(*[[-1 if n is None else n for n in r] for r in results])
+                ]
+                columns = ['-' if c == '-1' else c for c in columns]
+
+                print(f'{url:<40} {name:<8} {written:>12} {columns[0]:>8} {columns[1]:>10} {columns[2]:>8} {columns[3]:>10} {ITERATIONS:>5}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Compares making a series of small GET requests with mrequests.get(), which opens a new connection for
+# every request, against a mrequests.Session, which keeps the connection open and reuses it. With no URL
+# a local HTTP server is started to make the requests against (CPython only). Given a URL, it can also
+# be run with the MicroPython unix port, or on the board itself with `mpremote run` once src/lib is
+# copied across, which is where the TLS handshakes saved on https URLs really show up:
+#
+#   python tools/bench_http_keepalive.py [number of requests, default 50] [url]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib import mrequests  # noqa: E402
+from lib.mrequests.mrequests import Session  # noqa: E402
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+def start_server():
+    import http.server
+    import socketserver
+    import threading
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+        connections = 0
+
+        def setup(self):
+            Handler.connections += 1
+            super().setup()
+
+        def do_GET(self):
+            body = b'x' * 512
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f'http://127.0.0.1:{server.server_address[1]}/', Handler
+
+
+def run(get, url, count):
+    start = ticks_us()
+
+    for _ in range(count):
+        response = get(url)
+        response.content
+        response.close()
+
+    return ticks_diff(ticks_us(), start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    handler = None
+
+    if len(sys.argv) > 2:
+        url = sys.argv[2]
+    else:
+        url, handler = start_server()
+
+    print(f'{count} GET requests to {url}')
+    print(f"{'client':<10} {'total ms':>10} {'per request ms':>15} {'connections':>12}")
+
+    for name in ('mrequests', 'Session'):
+        if handler is not None:
+            handler.connections = 0
+
+        if name == 'Session':
+            with Session() as session:
+                elapsed = run(session.get, url, count)
+        else:
+            elapsed = run(mrequests.get, url, count)
+
+        connections = handler.connections if handler is not None else '-'
+        print(f'{name:<10} {elapsed / 1000:>10.1f} {elapsed / 1000 / count:>15.2f} {connections:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# Measures how quickly the MQTT client gets QoS 1 publishes acknowledged by a broker that takes a while to
+# reply, publishing from a loop that keeps as many publishes going as the client allows, the same as the
+# task that sends sensor readings from the offline buffer. The stand-in broker acknowledges each PUBLISH
+# after a random delay around the round trip time, so acknowledgements often come back in a different
+# order to the publishes and have to be matched up by packet ID. For each approach it reports publishes
+# per second, the median and 99th percentile time from calling publish() to it returning, how many
+# acknowledgements arrived out of order, and how many socket writes each PUBLISH took, any of which can
+# go out as a TCP segment of its own.
+#
+# The old approach is one publish at a time, each written a field at a time and checked for its
+# acknowledgement every 100ms, which is how the client worked before max_inflight was added. It's also
+# run with Nagle's algorithm left on, which holds back each PUBLISH until the one before it has been
+# acknowledged by TCP. CPython only:
+#
+#   python tools/bench_mqtt_publish.py [publishes, default 200] [round trip ms, default 20]
+#
+# The MicroPython-only modules src/mqtt.py imports are stood in for the same way as in bench_mqtt_read.py.
+
+import asyncio
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from bench_mqtt_read import CountingSocket, install_micropython_modules, readable, writable  # noqa: E402
+
+TOPIC = 'home/outdoor/weather'
+PAYLOAD = b'{"timestamp": "2026-01-01T00:00:00Z", "temperature": 21.5, "humidity": 55.2}'
+
+
+# Also counts writes, and has the read() the client uses for the first byte of each packet
+class BrokerSocket(CountingSocket):
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.writes = 0
+
+    def read(self, n):
+        try:
+            return self.sock.recv(n)
+        except BlockingIOError:
+            return None
+
+    def write(self, buf):
+        self.writes += 1
+
+        return super().write(buf)
+
+
+# Acknowledges each QoS 1 PUBLISH after somewhere between half and one and a half times the round trip
+# time, and counts the ones acknowledged before a PUBLISH that arrived earlier
+class Broker:
+    def __init__(self, sock, rtt):
+        self.sock = sock
+        self.rtt = rtt
+        self.random = random.Random(1)
+        self.buffer = b''
+        self.last_acked = 0
+        self.out_of_order = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            data = await loop.sock_recv(self.sock, 4096)
+
+            if not data:
+                return
+
+            self.buffer += data
+
+            while self.packet():
+                pass
+
+    # Handles one whole packet from the buffer if there is one
+    def packet(self):
+        size = 0
+        shift = 0
+        i = 1
+
+        while True:
+            if i >= len(self.buffer):
+                return False
+
+            size |= (self.buffer[i] & 0x7F) << shift
+            shift += 7
+            i += 1
+
+            if not self.buffer[i - 1] & 0x80:
+                break
+
+        if len(self.buffer) < i + size:
+            return False
+
+        op = self.buffer[0]
+        body = self.buffer[i:i + size]
+        self.buffer = self.buffer[i + size:]
+
+        if op & 0xF0 == 0x30 and op & 6:
+            topic_length = struct.unpack_from('!H', body)[0]
+            pid = struct.unpack_from('!H', body, 2 + topic_length)[0]
+            delay = self.rtt * self.random.uniform(0.5, 1.5)
+            asyncio.get_running_loop().call_later(delay, self.ack, pid)
+
+        return True
+
+    def ack(self, pid):
+        if pid < self.last_acked:
+            self.out_of_order += 1
+
+        self.last_acked = max(self.last_acked, pid)
+        self.sock.send(struct.pack('!BBH', 0x40, 2, pid))
+
+
+# What _publish() did before each packet was put together in one buffer
+async def fieldwise_publish(client, topic, msg, retain, qos, dup, pid, properties=None):
+    import mqtt
+
+    topic, msg = mqtt.as_bytes(topic), mqtt.as_bytes(msg)
+    pkt = bytearray(4)
+    pkt[0] = 0x30 | qos << 1 | retain | dup << 3
+    i = mqtt.pack_len(pkt, 1, 2 + len(topic) + len(msg) + (2 if qos else 0))
+    await client._as_write(pkt, i)
+    await client._as_write(struct.pack('!H', len(topic)))
+    await client._as_write(topic)
+
+    if qos:
+        await client._as_write(struct.pack('!H', pid))
+
+    await client._as_write(msg)
+
+
+# What waiting for an acknowledgement did before wait_msg() woke the publishing task
+async def polling_await_ack(client, pid, evt):
+    import mqtt
+
+    t = mqtt.ticks_ms()
+
+    while pid in client._acks:
+        if client._timeout(t) or not client.isconnected():
+            return False
+
+        await asyncio.sleep(0.1)
+
+    return True
+
+
+def percentile(values, p):
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(name, count, rtt, max_inflight, old=False, nodelay=True):
+    import mqtt
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client_sock = socket.create_connection(listener.getsockname())
+    broker_sock, _ = listener.accept()
+    listener.close()
+
+    # Brokers such as Mosquitto turn off Nagle's algorithm so acknowledgements go out straight away, and
+    # _connect_broker() does the same on the client since each packet is sent with a single write
+    broker_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    if nodelay:
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    client_sock.setblocking(False)
+    broker_sock.setblocking(False)
+
+    client = mqtt.MQTTClient(dict(mqtt.config, server='localhost', response_time=10, max_inflight=max_inflight))
+    client._sock = sock = BrokerSocket(client_sock)
+    client._isconnected = True
+
+    if old:
+        client._publish = lambda *args, **kwargs: fieldwise_publish(client, *args, **kwargs)
+        client._await_ack = lambda pid, evt: polling_await_ack(client, pid, evt)
+
+    broker = Broker(broker_sock, rtt)
+    broker_task = asyncio.create_task(broker.run())
+    reader = asyncio.create_task(client._handle_msg())
+
+    async def timed_publish():
+        start = time.perf_counter()
+        await client.publish(TOPIC, PAYLOAD, qos=1, retain=True)
+
+        return time.perf_counter() - start
+
+    # Keep up to max_inflight publishes going, collecting them oldest first like the drain task in sensor.py
+    latencies = []
+    pending = []
+    started = 0
+    begin = time.perf_counter()
+
+    while len(latencies) < count:
+        if started < count and len(pending) < max_inflight:
+            pending.append(asyncio.create_task(timed_publish()))
+            started += 1
+            continue
+
+        latencies.append(await pending.pop(0))
+
+    elapsed = time.perf_counter() - begin
+
+    reader.cancel()
+    broker_task.cancel()
+    await asyncio.gather(reader, broker_task, return_exceptions=True)
+    client_sock.close()
+    broker_sock.close()
+
+    print(f'{name:<28} {count / elapsed:>10.1f} {percentile(latencies, 50) * 1000:>8.1f} '
+          f'{percentile(latencies, 99) * 1000:>8.1f} {broker.out_of_order:>8} {sock.writes / count:>8.1f}')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rtt = int(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+
+    install_micropython_modules()
+
+    import mqtt
+
+    mqtt._readable = readable
+    mqtt._writable = writable
+
+    print(f"{'publishing':<28} {'pubs/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'reorder':>8} {'writes':>8}")
+
+    asyncio.run(run('one at a time, 100ms polls', count, rtt, 1, old=True, nodelay=False))
+    asyncio.run(run('max_inflight 4, Nagle on', count, rtt, 4, nodelay=False))
+
+    for max_inflight in (1, 4, 8):
+        asyncio.run(run(f'max_inflight {max_inflight}', count, rtt, max_inflight))
+
+
+if __name__ == '__main__':
+    main()
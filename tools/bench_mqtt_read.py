@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Measures how many times the MQTT client tries to read from its socket for every byte it receives while
+# the broker is sending slowly, comparing the old _as_read() loop, which tried the socket again on every
+# pass of the scheduler with `await asyncio.sleep_ms(0)` in between, against the current one, which
+# sleeps until the socket has something to read. Every attempt that finds nothing is time the CPU spends
+# spinning instead of running the sensor tasks or dropping into light sleep. CPython only:
+#
+#   python tools/bench_mqtt_read.py [bytes to send, default 4096] [bytes per send, default 64] [ms between sends, default 5]
+#
+# src/mqtt.py is written for MicroPython, so the MicroPython-only modules it imports are stood in for
+# here with their CPython equivalents, and asyncio's I/O queue (which isn't available in CPython) with
+# the event loop's add_reader() and add_writer().
+
+import asyncio
+import binascii
+import errno
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+
+def module(name, **attributes):
+    m = types.ModuleType(name)
+    m.__dict__.update(attributes)
+    sys.modules[name] = m
+
+    return m
+
+
+def install_micropython_modules():
+    async def sleep_ms(ms):
+        await asyncio.sleep(ms / 1000)
+
+    async def wait_for_ms(aw, ms):
+        return await asyncio.wait_for(aw, ms / 1000)
+
+    class WLAN:
+        def __init__(self, *args):
+            pass
+
+        def active(self, *args):
+            return True
+
+        def isconnected(self):
+            return True
+
+    uasyncio = module('uasyncio', sleep_ms=sleep_ms, wait_for_ms=wait_for_ms)
+    uasyncio.__dict__.update({k: v for k, v in asyncio.__dict__.items() if not k.startswith('__')})
+
+    module('usocket', **socket.__dict__)
+    module('ustruct', **struct.__dict__)
+    module('ubinascii', **binascii.__dict__)
+    module('uerrno', **errno.__dict__)
+    module('micropython', const=lambda x: x)
+    module('machine', unique_id=lambda: b'bench')
+    module('network', WLAN=WLAN, STA_IF=0)
+    module('utime', **time.__dict__,
+           ticks_ms=lambda: time.monotonic_ns() // 1000000,
+           ticks_us=lambda: time.monotonic_ns() // 1000,
+           ticks_diff=lambda a, b: a - b)
+
+
+async def wait_fd(add, remove, sock):
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    add(sock.fileno(), lambda: ready.done() or ready.set_result(None))
+
+    try:
+        await ready
+    finally:
+        remove(sock.fileno())
+
+
+async def readable(sock):
+    loop = asyncio.get_running_loop()
+    await wait_fd(loop.add_reader, loop.remove_reader, sock)
+
+
+async def writable(sock):
+    loop = asyncio.get_running_loop()
+    await wait_fd(loop.add_writer, loop.remove_writer, sock)
+
+
+# A non-blocking socket that behaves like MicroPython's, returning None from readinto() when there's
+# nothing to read, and counts how many times it's read from
+class CountingSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.reads = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def readinto(self, buf, n):
+        self.reads += 1
+
+        try:
+            return self.sock.recv_into(buf, n)
+        except BlockingIOError:
+            return None
+
+    def write(self, buf):
+        try:
+            return self.sock.send(buf)
+        except BlockingIOError:
+            return None
+
+
+def send_slowly(sock, total, chunk_size, delay):
+    data = b'x' * chunk_size
+    sent = 0
+
+    while sent < total:
+        time.sleep(delay)
+        n = min(chunk_size, total - sent)
+        sock.sendall(data[:n])
+        sent += n
+
+
+# What _as_read() did before it waited for the socket to be readable
+async def polling_read(client, n, sock):
+    import mqtt
+
+    buffer = memoryview(bytearray(n))
+    size = 0
+    t = mqtt.ticks_ms()
+
+    while size < n:
+        if client._timeout(t) or not client.isconnected():
+            raise OSError(-1, 'Timeout on socket read')
+
+        msg_size = sock.readinto(buffer[size:], n - size)
+
+        if msg_size == 0:
+            raise OSError(-1, 'Connection closed by host')
+
+        if msg_size is not None:
+            size += msg_size
+            t = mqtt.ticks_ms()
+
+        await asyncio.sleep(0)
+
+    return buffer[:n]
+
+
+async def run(name, read, client, total, chunk_size, delay):
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    sock = CountingSocket(a)
+
+    sender = threading.Thread(target=send_slowly, args=(b, total, chunk_size, delay))
+    start = time.process_time()
+    sender.start()
+
+    await read(client, total, sock)
+
+    cpu = time.process_time() - start
+    sender.join()
+    a.close()
+    b.close()
+
+    print(f'{name:<16} {total:>8} {sock.reads:>8} {sock.reads / total:>10.3f} {cpu * 1000:>8.0f}')
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    delay = int(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.005
+
+    install_micropython_modules()
+
+    import mqtt
+
+    mqtt._readable = readable
+    mqtt._writable = writable
+
+    config = dict(mqtt.config, server='localhost', response_time=10)
+    client = mqtt.MQTTClient(config)
+    client._isconnected = True
+
+    async def current_read(client, n, sock):
+        return await client._as_read(n, sock, bytearray(n))
+
+    print(f"{'read loop':<16} {'bytes':>8} {'reads':>8} {'reads/byte':>10} {'cpu ms':>8}")
+
+    asyncio.run(run('sleep_ms(0) poll', polling_read, client, total, chunk_size, delay))
+    asyncio.run(run('wait readable', current_read, client, total, chunk_size, delay))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Compares the two ways BlockDevWriter can verify a firmware image once it's been written: reading the
+# whole device back in a separate pass when it's closed (verify=True), or reading each block back as
+# soon as it's written (verify="block"). A file stands in for the OTA partition. Runs with CPython or
+# the MicroPython unix port, or on the board itself with `mpremote run` once src/lib is copied across:
+#
+#   python tools/bench_ota_verify.py [image size in KB, default 1536]
+
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib.ota.blockdev_writer import BlockDevWriter  # noqa: E402
+
+BLOCK_SIZE = 4096
+DEVICE_FILE = 'bench_ota_verify.bin'
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+# Implements the parts of the os.AbstractBlockDev interface used by BlockDevWriter on top of a file,
+# counting the bytes read and written
+class FileBlockDev:
+    def __init__(self, path, blockcount):
+        self.blockcount = blockcount
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        with open(path, 'wb') as file:
+            file.write(b'\xff' * (BLOCK_SIZE * blockcount))
+
+        self.file = open(path, 'r+b')
+
+    def readblocks(self, block, buf, offset=0):
+        self.file.seek(block * BLOCK_SIZE + offset)
+        self.file.readinto(buf)
+        self.bytes_read += len(buf)
+
+    def writeblocks(self, block, buf, offset=None):
+        self.file.seek(block * BLOCK_SIZE + (offset or 0))
+        self.file.write(buf)
+        self.file.flush()
+        self.bytes_written += len(buf)
+
+    def ioctl(self, op, arg):
+        if op == 4:
+            return self.blockcount
+        if op == 5:
+            return BLOCK_SIZE
+        return 0
+
+    def close(self):
+        self.file.close()
+
+
+def run(verify, image):
+    device = FileBlockDev(DEVICE_FILE, len(image) // BLOCK_SIZE + 1)
+    writer = BlockDevWriter(device, verify=verify, verbose=False)
+    writer.set_sha_length(hashlib.sha256(image).digest().hex(), len(image))
+    mv = memoryview(image)
+
+    start = ticks_us()
+
+    for i in range(0, len(image), BLOCK_SIZE):
+        writer.write(mv[i:i + BLOCK_SIZE])
+
+    written = ticks_us()
+    writer.close()
+    closed = ticks_us()
+
+    device.close()
+    os.remove(DEVICE_FILE)
+
+    return (ticks_diff(written, start), ticks_diff(closed, written), device.bytes_read)
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 1536 * 1024
+    image = bytearray(os.urandom(size))
+
+    print(f'{size // 1024}KB image, {BLOCK_SIZE} byte blocks')
+    print(f"{'verify':<8} {'write ms':>10} {'close ms':>10} {'total ms':>10} {'bytes read':>12}")
+
+    for verify in (True, 'block'):
+        (write_us, close_us, bytes_read) = run(verify, image)
+        print(f'{str(verify):<8} {write_us / 1000:>10.1f} {close_us / 1000:>10.1f} {(write_us + close_us) / 1000:>10.1f} {bytes_read:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Checks that other asyncio tasks keep running while amrequests downloads something, which is what lets
+# the MQTT client keep sending its keepalive pings during a code update. A local HTTP server trickles a
+# response out slowly while a task stands in for the pings, ticking over every PING_INTERVAL ms, and the
+# number of pings that got through during the download is compared between mrequests, which blocks
+# everything until the download is finished, and amrequests (CPython only):
+#
+#   python tools/check_amrequests_keepalive.py [download time in ms, default 2000]
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib import mrequests  # noqa: E402
+from lib.mrequests import amrequests  # noqa: E402
+
+PING_INTERVAL = 100
+CHUNKS = 20
+CHUNK_SIZE = 1024
+
+
+def start_server(delay):
+    import http.server
+    import socketserver
+    import threading
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            for _ in range(CHUNKS):
+                time.sleep(delay)
+                self.wfile.write(b'%x\r\n' % CHUNK_SIZE + b'x' * CHUNK_SIZE + b'\r\n')
+
+            self.wfile.write(b'0\r\n\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+class Pinger:
+    def __init__(self):
+        self.pings = 0
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL / 1000)
+            self.pings += 1
+
+
+# Stands in for a file so nothing is kept
+class Discard:
+    def write(self, data):
+        return len(data)
+
+
+async def download_mrequests(url, buf):
+    response = mrequests.get(url)
+    size = response.saveinto(Discard(), buf)
+    response.close()
+
+    return size
+
+
+async def download_amrequests(url, buf):
+    response = await amrequests.get(url)
+    size = await response.saveinto(Discard(), buf)
+    await response.close()
+
+    return size
+
+
+async def check(name, download, url):
+    pinger = Pinger()
+    task = asyncio.create_task(pinger.run())
+    # Let the pinger get going before the download starts
+    await asyncio.sleep(0)
+
+    start = time.monotonic()
+    size = await download(url, bytearray(CHUNK_SIZE))
+    elapsed = time.monotonic() - start
+
+    task.cancel()
+    expected = int(elapsed * 1000 / PING_INTERVAL)
+
+    print(f'{name:<12} {size:>8} {elapsed * 1000:>10.0f} {pinger.pings:>8} {expected:>10}')
+
+    return pinger.pings, expected
+
+
+async def main():
+    duration = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    url = start_server(duration / 1000 / CHUNKS)
+
+    print(f"{'client':<12} {'bytes':>8} {'time ms':>10} {'pings':>8} {'expected':>10}")
+
+    await check('mrequests', download_mrequests, url)
+    pings, expected = await check('amrequests', download_amrequests, url)
+
+    if pings < expected - 1:
+        print('FAIL: pings were held up while amrequests was downloading')
+        sys.exit(1)
+
+    print('OK: pings carried on while amrequests was downloading')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# Checks that no sensor readings are lost or reordered while the broker is unreachable. Readings from
+# three sensors are queued into the offline buffer every 30 seconds of simulated time, through a 10 minute
+# outage, and published by the real drain task in src/sensor.py to a fake broker that records what it
+# receives. The buffer is kept small so most of the outage spills to flash. It also checks that readings
+# beyond what the spill file can hold are the only ones discarded, that spilled readings survive a
+# restart, and that a reading whose publish fails is put back and sent again. CPython only:
+#
+#   python tools/check_offline_buffer.py
+#
+# The modules src/sensor.py needs that only exist on MicroPython or on the board (such as machine and
+# config.json) are stood in for here.
+
+import asyncio
+import gc
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from bench_mqtt_read import install_micropython_modules, module  # noqa: E402
+
+TOPICS = ('home/indoor/weather', 'home/outdoor/weather', 'home/indoor/airquality')
+INTERVAL = 30
+OUTAGE = 600
+BUFFER_SIZE = 1024
+SPILL_SIZE = 16384
+MAX_INFLIGHT = 4
+
+
+def install_board_modules():
+    install_micropython_modules()
+
+    class Stub:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def feed(self):
+            pass
+
+    module('machine', Pin=Stub, WDT=Stub, I2C=Stub, unique_id=lambda: b'check')
+
+    # CPython's gc and time modules don't have MicroPython's mem_free() or ticks functions
+    gc.mem_free = lambda: 0
+    time.ticks_ms = lambda: time.monotonic_ns() // 1000000
+    time.ticks_us = lambda: time.monotonic_ns() // 1000
+    time.ticks_diff = lambda a, b: a - b
+
+    errors = []
+
+    async def publish_error_message(error, client, exception=None):
+        errors.append(error['error'])
+
+    async def publish_log_message(message, client, retain=False):
+        pass
+
+    module('logger', log=lambda message: None, errors=errors,
+           publish_error_message=publish_error_message,
+           publish_log_message=publish_log_message,
+           get_current_time=lambda: '2026-01-01T00:00:00Z')
+
+    import mqtt
+
+    mqtt.config['max_inflight'] = MAX_INFLIGHT
+
+    module('config', config={
+        'sensors': [],
+        'disable_watchdog': True,
+        'offline_buffer_size': BUFFER_SIZE,
+        'offline_buffer_spill_size': SPILL_SIZE,
+        'batch': None,
+        'sensor_tick': 1,
+        'metrics': None,
+    })
+
+
+# Stands in for MQTTClient.publish(): while the broker is down it waits for it to come back, and a
+# publish that's in flight when the connection drops is sent again afterwards, the same as the real
+# client does. fail_once lists payloads whose first publish raises an error that isn't an OSError.
+class FakeBroker:
+    def __init__(self, fail_once=()):
+        self.received = []
+        self.up = asyncio.Event()
+        self.up.set()
+        self.inflight = 0
+        self.max_seen_inflight = 0
+        self.fail_once = set(fail_once)
+
+    async def publish(self, topic, payload, retain=False, qos=0):
+        if payload in self.fail_once:
+            self.fail_once.discard(payload)
+            raise RuntimeError('Simulated publish failure')
+
+        while True:
+            await self.up.wait()
+
+            self.inflight += 1
+            self.max_seen_inflight = max(self.max_seen_inflight, self.inflight)
+
+            try:
+                # Round trip to the broker and back
+                await asyncio.sleep(0.002)
+            finally:
+                self.inflight -= 1
+
+            if self.up.is_set():
+                self.received.append((topic, payload))
+                return
+
+
+def reading(n, topic):
+    return f'{{"timestamp": {n * INTERVAL * 1000}, "topic": "{topic}", "temperature": 21.5}}'.encode()
+
+
+def check(name, condition, detail=''):
+    print(f"{'OK  ' if condition else 'FAIL'} {name}{': ' + detail if detail else ''}")
+
+    if not condition:
+        check.failed = True
+
+
+check.failed = False
+
+
+async def wait_for_drain(sensor, broker, expected, timeout=10):
+    start = time.monotonic()
+
+    while len(broker.received) < expected or len(sensor.offline_buffer):
+        if time.monotonic() - start > timeout:
+            break
+
+        await asyncio.sleep(0.01)
+
+
+# A 10 minute outage with readings every 30 seconds, the drain task publishing throughout
+async def outage(sensor, OfflineBuffer):
+    sensor.offline_buffer = OfflineBuffer(BUFFER_SIZE, spill_file='readings.buf', spill_size=SPILL_SIZE)
+    broker = FakeBroker()
+    task = asyncio.create_task(sensor._publish_buffered_readings(broker))
+    sent = []
+    steps = OUTAGE // INTERVAL
+
+    for step in range(steps * 3):
+        # Down for the middle third, with the connection dropping while readings are in flight
+        if step == steps:
+            broker.up.clear()
+        elif step == steps * 2:
+            spilled = sensor.offline_buffer._spill_count
+            broker.up.set()
+
+        for topic in TOPICS:
+            payload = reading(step, topic)
+            sensor.offline_buffer.put(topic, payload)
+            sent.append((topic, payload))
+
+        await asyncio.sleep(0.001)
+
+    await wait_for_drain(sensor, broker, len(sent))
+    task.cancel()
+
+    check('10 minute outage spilled readings to flash', spilled > 0, f'{spilled} readings on flash')
+    check('10 minute outage lost no readings', set(broker.received) == set(sent),
+          f'{len(sent)} sent, {len(set(broker.received))} received')
+    check('10 minute outage kept readings in order', broker.received == sent)
+    check('readings were pipelined', broker.max_seen_inflight > 1,
+          f'up to {broker.max_seen_inflight} in flight at once')
+    check('nothing was discarded', sensor.offline_buffer.discards == 0)
+
+
+# With the spill file too small for the whole outage, only the oldest readings are dropped
+async def spill_full(sensor, OfflineBuffer):
+    buffer = OfflineBuffer(BUFFER_SIZE, spill_file='readings.buf', spill_size=2048)
+    sent = []
+
+    for step in range(OUTAGE // INTERVAL):
+        for topic in TOPICS:
+            payload = reading(step, topic)
+            buffer.put(topic, payload)
+            sent.append((topic, payload))
+
+    sensor.offline_buffer = buffer
+    broker = FakeBroker()
+    task = asyncio.create_task(sensor._publish_buffered_readings(broker))
+    await wait_for_drain(sensor, broker, len(sent) - buffer.discards)
+    task.cancel()
+
+    received = set(broker.received)
+    lost = [item for item in sent if item not in received]
+
+    check('full spill file only drops what it counts as discarded', len(lost) == buffer.discards,
+          f'{buffer.discards} discarded, {len(lost)} missing')
+    check('what was received is still in order', broker.received == [item for item in sent if item in received])
+
+
+# Readings on flash are picked up again after a restart
+async def restart(sensor, OfflineBuffer):
+    buffer = OfflineBuffer(BUFFER_SIZE, spill_file='readings.buf', spill_size=SPILL_SIZE)
+
+    for step in range(OUTAGE // INTERVAL):
+        for topic in TOPICS:
+            buffer.put(topic, reading(step, topic))
+
+    spilled = buffer._spill_count
+    buffer = OfflineBuffer(BUFFER_SIZE, spill_file='readings.buf', spill_size=SPILL_SIZE)
+
+    check('spilled readings survive a restart', len(buffer) == spilled, f'{spilled} spilled, {len(buffer)} loaded')
+
+    buffer._remove_spill_file()
+
+
+# A reading whose publish raises is put back and sent again rather than lost
+async def publish_failure(sensor, OfflineBuffer):
+    sensor.offline_buffer = OfflineBuffer(BUFFER_SIZE, spill_file='readings.buf', spill_size=SPILL_SIZE)
+    sent = [(TOPICS[0], reading(step, TOPICS[0])) for step in range(10)]
+    broker = FakeBroker(fail_once=[sent[3][1]])
+    task = asyncio.create_task(sensor._publish_buffered_readings(broker))
+
+    for topic, payload in sent:
+        sensor.offline_buffer.put(topic, payload)
+
+    await wait_for_drain(sensor, broker, len(sent))
+    task.cancel()
+
+    check('a failed publish is put back and sent again', set(broker.received) == set(sent),
+          f'{len(sent)} sent, {len(set(broker.received))} received')
+
+
+async def run():
+    import sensor
+    from offline_buffer import OfflineBuffer
+
+    for scenario in (outage, spill_full, restart, publish_failure):
+        await scenario(sensor, OfflineBuffer)
+
+
+def main():
+    install_board_modules()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        asyncio.run(run())
+
+    sys.exit(1 if check.failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# Checks the asynchronous firmware download in src/lib/ota/update.py end to end: a firmware image is
+# served from a local HTTP server and streamed with afrom_file() into a stand-in for the OTA partition,
+# then the bytes on the partition and their SHA256 are compared against the image. It also checks that
+# an image that doesn't match the expected SHA256 is rejected and not set as the boot partition, and that
+# an interrupted download picks up where it left off: a connection that drops partway through is resumed
+# with a Range request from the offset saved in the checkpoint file, a server that ignores the Range and
+# sends the whole image gets it written from the start again, a checkpoint saved for a different url or
+# length is thrown away, and the checkpoint is removed once the download succeeds. CPython only:
+#
+#   python tools/check_ota_download.py
+
+import asyncio
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib.ota import blockdev_writer, update  # noqa: E402
+
+BLOCK_SIZE = 4096
+BLOCK_COUNT = 128
+IMAGE_SIZE = 100 * BLOCK_SIZE + 123
+DROP_AFTER = 40 * BLOCK_SIZE + 1000
+
+
+# Stands in for esp32.Partition, with the partition the update is written to kept in memory
+class FakePartition:
+    RUNNING = 0
+    BOOT = 1
+
+    target = None
+    boot = 'ota_0'
+
+    def __init__(self, which=RUNNING):
+        self.which = which
+
+    def get_next_update(self):
+        return FakePartition.target
+
+    def info(self):
+        return (0, 0x10, 0x10000, BLOCK_SIZE * BLOCK_COUNT, FakePartition.boot if self.which == FakePartition.BOOT else 'ota_0', False)
+
+
+class TargetPartition:
+    def __init__(self):
+        self.data = bytearray(b'\xff' * (BLOCK_SIZE * BLOCK_COUNT))
+        self.booted = False
+
+    def info(self):
+        return (0, 0x11, 0x200000, BLOCK_SIZE * BLOCK_COUNT, 'ota_1', False)
+
+    def ioctl(self, op, arg):
+        if op == 4:
+            return BLOCK_COUNT
+        if op == 5:
+            return BLOCK_SIZE
+        if op == 6:
+            self.data[arg * BLOCK_SIZE:(arg + 1) * BLOCK_SIZE] = b'\xff' * BLOCK_SIZE
+        return 0
+
+    def readblocks(self, block, buf, offset=0):
+        start = block * BLOCK_SIZE + offset
+        buf[:] = self.data[start:start + len(buf)]
+
+    def writeblocks(self, block, buf, offset=None):
+        start = block * BLOCK_SIZE + (offset or 0)
+        self.data[start:start + len(buf)] = buf
+
+    def set_boot(self):
+        self.booted = True
+        FakePartition.boot = 'ota_1'
+
+
+# Serves the image, answering Range requests unless ignore_range is set. Each entry in script is used up
+# by one request: 'drop' closes the connection partway through the body and 'fail' replies with a 503.
+class Handler(http.server.BaseHTTPRequestHandler):
+    image = b''
+    ignore_range = False
+    script = []
+    ranges = []
+
+    def do_GET(self):
+        requested = self.headers.get('Range')
+        Handler.ranges.append(requested)
+        action = Handler.script.pop(0) if Handler.script else None
+
+        if action == 'fail':
+            self.send_error(503)
+            return
+
+        start = 0
+
+        if requested and not self.ignore_range:
+            start = int(requested[len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(self.image) - 1}/{len(self.image)}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(self.image) - start))
+        self.end_headers()
+
+        if action == 'drop':
+            self.wfile.write(self.image[start:start + DROP_AFTER])
+        else:
+            self.wfile.write(self.image[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(image):
+    Handler.image = image
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f'http://127.0.0.1:{server.server_address[1]}/firmware.app-bin'
+
+
+def new_partition():
+    FakePartition.target = TargetPartition()
+    FakePartition.boot = 'ota_0'
+    Handler.ignore_range = False
+    Handler.script = []
+    Handler.ranges = []
+
+    return FakePartition.target
+
+
+def check(name, condition, detail=''):
+    print(f"{'OK  ' if condition else 'FAIL'} {name}{': ' + detail if detail else ''}")
+
+    if not condition:
+        check.failed = True
+
+
+check.failed = False
+
+
+async def download(url, sha, length):
+    # Keep the progress the OTA code prints out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        await update.afrom_file(url, sha=sha, length=length, verify='block', verbose=False, reboot=False)
+
+
+async def full_download(url, image, sha):
+    partition = new_partition()
+    await download(url, sha, len(image))
+    written = bytes(partition.data[:len(image)])
+
+    check('downloaded image matches byte for byte', written == image)
+    check('SHA256 of the partition matches', hashlib.sha256(written).hexdigest() == sha)
+    check('partition set to boot', partition.booted)
+
+
+def read_checkpoint():
+    try:
+        with open(update.CHECKPOINT_FILE) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def write_checkpoint(**checkpoint):
+    with open(update.CHECKPOINT_FILE, 'w') as f:
+        json.dump(checkpoint, f)
+
+
+def matches(partition, image, sha):
+    written = bytes(partition.data[:len(image)])
+
+    return written == image and hashlib.sha256(written).hexdigest() == sha
+
+
+# Drops the connection partway through and then fails the retry, leaving a checkpoint behind
+async def interrupted_download(url, image, sha):
+    Handler.script = ['drop', 'fail']
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        ota = update.OTA(verify='block', verbose=False)
+
+        try:
+            await ota.afrom_firmware_file(url, sha, len(image))
+        except ValueError:
+            pass
+
+    return read_checkpoint()
+
+
+async def wrong_sha(url, image):
+    partition = new_partition()
+
+    try:
+        await download(url, '0' * 64, len(image))
+        rejected = False
+    except ValueError:
+        rejected = True
+
+    check('image with the wrong SHA256 rejected', rejected and not partition.booted)
+
+
+async def resume(url, image, sha):
+    partition = new_partition()
+    checkpoint = await interrupted_download(url, image, sha)
+    offset = checkpoint['offset'] if checkpoint else 0
+
+    check('dropped connection saved a checkpoint', 0 < offset <= DROP_AFTER and offset % BLOCK_SIZE == 0,
+          f'offset {offset}')
+    check('dropped connection retried from the last block written', Handler.ranges == [None, f'bytes={offset}-'],
+          f'{Handler.ranges}')
+
+    Handler.ranges = []
+    await download(url, sha, len(image))
+
+    check('later attempt resumed from the checkpoint with a Range request', Handler.ranges == [f'bytes={offset}-'],
+          f'{Handler.ranges}')
+    check('resumed image matches', matches(partition, image, sha))
+    check('checkpoint removed after the download succeeded', read_checkpoint() is None)
+
+
+async def range_ignored(url, image, sha):
+    partition = new_partition()
+    checkpoint = await interrupted_download(url, image, sha)
+
+    # Anything kept from before the checkpoint would now fail the SHA256 check
+    partition.data[:checkpoint['offset']] = bytes(checkpoint['offset'])
+    Handler.ignore_range = True
+    Handler.ranges = []
+    await download(url, sha, len(image))
+
+    check('server ignoring the Range gets the image written from the start',
+          Handler.ranges == [f"bytes={checkpoint['offset']}-"] and matches(partition, image, sha))
+
+
+async def stale_checkpoint(url, image, sha):
+    for name, changes in (('different url', {'url': url + '.old'}), ('different length', {'length': len(image) + 1})):
+        partition = new_partition()
+        write_checkpoint(**dict({'url': url, 'sha': sha, 'length': len(image), 'partition': 'ota_1',
+                                 'offset': 40 * BLOCK_SIZE}, **changes))
+        await download(url, sha, len(image))
+
+        check(f'checkpoint for a {name} is discarded', Handler.ranges == [None] and matches(partition, image, sha),
+              f'{Handler.ranges}')
+        check(f'discarded checkpoint for a {name} is gone', read_checkpoint() is None)
+
+
+async def run(url, image):
+    sha = hashlib.sha256(image).hexdigest()
+
+    await full_download(url, image, sha)
+    await wrong_sha(url, image)
+    await resume(url, image, sha)
+    await range_ignored(url, image, sha)
+    await stale_checkpoint(url, image, sha)
+
+
+def main():
+    # Only the parts of esp32.Partition that OTA uses are needed
+    update.Partition = FakePartition
+
+    # aresume() replaces the BufferedWriter around the partition, and on CPython the old one closes the
+    # Blockdev they share when it's garbage collected, which MicroPython's doesn't do
+    blockdev_writer.Blockdev.close = lambda self: None
+
+    image = os.urandom(IMAGE_SIZE)
+    url = start_server(image)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        asyncio.run(run(url, image))
+
+    sys.exit(1 if check.failed else 0)
+
+
+if __name__ == '__main__':
+    main()
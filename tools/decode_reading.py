@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Decodes sensor reading payloads published by the board in any of its wire formats (JSON, struct or
+# CBOR) back into a dictionary. Can be imported by consumers, or run directly to decode a payload read
+# from a file or stdin and print it as JSON:
+#
+#   mosquitto_sub -h <broker-address> -t home/outdoor/weather -C 1 -N | python tools/decode_reading.py
+
+import json
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from reading_format import CBOR_V1, FIELDS, STRUCT_HEADER_FORMAT, STRUCT_HEADER_SIZE, STRUCT_V1  # noqa: E402
+
+BOOLEAN_FIELDS = ('triggered',)
+
+
+def decode(payload):
+    payload = bytes(payload)
+
+    if payload[:1] == b'{':
+        return json.loads(payload)
+
+    if payload[0] == STRUCT_V1:
+        return _decode_struct(payload)
+
+    if payload[0] == CBOR_V1:
+        reading, _ = _decode_cbor(payload, 1)
+        return reading
+
+    raise ValueError(f'Unknown payload format or schema version 0x{payload[0]:02x}')
+
+
+def _decode_struct(payload):
+    _, mask, timestamp = struct.unpack_from(STRUCT_HEADER_FORMAT, payload, 0)
+    reading = {'timestamp': timestamp}
+    i = STRUCT_HEADER_SIZE
+
+    for (bit, (name, fmt, size)) in enumerate(FIELDS):
+        if mask & (1 << bit):
+            (value,) = struct.unpack_from(fmt, payload, i)
+            reading[name] = bool(value) if name in BOOLEAN_FIELDS else value
+            i += size
+
+    if i != len(payload):
+        raise ValueError(f'Expected {i} bytes for fields 0x{mask:x}, got {len(payload)}')
+
+    return reading
+
+
+# Returns the decoded item at offset i and the offset of the next item
+def _decode_cbor(payload, i):
+    major, info = payload[i] >> 5, payload[i] & 0x1F
+    i += 1
+
+    if major == 7:
+        if info == 20:
+            return False, i
+        if info == 21:
+            return True, i
+        if info == 22:
+            return None, i
+        if info == 25:
+            return struct.unpack_from('>e', payload, i)[0], i + 2
+        if info == 26:
+            return struct.unpack_from('>f', payload, i)[0], i + 4
+        if info == 27:
+            return struct.unpack_from('>d', payload, i)[0], i + 8
+        raise ValueError(f'Unsupported CBOR simple value {info}')
+
+    if info < 24:
+        n = info
+    elif info in (24, 25, 26, 27):
+        size = 1 << (info - 24)
+        n = int.from_bytes(payload[i:i + size], 'big')
+        i += size
+    else:
+        raise ValueError(f'Unsupported CBOR length encoding {info}')
+
+    if major == 0:
+        return n, i
+    if major == 1:
+        return -1 - n, i
+    if major == 2:
+        return payload[i:i + n], i + n
+    if major == 3:
+        return payload[i:i + n].decode(), i + n
+    if major == 4:
+        items = []
+        for _ in range(n):
+            item, i = _decode_cbor(payload, i)
+            items.append(item)
+        return items, i
+    if major == 5:
+        items = {}
+        for _ in range(n):
+            key, i = _decode_cbor(payload, i)
+            items[key], i = _decode_cbor(payload, i)
+        return items, i
+
+    raise ValueError(f'Unsupported CBOR major type {major}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as file:
+            data = file.read()
+    else:
+        data = sys.stdin.buffer.read()
+
+    print(json.dumps(decode(data)))
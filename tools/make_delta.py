@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# Makes a patch that turns one firmware image into another, for boards that are already running the
+# old image to download instead of the whole of the new one (see the delta_url field of the firmware
+# update payload). The patch is applied back to the old image before it's written to check it, and the
+# SHA256 and size to put in the payload alongside it are printed:
+#
+#   python tools/make_delta.py old-firmware.bin new-firmware.bin firmware.patch
+
+import asyncio
+import hashlib
+import io
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib.ota.delta import COPY_FMT, HEADER_FMT, INSERT_FMT, MAGIC, OP_COPY, OP_END, OP_INSERT, VERSION, apply  # noqa: E402
+
+# Runs of the old image are indexed every STRIDE bytes by their first WINDOW bytes, and a match has
+# to be at least MIN_COPY bytes long to be worth the 9 bytes of a copy op over inserting it
+WINDOW = 16
+STRIDE = 8
+MIN_COPY = 32
+
+
+def make_delta(old, new):
+    index = {}
+
+    for offset in range(0, len(old) - WINDOW + 1, STRIDE):
+        index.setdefault(old[offset:offset + WINDOW], offset)
+
+    ops = []
+    insert_start = 0
+    pos = 0
+
+    while pos + WINDOW <= len(new):
+        match = index.get(new[pos:pos + WINDOW])
+        length = 0
+
+        if match is not None:
+            # Also try the same position in the old image, which is usually right when only a few
+            # bytes have changed in between
+            candidates = (match, pos - insert_start + _last_copy_end(ops)) if ops else (match,)
+
+            for offset in candidates:
+                n = _match_length(old, offset, new, pos)
+
+                if n > length:
+                    match, length = offset, n
+
+        if length < MIN_COPY:
+            pos += 1
+            continue
+
+        if insert_start < pos:
+            ops.append((OP_INSERT, new[insert_start:pos]))
+
+        ops.append((OP_COPY, match, length))
+        pos += length
+        insert_start = pos
+
+    if insert_start < len(new):
+        ops.append((OP_INSERT, new[insert_start:]))
+
+    patch = io.BytesIO()
+    patch.write(struct.pack(HEADER_FMT, MAGIC, VERSION, hashlib.sha256(old).digest(), len(old), len(new)))
+
+    for op in ops:
+        if op[0] == OP_COPY:
+            patch.write(bytes([OP_COPY]) + struct.pack(COPY_FMT, op[1], op[2]))
+        else:
+            patch.write(bytes([OP_INSERT]) + struct.pack(INSERT_FMT, len(op[1])) + op[1])
+
+    patch.write(bytes([OP_END]))
+
+    return patch.getvalue()
+
+
+def _last_copy_end(ops):
+    for op in reversed(ops):
+        if op[0] == OP_COPY:
+            return op[1] + op[2]
+
+    return 0
+
+
+def _match_length(old, offset, new, pos):
+    if offset < 0 or offset >= len(old):
+        return 0
+
+    n = 0
+    end = min(len(old) - offset, len(new) - pos)
+
+    while n < end and old[offset + n] == new[pos + n]:
+        n += 1
+
+    return n
+
+
+# Stand-ins for the partition and writer on the board so the patch can be checked with lib.ota.delta
+class _Image:
+    def __init__(self, data, block_size=4096):
+        self.data = data
+        self.block_size = block_size
+
+    def ioctl(self, op, arg):
+        return self.block_size
+
+    def readblocks(self, block, buf, offset=0):
+        start = block * self.block_size + offset
+        buf[:] = self.data[start:start + len(buf)]
+
+
+class _Writer:
+    def __init__(self):
+        self.out = io.BytesIO()
+        self.length = 0
+
+    @property
+    def written(self):
+        return self.out.tell()
+
+    def write(self, data):
+        return self.out.write(data)
+
+
+class _Stream:
+    def __init__(self, data):
+        self.f = io.BytesIO(data)
+
+    async def readinto(self, buf):
+        return self.f.readinto(buf)
+
+
+def check(old, new, patch):
+    writer = _Writer()
+    asyncio.run(apply(_Stream(patch), _Image(old), writer))
+
+    return writer.out.getvalue() == new
+
+
+def main():
+    if len(sys.argv) != 4:
+        print(f'Usage: {sys.argv[0]} <old firmware> <new firmware> <patch>', file=sys.stderr)
+        sys.exit(1)
+
+    with open(sys.argv[1], 'rb') as f:
+        old = f.read()
+
+    with open(sys.argv[2], 'rb') as f:
+        new = f.read()
+
+    patch = make_delta(old, new)
+
+    if not check(old, new, patch):
+        print('Applying the patch did not reproduce the new firmware', file=sys.stderr)
+        sys.exit(1)
+
+    with open(sys.argv[3], 'wb') as f:
+        f.write(patch)
+
+    print(f'Patch size: {len(patch)} bytes ({len(patch) * 100 // max(len(new), 1)}% of {len(new)})')
+    print(f'sha256: {hashlib.sha256(new).hexdigest()}')
+    print(f'size: {len(new)}')
+
+
+if __name__ == '__main__':
+    main()